@@ -2,6 +2,12 @@ const http = require('http');
 const receiptline = require('receiptline');
 const { URL } = require('url');
 const { parse } = require('querystring');
+const fs = require('fs');
+const path = require('path');
+
+// ロゴ画像は起動時に1回だけ読み込み、レシートテキスト中のプレースホルダーを置き換える
+const LOGO_PLACEHOLDER = '{image:logo}';
+const LOGO_IMAGE = `{image:${fs.readFileSync(path.join(__dirname, 'logo.png')).toString('base64')}}`;
 
 // HTMLテンプレート
 const generateHtml = svg => `<!DOCTYPE html>
@@ -33,7 +39,8 @@ const server = http.createServer(async (req, res) => {
             req.on('end', async () => {
                 const { text } = parse(body);
                 if (text) {
-                    const svg = receiptline.transform(text, { cpl: 35, encoding: 'shiftjis', spacing: true });
+                    const receipt = text.split(LOGO_PLACEHOLDER).join(LOGO_IMAGE);
+                    const svg = receiptline.transform(receipt, { cpl: 35, encoding: 'shiftjis', spacing: true });
                     const html = generateHtml(svg);
 
                     res.writeHead(200, { 'Content-Type': 'text/html; charset=utf-8' });
@@ -1,21 +1,38 @@
+import csv
+import io
 from django.contrib import admin, messages
-from django.db import transaction
-from django.db.models import Sum, F, FloatField, OuterRef, Subquery
-from django.db.models.functions import Coalesce
+from django.http import HttpResponseRedirect
+from django.template.response import TemplateResponse
+from django.db.models import Sum, F
 from django.utils import timezone
 from django.utils.html import format_html
-from django.urls import reverse
-from import_export import resources
+from django.urls import path, reverse
+from import_export import fields, resources, widgets
 from import_export.admin import ImportExportModelAdmin
 from simple_history.admin import SimpleHistoryAdmin
 from django import forms
+from .catalog_cache import catalog_cache
+from .db_router import replica_alias
+from .exports import streaming_export_response
+from .stock import (
+    adjust_stocks,
+    deferred_stock_provisioning,
+    provision_stocks,
+    regenerate_stocks,
+    set_stock_quantities,
+    with_current_quantity,
+)
+from .forms import StockAdjustmentForm, StockAdjustmentUploadForm
 from .models import (
     Store,
     Product,
     Stock,
+    StockMovement,
     Transaction,
     SaleProduct,
     SaleSummary,
+    DailySalesRollup,
+    SalesRollupDelta,
     ReturnTransaction,
     ReturnProduct,
     Coupon,
@@ -42,12 +59,46 @@ class ProductResource(BaseResource):
         import_id_fields = ("JAN",)
         fields = ("JAN", "name", "price", "tax")
 
+    def import_data(self, dataset, *args, **kwargs):
+        # 行ごとのシグナルでは在庫を作成せず、after_importでまとめて作成する
+        with deferred_stock_provisioning():
+            return super().import_data(dataset, *args, **kwargs)
+
+    def after_import(self, dataset, result, **kwargs):
+        # 一括インポート後は商品キャッシュ全体を破棄し、インポートした商品の在庫を全店舗分まとめて作成する
+        if not kwargs.get("dry_run"):
+            catalog_cache.invalidate()
+            result.provisioned_stocks = provision_stocks(jan_codes={str(jan_code) for jan_code in dataset["JAN"]})
+
 
 class StockResource(BaseResource):
+    # 在庫のJANは商品のidではなくJANコードで参照する (エクスポートと同じ値でインポートできるようにする)
+    JAN = fields.Field(attribute="JAN", column_name="JAN", widget=widgets.ForeignKeyWidget(Product, "JAN"))
+
     class Meta:
         model = Stock
         import_id_fields = ("storecode", "JAN")
 
+    def dehydrate_quantity(self, stock):
+        # エクスポートでは未集約の入出庫を含めた現在の在庫数を出力する
+        return getattr(stock, "current_quantity", stock.quantity)
+
+    def before_import(self, dataset, **kwargs):
+        self.imported_quantities = {}
+
+    def do_instance_save(self, instance, is_create):
+        if is_create:
+            instance.save()
+        else:
+            # 既存の在庫はスナップショットを書き換えず、after_importで入出庫として記録する
+            self.imported_quantities[instance.pk] = instance.quantity
+
+    def after_import(self, dataset, result, **kwargs):
+        # インポートした在庫数が未集約の入出庫を含めた現在の在庫数になるように、差分を在庫調整として記録する
+        # (プレビュー (dry run) ではインポート全体がロールバックされる)
+        if self.imported_quantities:
+            set_stock_quantities(self.imported_quantities, reference="インポート", user=kwargs.get("user"))
+
 
 class TransactionResource(BaseResource):
     class Meta:
@@ -100,7 +151,7 @@ class NegativeQuantityFilter(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value() == "negative":
-            return queryset.filter(quantity__lt=0)
+            return queryset.filter(current_quantity__lt=0)
         return queryset
 
 
@@ -133,56 +184,192 @@ class ProductAdmin(ImportExportModelAdmin):
     inlines = [StockInline]
     actions = ["regenerate_stock"]
 
-    @transaction.atomic
     def regenerate_stock(self, request, queryset):
+        # 一定件数ごとにコミットし、長時間のロックを避ける (失敗した場合はそれまでの区切りは反映済み)
         try:
-            stores = Store.objects.all()
-            batch_size = 50  # バッチサイズを決定
-            for i in range(0, queryset.count(), batch_size):
-                batch = queryset[i:i + batch_size]
-                for product in batch:
-                    for store in stores:
-                        Stock.objects.update_or_create(storecode=store, JAN=product, defaults={"quantity": 0})
-            self.message_user(request, "選択した商品の在庫が再生成されました。", messages.SUCCESS)
+            created, reset = regenerate_stocks(queryset.values_list("JAN", flat=True), history_user=request.user)
+            self.message_user(
+                request,
+                f"選択した商品の在庫が再生成されました。(作成 {created} 件 / リセット {reset} 件)",
+                messages.SUCCESS,
+            )
         except Exception as e:
             self.message_user(request, f"在庫の再生成に失敗しました: {str(e)}", messages.ERROR)
-            transaction.set_rollback(True)
+
+    def add_success_message(self, result, request):
+        super().add_success_message(result, request)
+        provisioned = getattr(result, "provisioned_stocks", 0)
+        if provisioned:
+            self.message_user(request, f"インポートした商品の在庫を{provisioned}件作成しました。", messages.INFO)
 
     regenerate_stock.short_description = "選択した商品の在庫を再生成"
 
 
 class StockAdmin(ImportExportModelAdmin, SimpleHistoryAdmin):
     resource_class = StockResource
-    list_display = ("storecode", "JAN", "quantity")
+    list_display = ("storecode", "JAN", "current_quantity", "quantity")
     list_filter = (StoreCodeNameFilter, NegativeQuantityFilter)
     search_fields = ("storecode__storecode", "JAN__JAN")
     list_per_page = 50
-    actions = ["add_stock", "reset_stock"]
+    actions = ["add_stock", "reset_stock", "adjust_stock"]
+    change_list_template = "admin/DBmaint/stock/change_list.html"
+
+    def get_queryset(self, request):
+        return with_current_quantity(super().get_queryset(request))
+
+    def get_readonly_fields(self, request, obj=None):
+        # 既存の在庫数 (スナップショット) は直接変更せず、在庫調整のアクションで入出庫として記録する
+        return ("quantity",) if obj else ()
+
+    def current_quantity(self, obj):
+        return obj.current_quantity
+
+    current_quantity.short_description = "現在の在庫数"
+    current_quantity.admin_order_field = "current_quantity"
 
-    @transaction.atomic
     def add_stock(self, request, queryset):
         try:
-            for stock in queryset:
-                stock.quantity += 10
-                stock.save()
-            self.message_user(request, "選択した商品の在庫を10個加算しました。", messages.SUCCESS)
+            movements = adjust_stocks(dict.fromkeys(queryset.values_list("pk", flat=True), 10), history_user=request.user)
+            self.message_user(request, f"選択した商品の在庫を10個加算しました。({len(movements)} 件)", messages.SUCCESS)
         except Exception as e:
             self.message_user(request, f"在庫の加算に失敗しました: {str(e)}", messages.ERROR)
-            transaction.set_rollback(True)
 
     add_stock.short_description = "選択した商品の在庫を10個加算"
 
-    @transaction.atomic
     def reset_stock(self, request, queryset):
         try:
-            queryset.update(quantity=0)
-            self.message_user(request, "選択した在庫をリセットしました。", messages.SUCCESS)
+            movements = adjust_stocks(
+                dict.fromkeys(queryset.values_list("pk", flat=True), 0), mode="set", history_user=request.user
+            )
+            self.message_user(request, f"選択した在庫をリセットしました。({len(movements)} 件)", messages.SUCCESS)
         except Exception as e:
             self.message_user(request, f"在庫のリセットに失敗しました: {str(e)}", messages.ERROR)
-            transaction.set_rollback(True)
 
     reset_stock.short_description = "選択した在庫をリセット"
 
+    def adjust_stock(self, request, queryset):
+        # 確認画面で変更方法と数量を入力してから、選択した在庫をまとめて変更する
+        form = StockAdjustmentForm(request.POST if "apply" in request.POST else None)
+        if form.is_valid():
+            try:
+                movements = adjust_stocks(
+                    dict.fromkeys(queryset.values_list("pk", flat=True), form.cleaned_data["value"]),
+                    mode=form.cleaned_data["mode"],
+                    history_user=request.user,
+                    change_reason=form.cleaned_data["reason"],
+                )
+                self.message_user(request, f"選択した在庫 {len(movements)} 件の在庫数を変更しました。", messages.SUCCESS)
+            except Exception as e:
+                self.message_user(request, f"在庫数の変更に失敗しました: {str(e)}", messages.ERROR)
+            return None
+
+        context = {
+            **self.admin_site.each_context(request),
+            "title": "在庫数の一括変更",
+            "opts": self.model._meta,
+            "form": form,
+            "stocks": queryset.only("pk"),
+        }
+        return TemplateResponse(request, "admin/DBmaint/stock/adjust.html", context)
+
+    adjust_stock.short_description = "選択した在庫の在庫数を変更"
+
+    def get_urls(self):
+        urls = [
+            path(
+                "adjust-upload/",
+                self.admin_site.admin_view(self.adjust_upload_view),
+                name="DBmaint_stock_adjust_upload",
+            ),
+        ]
+        return urls + super().get_urls()
+
+    def adjust_upload_view(self, request):
+        """
+        店番・JAN・数量のCSVファイルで、在庫ごとに異なる数量をまとめて変更する
+        """
+        form = StockAdjustmentUploadForm(request.POST or None, request.FILES or None)
+        if form.is_valid():
+            try:
+                adjustments, errors = self.read_adjustments(form.cleaned_data["file"], form.cleaned_data["mode"])
+            except (UnicodeDecodeError, csv.Error) as e:
+                errors = [f"CSVファイルを読み込めませんでした: {str(e)}"]
+            if errors:
+                for error in errors[:10]:
+                    self.message_user(request, error, messages.ERROR)
+            else:
+                movements = adjust_stocks(
+                    adjustments,
+                    mode=form.cleaned_data["mode"],
+                    history_user=request.user,
+                    change_reason=form.cleaned_data["reason"],
+                )
+                self.message_user(request, f"在庫 {len(movements)} 件の在庫数を変更しました。", messages.SUCCESS)
+                return HttpResponseRedirect(reverse("admin:DBmaint_stock_changelist"))
+
+        context = {
+            **self.admin_site.each_context(request),
+            "title": "在庫数の一括変更 (CSV)",
+            "opts": self.model._meta,
+            "form": form,
+        }
+        return TemplateResponse(request, "admin/DBmaint/stock/adjust.html", context)
+
+    def read_adjustments(self, uploaded_file, mode="delta"):
+        """
+        CSVファイルを {在庫のpk: 数量} に変換し、(変換結果, エラーのリスト) を返す
+        在庫は1回のクエリでまとめて取得し、エラーが1件でもあれば何も変更しない
+        同じ店番・JANの行は、加算 (delta) の場合は合計し、設定 (set) の場合はエラーにする
+        """
+        reader = csv.reader(io.TextIOWrapper(uploaded_file, encoding="utf-8-sig"))
+        next(reader, None)  # 見出し行
+        rows, errors = {}, []
+        for line_number, row in enumerate(reader, start=2):
+            if not any(row):
+                continue
+            try:
+                storecode, jan_code, value = (cell.strip() for cell in row[:3])
+                value = int(value)
+            except ValueError:
+                errors.append(f"{line_number}行目: 店番・JAN・数量(整数)の3列を指定してください。")
+                continue
+            if mode == "set" and (storecode, jan_code) in rows:
+                errors.append(f"{line_number}行目: 店番 {storecode} と JAN {jan_code} の行が重複しています。")
+                continue
+            rows[(storecode, jan_code)] = rows.get((storecode, jan_code), 0) + value
+
+        stock_ids = {
+            (storecode, jan_code): pk
+            for pk, storecode, jan_code in Stock.objects.filter(
+                storecode__in={storecode for storecode, _ in rows}, JAN__in={jan_code for _, jan_code in rows}
+            ).values_list("pk", "storecode", "JAN")
+        }
+        adjustments = {}
+        for key, value in rows.items():
+            if key not in stock_ids:
+                errors.append(f"店番 {key[0]} と JAN {key[1]} の在庫が存在しません。")
+            else:
+                adjustments[stock_ids[key]] = value
+        return adjustments, errors
+
+
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ("created_at", "stock", "kind", "quantity", "reference", "user", "compacted")
+    list_filter = ("kind", "compacted", "created_at")
+    search_fields = ("reference", "stock__JAN__JAN", "stock__storecode__storecode")
+    list_select_related = ("stock", "user")
+    ordering = ("-id",)
+
+    # 入出庫台帳は追記のみのため、管理画面からの追加・変更・削除は行わない
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
 
 class TransactionAdmin(ImportExportModelAdmin, SimpleHistoryAdmin):
     resource_class = TransactionResource
@@ -199,9 +386,35 @@ class TransactionAdmin(ImportExportModelAdmin, SimpleHistoryAdmin):
         "receipt_button",  # ここに新しい列を追加
     )
     search_fields = ("sale_id", "storecode__storecode", "staffcode__staffcode")
-    list_filter = ("sale_type", "sale_date")
+    list_filter = ("sale_type", "sale_date", StoreCodeNameFilter)
     ordering = ("-id",)
     inlines = [SaleProductInline]
+    actions = ["export_transactions_csv", "export_transactions_jsonl", "export_sale_products_csv", "export_sale_products_jsonl"]
+
+    # 日付・店舗で絞り込んだ一覧から「全件を選択」して実行すると、絞り込み結果の全件をストリーミングで出力する
+    def export_transactions_csv(self, request, queryset):
+        return streaming_export_response("transactions", "csv", queryset=queryset)
+
+    export_transactions_csv.short_description = "選択した取引をCSVで出力"
+
+    def export_transactions_jsonl(self, request, queryset):
+        return streaming_export_response("transactions", "jsonl", queryset=queryset)
+
+    export_transactions_jsonl.short_description = "選択した取引をJSONLで出力"
+
+    def export_sale_products_csv(self, request, queryset):
+        return streaming_export_response(
+            "saleproducts", "csv", queryset=SaleProduct.objects.filter(transaction__in=queryset.values("pk"))
+        )
+
+    export_sale_products_csv.short_description = "選択した取引の販売商品をCSVで出力"
+
+    def export_sale_products_jsonl(self, request, queryset):
+        return streaming_export_response(
+            "saleproducts", "jsonl", queryset=SaleProduct.objects.filter(transaction__in=queryset.values("pk"))
+        )
+
+    export_sale_products_jsonl.short_description = "選択した取引の販売商品をJSONLで出力"
 
     def receipt_button(self, obj):
         return format_html(
@@ -216,6 +429,22 @@ class SaleProductAdmin(ImportExportModelAdmin, SimpleHistoryAdmin):
     resource_class = SaleProductResource
     list_display = ("transaction_id", "JAN", "name", "price", "tax", "points")
     search_fields = ("transaction__id", "JAN__JAN", "name")
+    list_filter = ("transaction__sale_date",)
+    actions = ["export_csv", "export_jsonl"]
+
+    def export_csv(self, request, queryset):
+        return streaming_export_response("saleproducts", "csv", queryset=queryset)
+
+    export_csv.short_description = "選択した販売商品をCSVで出力"
+
+    def export_jsonl(self, request, queryset):
+        return streaming_export_response("saleproducts", "jsonl", queryset=queryset)
+
+    export_jsonl.short_description = "選択した販売商品をJSONLで出力"
+
+
+# 販売概要の商品・日ごとの合計と全体の合計に表示する列
+SUMMARY_TOTALS = ("total_amount", "total_points", "returned_amount", "returned_points")
 
 
 class SaleSummaryAdmin(admin.ModelAdmin):
@@ -224,34 +453,59 @@ class SaleSummaryAdmin(admin.ModelAdmin):
     change_list_template = "admin/sale_summary_change_list.html"
 
     def get_queryset(self, request):
-        return super().get_queryset(request)
+        # 集計画面の読み取りはレプリカで行う
+        return super().get_queryset(request).using(replica_alias())
 
     def changelist_view(self, request, extra_context=None):
-        qs = self.get_queryset(request)
-
-        product_names = Product.objects.filter(JAN=OuterRef("JAN__JAN")).values("JAN")[:1]
-
-        summary = (
-            SaleProduct.objects.filter(transaction__in=qs)
-            .values("JAN__JAN", "transaction__sale_date__date")
-            .annotate(
-                name=Subquery(product_names.values("name")[:1]),
-                total_amount=Coalesce(Sum(F("price") * F("points")), 0, output_field=FloatField()),
-                total_points=Coalesce(Sum("points"), 0),
+        # 販売商品を毎回集計せず、日別販売集計と集計待ちの行から読み込む
+        # 集計待ちの行は集計の後に読むため、間に加算 (fold_sales_rollup) が実行されても二重には数えない
+        filters = self.get_rollup_filters(request)
+        summary = {}
+        for model in (DailySalesRollup, SalesRollupDelta):
+            rows = (
+                model.objects.using(replica_alias())
+                .filter(**filters)
+                .values("JAN", "date")
+                .annotate(
+                    name=F("JAN__name"),
+                    total_amount=Sum("sold_amount"),
+                    total_points=Sum("sold_points"),
+                    returned_amount=Sum("returned_amount"),
+                    returned_points=Sum("returned_points"),
+                )
+                .order_by()
             )
-            .order_by("-total_points", "-transaction__sale_date__date")
-        )
-
-        total_amount = summary.aggregate(total=Sum("total_amount"))["total"] or 0
-        total_points = summary.aggregate(total=Sum("total_points"))["total"] or 0
+            for row in rows:
+                item = summary.get((row["JAN"], row["date"]))
+                if item is None:
+                    summary[(row["JAN"], row["date"])] = row
+                    continue
+                for key in SUMMARY_TOTALS:
+                    item[key] += row[key]
+        summary = sorted(summary.values(), key=lambda item: (-item["total_points"], -item["date"].toordinal()))
+        totals = {key: sum(item[key] for item in summary) for key in SUMMARY_TOTALS}
 
         extra_context = extra_context or {}
         extra_context["summary"] = summary
-        extra_context["total_amount"] = total_amount
-        extra_context["total_points"] = total_points
+        extra_context.update(totals)
 
         return super().changelist_view(request, extra_context=extra_context)
 
+    def get_rollup_filters(self, request):
+        """
+        日付階層・日付フィルターの条件 (sale_date__*) を日別販売集計の日付の条件に変換する
+        """
+        filters = {}
+        for key, value in request.GET.items():
+            lookup = key.removeprefix("sale_date__")
+            if lookup == key or not value:
+                continue
+            if lookup in ("year", "month", "day"):
+                filters[f"date__{lookup}"] = value
+            elif lookup in ("gte", "lt"):
+                filters[f"date__{lookup}"] = value[:10]
+        return filters
+
 
 class ReturnTransactionAdmin(ImportExportModelAdmin, SimpleHistoryAdmin):
     resource_class = ReturnTransactionResource
@@ -351,6 +605,7 @@ class CouponAdmin(admin.ModelAdmin):
 admin.site.register(Store, StoreAdmin)
 admin.site.register(Product, ProductAdmin)
 admin.site.register(Stock, StockAdmin)
+admin.site.register(StockMovement, StockMovementAdmin)
 admin.site.register(Transaction, TransactionAdmin)
 admin.site.register(SaleProduct, SaleProductAdmin)
 admin.site.register(SaleSummary, SaleSummaryAdmin)
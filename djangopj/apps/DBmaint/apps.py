@@ -6,5 +6,5 @@ class DbmaintConfig(AppConfig):
     name = "apps.DBmaint"
     verbose_name = "販売管理サブシステム"
 
-    # def ready(self):
-    #     import DBmaint.signals
+    def ready(self):
+        from . import signals
@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from .models import CatalogChange, Product
+
+# キャッシュを変更バージョンに追従させる際に、個別に破棄する変更の上限 (超えた場合はキャッシュ全体を破棄する)
+SYNC_MAX_CHANGES = 1000
+
+
+class CatalogCache:
+    """
+    ワーカープロセス内で商品マスターをJANコードをキーに保持するキャッシュ
+    上限件数を超えると最も古く参照された商品から破棄する (LRU)
+    同一プロセス内の変更はシグナルで即時に破棄し、他のワーカーでの変更はTTLで反映する
+    sync() を呼び出した場合は、指定した変更バージョンまでの他のワーカーでの変更も破棄してから返す
+    キャッシュから返す商品インスタンスは共有されるため、呼び出し側で変更しないこと
+    レプリカから読み込んだ商品は遅延で古い可能性があるためキャッシュしない (販売の金額計算でも同じキャッシュを使うため)
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # キャッシュの内容が反映済みの変更バージョン (Noneは未同期)
+        self._version = None
+        # 破棄のたびに増やす世代 (読み込み中に破棄された商品をキャッシュに戻さないために使う)
+        self._generation = 0
+
+    def sync(self, version):
+        """
+        変更バージョンversionまでの商品の変更をキャッシュに反映する
+        以降に返す商品はversion時点以降の内容になるため、versionから算出したETagと食い違わない
+        """
+        known = self._version
+        if version is None or (known is not None and version <= known):
+            return
+        keys = None
+        if known is not None:
+            keys = list(self._changed_products(known, version)[:SYNC_MAX_CHANGES + 1])
+        self._apply_sync(known, version, keys)
+
+    async def async_sync(self, version):
+        """
+        syncの非同期版
+        """
+        known = self._version
+        if version is None or (known is not None and version <= known):
+            return
+        keys = None
+        if known is not None:
+            keys = [key async for key in self._changed_products(known, version)[:SYNC_MAX_CHANGES + 1]]
+        self._apply_sync(known, version, keys)
+
+    def _changed_products(self, known, version):
+        return CatalogChange.objects.filter(kind="product", id__gt=known, id__lte=version).values_list("key", flat=True)
+
+    def _apply_sync(self, known, version, keys):
+        with self._lock:
+            if self._version is not None and self._version >= version:
+                # 他のスレッドが先に同期した
+                return
+            if keys is None or len(keys) > SYNC_MAX_CHANGES or self._version != known:
+                # 未同期・変更が多い場合は、キャッシュ全体を破棄する
+                self._entries.clear()
+            else:
+                for key in keys:
+                    self._entries.pop(key, None)
+            self._version = version
+            self._generation += 1
+
+    def get(self, jan_code):
+        return self.get_many([jan_code]).get(jan_code)
+
+    def get_many(self, jan_codes):
+        """
+        JANコードをキーにした商品の辞書を返す
+        キャッシュにない商品は1回のクエリでまとめて取得する
+        存在しないJANは結果に含まれない
+        """
+        now, generation, found, missing = self._lookup(jan_codes)
+        if missing:
+            queryset = Product.objects.all()
+            found.update(self._store(queryset.in_bulk(missing, field_name="JAN"), now, generation, queryset.db))
+        return found
+
+    async def aget(self, jan_code):
+        return (await self.aget_many([jan_code])).get(jan_code)
+
+    async def aget_many(self, jan_codes):
+        """
+        get_manyの非同期版 (キャッシュにない商品は非同期ORMで取得する)
+        """
+        now, generation, found, missing = self._lookup(jan_codes)
+        if missing:
+            queryset = Product.objects.all()
+            found.update(self._store(await queryset.ain_bulk(missing, field_name="JAN"), now, generation, queryset.db))
+        return found
+
+    def _lookup(self, jan_codes):
+        now = time.monotonic()
+        found = {}
+        missing = set()
+        with self._lock:
+            for jan_code in set(jan_codes):
+                entry = self._entries.get(jan_code)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(jan_code)
+                    found[jan_code] = entry[0]
+                    self.hits += 1
+                else:
+                    missing.add(jan_code)
+                    self.misses += 1
+            generation = self._generation
+        return now, generation, found, missing
+
+    def _store(self, products, now, generation, using):
+        if using != DEFAULT_DB_ALIAS:
+            # レプリカから読み込んだ商品はキャッシュしない
+            return products
+        with self._lock:
+            if generation != self._generation:
+                # 読み込み中に破棄された場合は、古い内容の可能性があるためキャッシュしない
+                return products
+            for jan_code, product in products.items():
+                self._entries[jan_code] = (product, now + self.ttl)
+                self._entries.move_to_end(jan_code)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return products
+
+    def invalidate(self, jan_code=None):
+        """
+        指定したJANの商品をキャッシュから破棄する
+        JANを省略した場合はキャッシュ全体を破棄する
+        """
+        with self._lock:
+            if jan_code is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(jan_code, None)
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else None,
+            }
+
+
+catalog_cache = CatalogCache(
+    maxsize=getattr(settings, "CATALOG_CACHE_SIZE", 50000),
+    ttl=getattr(settings, "CATALOG_CACHE_TTL", 60),
+)
@@ -0,0 +1,90 @@
+from django.db import connection, transaction
+from django.db.models import Count, Max, Subquery
+from .models import CatalogChange, Coupon, Product
+
+
+def record_catalog_changes(kind, keys, operation="upsert"):
+    """
+    商品・クーポンの変更を変更履歴へまとめて記録する
+    PostgreSQLでは変更履歴テーブルを書き込み同士で排他し、バージョン(id)の採番順とコミット順を一致させる
+    (採番順とコミット順がずれると、差分取得時に先に読まれた大きいバージョンの陰で変更を取りこぼす)
+    ロックは呼び出し元のトランザクションが終わるまで保持される
+    """
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(f'LOCK TABLE "{CatalogChange._meta.db_table}" IN SHARE ROW EXCLUSIVE MODE')
+        CatalogChange.objects.bulk_create(
+            [CatalogChange(kind=kind, key=key, operation=operation) for key in keys]
+        )
+
+
+def _latest_catalog_change_fields():
+    latest = CatalogChange.objects.order_by("-id")
+    return {
+        "version": Max(Subquery(latest.values("id")[:1])),
+        "changed_at": Max(Subquery(latest.values("changed_at")[:1])),
+        "product_count": Count("id"),
+        "product_max_id": Max("id"),
+    }
+
+
+def latest_catalog_change():
+    """
+    最新の変更バージョンと変更日時、商品の件数・最大のidを1回のクエリで返す (変更履歴がない場合はバージョン・変更日時はNone)
+    商品の変更は保存・削除のシグナル (もしくはrecord_catalog_changes) で変更履歴に記録されることを前提とする
+    (変更バージョンは商品キャッシュの同期・レジの差分同期にも使う)。
+    シグナルを通らないquerysetのupdate()などで商品を変更する場合は、record_catalog_changesで変更を記録すること
+    商品の件数・最大のidはシグナルを通らない一括登録・一括削除でもETagを変えるために含める
+    """
+    return Product.objects.aggregate(**_latest_catalog_change_fields())
+
+
+async def alatest_catalog_change():
+    """
+    latest_catalog_changeの非同期版
+    """
+    return await Product.objects.aaggregate(**_latest_catalog_change_fields())
+
+
+def catalog_etag_source(latest):
+    """
+    latest_catalog_changeの結果から、商品一覧のETagの元になる値を返す
+    """
+    return "{version}:{product_count}:{product_max_id}".format(**latest)
+
+
+def get_catalog_changes(since, limit):
+    """
+    指定バージョンより後の変更を、種別ごとの最新状態に畳み込んで返す
+    1回あたり最大limit件の変更履歴を読み、続きがある場合はhas_moreをTrueにする
+    """
+    changes = list(
+        CatalogChange.objects.filter(id__gt=since).order_by("id").values_list("id", "kind", "key", "operation")[:limit]
+    )
+
+    # 同じキーへの複数の変更は最後の操作だけを残す
+    latest = {}
+    for version, kind, key, operation in changes:
+        latest[(kind, key)] = (version, operation)
+
+    result = {
+        "version": changes[-1][0] if changes else since,
+        "has_more": len(changes) == limit,
+    }
+    for kind, queryset, key_field in (
+        ("product", Product.objects.all(), "JAN"),
+        ("coupon", Coupon.objects.select_related("applicable_product_jan").prefetch_related("combo_product_jans"), "code"),
+    ):
+        upsert_keys = [key for (k, key), (_, operation) in latest.items() if k == kind and operation == "upsert"]
+        rows = queryset.in_bulk(upsert_keys, field_name=key_field) if upsert_keys else {}
+        result[kind] = {
+            # 現在の行と、その行に対応する変更バージョンの組
+            "upserts": [(rows[key], latest[(kind, key)][0]) for key in upsert_keys if key in rows],
+            # 削除済み、もしくは差分取得までに削除された行
+            "deletes": [key for (k, key), _ in latest.items() if k == kind and key not in rows],
+        }
+    return result
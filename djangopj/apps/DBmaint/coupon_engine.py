@@ -0,0 +1,272 @@
+import threading
+import time
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from .models import Coupon
+
+# 小計に対して按分して税額計算に反映するクーポン種別
+PROPORTIONAL_COUPON_TYPES = ("percent", "amount", "combo")
+
+
+class CompiledCoupon:
+    """
+    判定に必要な値だけを保持したクーポン
+    対象JANは商品のidではなくJANコードで保持する
+    """
+
+    __slots__ = (
+        "code",
+        "coupon_type",
+        "expiration_date",
+        "discount_value",
+        "discount_percentage",
+        "applicable_jan",
+        "combo_jans",
+        "min_quantity",
+    )
+
+    def __init__(
+        self,
+        code,
+        coupon_type,
+        expiration_date,
+        discount_value,
+        discount_percentage=None,
+        applicable_jan=None,
+        combo_jans=(),
+        min_quantity=1,
+    ):
+        self.code = code
+        self.coupon_type = coupon_type
+        self.expiration_date = expiration_date
+        self.discount_value = discount_value
+        self.discount_percentage = discount_percentage
+        self.applicable_jan = applicable_jan
+        self.combo_jans = frozenset(combo_jans)
+        self.min_quantity = min_quantity or 1
+
+    @classmethod
+    def from_model(cls, coupon):
+        return cls(
+            code=coupon.code,
+            coupon_type=coupon.coupon_type,
+            expiration_date=coupon.expiration_date,
+            discount_value=coupon.discount_value,
+            discount_percentage=coupon.discount_percentage,
+            applicable_jan=coupon.applicable_product_jan.JAN if coupon.applicable_product_jan else None,
+            combo_jans=[product.JAN for product in coupon.combo_product_jans.all()],
+            min_quantity=coupon.min_quantity,
+        )
+
+    def discount(self, amount, quantities):
+        """
+        小計amountと {JAN: 点数} の購入内容に対する割引額を返す
+        """
+        if self.coupon_type == "percent":
+            return (amount * self.discount_percentage / Decimal("100.0")).quantize(Decimal("1"), rounding=ROUND_HALF_UP)
+        if self.coupon_type == "amount":
+            return self.discount_value
+        if self.coupon_type == "product":
+            return self.discount_value if self.applicable_jan in quantities else 0
+        if self.coupon_type == "combo":
+            return int(self.discount_value) if self.combo_jans.issubset(quantities) else 0
+        if self.coupon_type == "multi":
+            total_quantity = quantities.get(self.applicable_jan, 0)
+            if total_quantity >= self.min_quantity:
+                return self.discount_value * (total_quantity // self.min_quantity)
+        return 0
+
+
+class CouponResult:
+    def __init__(self):
+        self.discounts = {}
+        self.total = 0
+        # 税額計算で小計に按分する割引額 (percent, amount, combo)
+        self.proportional = 0
+        self.invalid_codes = []
+
+
+class CouponIndex:
+    """
+    有効なクーポンをコード・JAN・種別で引けるようにまとめた索引
+    parentを指定した場合は、parentの索引にDBから読み直したクーポンを重ねた索引になる (parentは変更しない)
+    loadedはDBから読み直したコードで、DBに存在しなかったコードもparentの内容によらず存在しないものとして扱う
+    """
+
+    def __init__(self, coupons, parent=None, loaded=()):
+        self.parent = parent
+        self.loaded = frozenset(loaded)
+        self.by_code = {}
+        self.by_jan = defaultdict(list)
+        self.basket_wide = []
+        for coupon in coupons:
+            self.by_code[coupon.code] = coupon
+            if coupon.coupon_type in ("product", "multi"):
+                self.by_jan[coupon.applicable_jan].append(coupon)
+            elif coupon.coupon_type == "combo" and coupon.combo_jans:
+                for jan in coupon.combo_jans:
+                    self.by_jan[jan].append(coupon)
+            else:
+                self.basket_wide.append(coupon)
+
+    def __len__(self):
+        return len(self.by_code) + (len(self.parent) if self.parent is not None else 0)
+
+    @property
+    def refreshed(self):
+        """
+        この索引までにDBから読み直したコードの集合
+        """
+        if self.parent is None:
+            return self.loaded
+        return self.loaded | self.parent.refreshed
+
+    def find(self, code):
+        if code in self.loaded or self.parent is None:
+            return self.by_code.get(code)
+        return self.parent.find(code)
+
+    def get(self, code, now=None):
+        """
+        有効期限内のクーポンを返す (存在しない・期限切れの場合はNone)
+        """
+        coupon = self.find(code)
+        if coupon is None or coupon.expiration_date < (now or timezone.now()):
+            return None
+        return coupon
+
+    def including(self, codes):
+        """
+        指定したコードのクーポンをDBから読み直し、この索引に重ねた索引を返す
+        コンパイル済みの索引は他のワーカーでの追加・変更・削除を反映していないことがあるため、
+        レジで指定されたクーポンは必ずDBの内容で判定する (削除されたクーポンはこの索引にあっても無効になる)
+        この索引はコピーしないため、索引の大きさによらず読み込んだクーポンの分だけのコストで済む
+        """
+        missing = set(codes) - self.refreshed
+        if not missing:
+            return self
+        coupons = (
+            Coupon.objects.filter(code__in=missing)
+            .select_related("applicable_product_jan")
+            .prefetch_related("combo_product_jans")
+        )
+        return CouponIndex((CompiledCoupon.from_model(coupon) for coupon in coupons), parent=self, loaded=missing)
+
+    def candidates(self, quantities, now=None):
+        """
+        購入内容に含まれるJANから、適用できる可能性のあるクーポンを返す
+        """
+        now = now or timezone.now()
+        found = {}
+        if self.parent is not None:
+            found = {
+                coupon.code: coupon
+                for coupon in self.parent.candidates(quantities, now)
+                if coupon.code not in self.loaded
+            }
+        for jan in quantities:
+            for coupon in self.by_jan.get(jan, ()):
+                found[coupon.code] = coupon
+        for coupon in self.basket_wide:
+            found[coupon.code] = coupon
+        return [coupon for coupon in found.values() if coupon.expiration_date >= now]
+
+    def evaluate(self, amount, quantities, codes=None, now=None):
+        """
+        小計と {JAN: 点数} の購入内容に対して複数のクーポンを1回で判定する
+        codesを省略した場合は購入内容に適用できる全てのクーポンを判定する
+        割引率のクーポンは他の割引を差し引いた後の小計に適用し、割引の合計は小計を超えない
+        """
+        now = now or timezone.now()
+        result = CouponResult()
+        if codes is None:
+            coupons = self.candidates(quantities, now)
+        else:
+            coupons = []
+            for code in dict.fromkeys(codes):
+                coupon = self.get(code, now)
+                if coupon is None:
+                    result.invalid_codes.append(code)
+                else:
+                    coupons.append(coupon)
+
+        coupons.sort(key=lambda coupon: coupon.coupon_type == "percent")
+        remaining = amount
+        for coupon in coupons:
+            discount = min(coupon.discount(remaining, quantities), remaining)
+            if not discount:
+                continue
+            result.discounts[coupon.code] = discount
+            result.total += discount
+            if coupon.coupon_type in PROPORTIONAL_COUPON_TYPES:
+                result.proportional += discount
+            remaining -= discount
+        return result
+
+
+class CouponIndexCache:
+    """
+    ワーカープロセス内でコンパイル済みの索引を保持する
+    有効期間 (TTL) が過ぎた索引や変更で破棄された索引は、バックグラウンドのスレッドでコンパイルし直し、
+    コンパイルが終わるまでは現在の索引を使う (コンパイルを待つのはプロセスで最初の取得だけ)
+    レジで指定されたクーポンコードは including() でDBから読み直すため、他のワーカーでの追加・変更・削除もすぐに判定できる
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._index = None
+        self._expires_at = 0
+        # 破棄のたびに増やす世代 (コンパイル中に破棄された場合にもう一度コンパイルするために使う)
+        self._generation = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._index is None:
+                self._index = compile_coupons()
+                self._expires_at = time.monotonic() + self.ttl
+            elif self._expires_at <= time.monotonic() and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._refresh, args=(self._generation,), daemon=True).start()
+            return self._index
+
+    def _refresh(self, generation):
+        index = None
+        try:
+            index = compile_coupons()
+        finally:
+            # バックグラウンドのスレッドのDB接続を閉じる
+            connection.close()
+            with self._lock:
+                if index is not None:
+                    self._index = index
+                # コンパイル中に破棄された場合は、次の取得でもう一度コンパイルする
+                self._expires_at = time.monotonic() + self.ttl if generation == self._generation else 0
+                self._refreshing = False
+
+    def invalidate(self):
+        """
+        次の取得時にコンパイルし直す (コンパイルが終わるまでは現在の索引を使う)
+        """
+        with self._lock:
+            self._expires_at = 0
+            self._generation += 1
+
+
+def compile_coupons(now=None):
+    """
+    有効期限内のクーポンを2回のクエリで読み込み、索引を作成する
+    """
+    coupons = (
+        Coupon.objects.filter(expiration_date__gte=now or timezone.now())
+        .select_related("applicable_product_jan")
+        .prefetch_related("combo_product_jans")
+    )
+    return CouponIndex(CompiledCoupon.from_model(coupon) for coupon in coupons)
+
+
+coupon_index = CouponIndexCache(ttl=getattr(settings, "COUPON_INDEX_TTL", 60))
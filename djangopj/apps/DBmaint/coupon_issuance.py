@@ -0,0 +1,128 @@
+import random
+import re
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import Substr
+from apps.user.models import generate_ulid
+from .catalog_changes import record_catalog_changes
+from .coupon_engine import coupon_index
+from .models import COUPON_TYPE_CODES, Coupon, calculate_check_digit
+
+COUPON_CODE_PREFIX = "28"
+# クーポン種別ごとの識別子 (6桁) の空間
+COUPON_CODE_SPACE = 10**6
+
+_random = random.SystemRandom()
+
+
+class CouponCodeSpaceExhausted(Exception):
+    pass
+
+
+def coupon_code_prefix(coupon_type):
+    return COUPON_CODE_PREFIX + COUPON_TYPE_CODES.get(coupon_type, "00")
+
+
+def build_coupon_code(prefix, identifier):
+    partial_code = f"{prefix}{identifier:06d}"
+    return partial_code + str(calculate_check_digit(partial_code))
+
+
+def used_identifiers(prefix):
+    """
+    指定したプレフィックスで使用済みの識別子の集合を返す
+    手入力などで「プレフィックス + 識別子(6桁) + チェックディジット」の形式でないコードは、発行するコードと衝突しないため除く
+    """
+    pattern = re.compile(rf"{re.escape(prefix)}([0-9]{{6}})[0-9]")
+    codes = Coupon.objects.filter(code__startswith=prefix).values_list("code", flat=True)
+    identifiers = set()
+    for code in codes.iterator(chunk_size=20000):
+        match = pattern.fullmatch(code)
+        if match and build_coupon_code(prefix, int(match[1])) == code:
+            identifiers.add(int(match[1]))
+    return identifiers
+
+
+def draw_identifiers(count, used):
+    """
+    使用済みを除いた識別子をcount件ランダムに選ぶ
+    空きが多い間は棄却サンプリングを、空きが少なくなったら空き一覧からの抽出を使う
+    """
+    free = COUPON_CODE_SPACE - len(used)
+    if count > free:
+        raise CouponCodeSpaceExhausted(f"クーポンコードの空きが不足しています (空き {free} 件 / 要求 {count} 件)")
+    if free > COUPON_CODE_SPACE // 2:
+        drawn = set()
+        while len(drawn) < count:
+            identifier = _random.randrange(COUPON_CODE_SPACE)
+            if identifier not in used:
+                drawn.add(identifier)
+        return list(drawn)
+    return _random.sample([i for i in range(COUPON_CODE_SPACE) if i not in used], count)
+
+
+def issue_coupons(coupon_type, count, batch_size=10000, max_attempts=5, combo_products=(), **attrs):
+    """
+    クーポンをcount件まとめて発行し、発行したクーポンコードのリストを返す
+    バッチごとにbulk insertし、他の発行処理と衝突したコードは衝突した件数分だけまとめて採番し直す
+    attrs には expiration_date, discount_value などCouponのフィールドを指定する
+    """
+    prefix = coupon_code_prefix(coupon_type)
+    used = used_identifiers(prefix)
+    combo_products = list(combo_products)
+    issued = []
+
+    while len(issued) < count:
+        remaining = min(batch_size, count - len(issued))
+        batch_id = generate_ulid()
+        inserted = []
+        for _ in range(max_attempts):
+            identifiers = draw_identifiers(remaining, used)
+            used.update(identifiers)
+            codes = [build_coupon_code(prefix, identifier) for identifier in identifiers]
+            with transaction.atomic():
+                Coupon.objects.bulk_create(
+                    [Coupon(code=code, coupon_type=coupon_type, issue_batch=batch_id, **attrs) for code in codes],
+                    ignore_conflicts=True,
+                )
+                # このバッチで挿入できた行だけを確認し、衝突分は次の試行で採番し直す
+                created = list(
+                    Coupon.objects.filter(code__in=codes, issue_batch=batch_id).values_list("code", flat=True)
+                )
+                if combo_products:
+                    Through = Coupon.combo_product_jans.through
+                    Through.objects.bulk_create(
+                        [Through(coupon_id=code, product_id=product.pk) for code in created for product in combo_products]
+                    )
+                record_catalog_changes("coupon", created)
+            inserted.extend(created)
+            remaining -= len(created)
+            if not remaining:
+                break
+        else:
+            raise CouponCodeSpaceExhausted(f"{max_attempts}回の試行でクーポンコードを採番できませんでした")
+        issued.extend(inserted)
+
+    coupon_index.invalidate()
+    return issued
+
+
+def coupon_code_utilisation():
+    """
+    クーポン種別ごとの発行済み件数と、コード空間の使用率を返す
+    """
+    counts = dict(
+        Coupon.objects.filter(code__startswith=COUPON_CODE_PREFIX)
+        .annotate(type_code=Substr("code", len(COUPON_CODE_PREFIX) + 1, 2))
+        .values("type_code")
+        .annotate(issued=Count("code"))
+        .values_list("type_code", "issued")
+    )
+    return {
+        coupon_type: {
+            "issued": counts.get(type_code, 0),
+            "capacity": COUPON_CODE_SPACE,
+            "utilisation": counts.get(type_code, 0) / COUPON_CODE_SPACE,
+        }
+        for coupon_type, type_code in COUPON_TYPE_CODES.items()
+    }
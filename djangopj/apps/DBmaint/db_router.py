@@ -0,0 +1,143 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+# read_from_replica() のブロック内かどうか (スレッド・非同期タスクごと)
+_replica_reads = contextvars.ContextVar("replica_reads", default=False)
+
+
+class ReplicaLagMonitor:
+    """
+    レプリカの遅延を一定間隔で確認し、遅延が閾値以内かどうかを返す
+    確認結果はワーカープロセス内でcheck_interval秒間使い回す
+    レプリカに接続できない場合も閾値を超えたものとして扱い、次の確認までの間隔を倍々に延ばす (最大retry_max_interval秒)
+    確認は1つのスレッドだけが行い、確認中の他のスレッドは前回の結果を使う (接続のタイムアウトを待たない)
+    """
+
+    def __init__(self, max_lag, check_interval, retry_max_interval):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_max_interval = retry_max_interval
+        # {エイリアス: (使えるかどうか, 次に確認する時刻, 連続して接続できなかった回数)}
+        self._available = {}
+        self._checking = set()
+        self._lock = threading.Lock()
+
+    def available(self, alias):
+        with self._lock:
+            available, next_check_at, failures = self._available.get(alias, (False, None, 0))
+            if alias in self._checking or (next_check_at is not None and time.monotonic() < next_check_at):
+                return available
+            self._checking.add(alias)
+
+        lag = None
+        try:
+            lag = self.lag(alias)
+        finally:
+            if lag is None:
+                failures += 1
+                interval = min(self.check_interval * 2 ** failures, self.retry_max_interval)
+            else:
+                failures = 0
+                interval = self.check_interval
+            available = lag is not None and lag <= self.max_lag
+            with self._lock:
+                self._available[alias] = (available, time.monotonic() + interval, failures)
+                self._checking.discard(alias)
+        return available
+
+    def reset(self):
+        with self._lock:
+            self._available.clear()
+
+    def lag(self, alias):
+        """
+        レプリカの遅延(秒)を返す (接続できない場合はNone)
+        プライマリの現在のWALの位置まで適用済みの場合は0とする
+        WALの受信が止まっている場合 (受信と適用の位置が一致していても) は、最後に適用した更新からの経過時間を遅延とする
+        """
+        connection = connections[alias]
+        if connection.vendor != "postgresql":
+            return 0
+        with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+            cursor.execute("SELECT pg_current_wal_lsn()::text")
+            primary_lsn = cursor.fetchone()[0]
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() OR pg_last_wal_replay_lsn() >= %s::pg_lsn THEN 0
+                        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                    END
+                    """,
+                    [primary_lsn],
+                )
+                lag = cursor.fetchone()[0]
+        except DatabaseError:
+            connection.close()
+            return None
+        # まだ何も適用していないレプリカは使わない
+        return float("inf") if lag is None else float(lag)
+
+
+replica_monitor = ReplicaLagMonitor(
+    max_lag=getattr(settings, "REPLICA_MAX_LAG_SECONDS", 5),
+    check_interval=getattr(settings, "REPLICA_LAG_CHECK_INTERVAL", 1),
+    retry_max_interval=getattr(settings, "REPLICA_RETRY_MAX_INTERVAL", 30),
+)
+
+
+def replica_alias():
+    """
+    読み取りに使うDBのエイリアスを返す
+    レプリカが設定されていない・遅延が閾値を超えている・プライマリでトランザクション中の場合はプライマリを返す
+    """
+    alias = getattr(settings, "REPLICA_DATABASE_ALIAS", "replica")
+    if alias not in settings.DATABASES or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    return alias if replica_monitor.available(alias) else DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def read_from_replica():
+    """
+    ブロック内の読み取りクエリをレプリカで実行する (書き込みは常にプライマリ)
+    書き込み直後に同じデータを読み直す処理 (販売直後のレシート、返品など) では使わないこと
+    querysetはブロック内で評価すること (ブロックの外で評価する場合は .using(replica_alias()) を使う)
+    """
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+class ReplicaRouter:
+    """
+    read_from_replica() のブロック内の読み取りだけをレプリカに振り分けるDBルーター
+    それ以外の読み取りと全ての書き込みはプライマリ (default) で行う
+    """
+
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get():
+            return replica_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはプライマリの複製のため、どちらから読み込んだインスタンスも関連付けられる
+        databases = {DEFAULT_DB_ALIAS, getattr(settings, "REPLICA_DATABASE_ALIAS", "replica")}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == getattr(settings, "REPLICA_DATABASE_ALIAS", "replica"):
+            return False
+        return None
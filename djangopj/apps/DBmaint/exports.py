@@ -0,0 +1,134 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from .db_router import replica_alias
+from .models import SaleProduct, Transaction
+
+# 出力対象ごとの (モデル, 日時フィールド, 店舗フィールド, 出力する列)
+EXPORTS = {
+    "transactions": (
+        Transaction,
+        "sale_date",
+        "storecode",
+        [
+            "id",
+            "sale_id",
+            "sale_type",
+            "sale_date",
+            "storecode",
+            "staffcode",
+            "purchase_points",
+            "coupon_code",
+            "tax_10_percent",
+            "tax_8_percent",
+            "tax_amount",
+            "total_amount",
+            "discount_amount",
+            "deposit",
+            "change",
+        ],
+    ),
+    "saleproducts": (
+        SaleProduct,
+        "transaction__sale_date",
+        "transaction__storecode",
+        [
+            "id",
+            "transaction__sale_id",
+            "transaction__sale_date",
+            "transaction__storecode",
+            "JAN",
+            "name",
+            "price",
+            "tax",
+            "points",
+        ],
+    ),
+}
+
+EXPORT_CHUNK_SIZE = getattr(settings, "EXPORT_CHUNK_SIZE", 2000)
+
+
+def export_rows(kind, queryset=None, since=None, until=None, storecode=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    (列名のリスト, 行のイテレーター) を返す
+    行はid順にchunk_size件ずつ読み込む (PostgreSQLではサーバーサイドカーソルを使う) ため、件数によらずメモリ使用量は一定
+    since・until (日付) は現地日付で両端を含む
+    """
+    model, date_field, store_field, fields = EXPORTS[kind]
+    if queryset is None:
+        queryset = model.objects.all()
+    # 出力はレプリカから読み込む (行はブロックの外で読み込むため、DBを明示する)
+    queryset = queryset.using(replica_alias())
+    # 日時の範囲で絞り込み、日時フィールドのインデックスを使えるようにする
+    if since:
+        queryset = queryset.filter(**{f"{date_field}__gte": timezone.make_aware(datetime.combine(since, time.min))})
+    if until:
+        next_day = datetime.combine(until + timedelta(days=1), time.min)
+        queryset = queryset.filter(**{f"{date_field}__lt": timezone.make_aware(next_day)})
+    if storecode:
+        queryset = queryset.filter(**{store_field: storecode})
+    return fields, queryset.order_by("pk").values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+class Echo:
+    """
+    csv.writerの書き込み結果をそのまま返す疑似ファイル
+    """
+
+    def write(self, value):
+        return value
+
+
+def localize(row):
+    # 日時は現地時刻のISO 8601形式で出力する
+    return [timezone.localtime(value).isoformat() if isinstance(value, datetime) else value for value in row]
+
+
+def render_csv(fields, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow(localize(row))
+
+
+def render_jsonl(fields, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, localize(row))), cls=DjangoJSONEncoder, ensure_ascii=False) + "\n"
+
+
+RENDERERS = {
+    "csv": (render_csv, "text/csv"),
+    "jsonl": (render_jsonl, "application/x-ndjson"),
+}
+
+
+def render_export(fmt, fields, rows, lines_per_chunk=1000):
+    """
+    出力を行単位ではなく、lines_per_chunk行ずつまとめた文字列として返す
+    """
+    renderer, _ = RENDERERS[fmt]
+    buffer = []
+    for line in renderer(fields, rows):
+        buffer.append(line)
+        if len(buffer) >= lines_per_chunk:
+            yield "".join(buffer)
+            buffer = []
+    if buffer:
+        yield "".join(buffer)
+
+
+def streaming_export_response(kind, fmt, **filters):
+    """
+    出力をストリーミングで返すレスポンス
+    """
+    fields, rows = export_rows(kind, **filters)
+    _, content_type = RENDERERS[fmt]
+    response = StreamingHttpResponse(render_export(fmt, fields, rows), content_type=f"{content_type}; charset=utf-8")
+    filename = f"{kind}_{timezone.localtime():%Y%m%d%H%M%S}.{fmt}"
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
@@ -1,6 +1,6 @@
 from django.shortcuts import render
 from .models import Product
-from django.db.models import Sum
+from .stock import product_stock_total
 from django import forms
 
 
@@ -12,6 +12,27 @@ class ItemFilterForm(forms.Form):
     stock_min = forms.IntegerField(required=False, label="最低在庫数", min_value=0)
 
 
+class StockAdjustmentForm(forms.Form):
+    MODES = (
+        ("delta", "在庫数に加算 (マイナスで減算)"),
+        ("set", "在庫数を指定した値に変更"),
+    )
+    mode = forms.ChoiceField(choices=MODES, label="変更方法")
+    value = forms.IntegerField(label="数量")
+    reason = forms.CharField(required=False, max_length=100, label="変更理由")
+
+
+class StockAdjustmentUploadForm(forms.Form):
+    """
+    店番・JAN・数量の3列のCSVファイル (1行目は見出し) で在庫数をまとめて変更する
+    """
+
+    MODES = StockAdjustmentForm.MODES
+    file = forms.FileField(label="CSVファイル (storecode, JAN, quantity)")
+    mode = forms.ChoiceField(choices=MODES, label="変更方法")
+    reason = forms.CharField(required=False, max_length=100, label="変更理由")
+
+
 def filter_items(request):
     form = ItemFilterForm(request.GET)
     products = Product.objects.all()
@@ -34,7 +55,7 @@ def filter_items(request):
         # 在庫数でフィルタリング
         if form.cleaned_data["stock_min"] is not None:
             # 各商品に関連する在庫の合計を計算してフィルタリングする
-            products = products.annotate(total_stock=Sum("stock__quantity")).filter(
+            products = products.annotate(total_stock=product_stock_total()).filter(
                 total_stock__gte=form.cleaned_data["stock_min"]
             )
 
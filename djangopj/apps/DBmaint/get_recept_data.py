@@ -1,43 +1,116 @@
-def generate_receipt_text(transaction):
-    store_name = transaction.storecode.name
-    staff_code = transaction.staffcode.staffcode
-    sale_products = transaction.sale_products.all()
+from functools import partial
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from .models import SaleProduct, Transaction
 
-    receipt = f"""
-{{image:iVBORw0KGgoAAAANSUhEUgAAAKUAAACNCAMAAADhCkqzAAAACXBIWXMAAA7EAAAOxAGVKw4bAAACK1BMVEVHcEwBAQEBAQEBAQEBAQEAAAAAAAAAAAAAAAABAQEAAAAAAAAAAAAAAAAAAAABAQEBAQEAAAAAAAAAAAAAAAAAAAABAQEAAAAAAAAAAAAAAAAAAAAAAAAAAAABAQEAAAAAAAABAQEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABAQEAAAAAAAAAAAAAAAAAAAABAQEAAAABAQEAAAABAQEBAQEAAAAAAAAAAAABAQEAAAABAQEAAAAAAAAAAAAAAAAAAAAAAAABAQEBAQEAAAABAQEBAQEAAAABAQEAAAAAAAAAAAABAQEAAAABAQEBAQEBAQEAAAAAAAAAAAACAgIBAQEDAwMBAQEAAAABAQEAAAABAQEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABAQEBAQEAAAABAQEDAwMBAQEAAAAAAAAAAAAAAAABAQEAAAAAAAAAAAAAAAABAQEAAAABAQEAAAAAAAABAQEDAwMAAAABAQEBAQEBAQEDAwMAAAADAwMAAAAAAAABAQEBAQEBAQEAAAABAQEBAQEBAQEAAAADAwMBAQEDAwMFBQUBAQEBAQEAAAABAQEAAAABAQEBAQEAAAABAQEBAQEBAQEAAAABAQEBAQEAAAAAAAADAwMFBQUBAQEBAQEAAAAAAAABAQEBAQEDAwMDAwMAAAAAAAADAwMDAwMBAQEHBwcDAwMFBQUDAwMODg4BAwAAAAABAQEDAwPoPZ1IAAAAtXRSTlMA/QwWBgj7Av0E9/X5Cu0SEOnx59nF++HzFFLb69FCJsde3e+3LkSnr5/fv/PPy0bjeHSJIg5QPI2jlySRSKsgZCyDOD5gVhoqoTTlZo/BWptKWBjXMkD5ILmFerUogRww0zpu1ckcYjalCsNUHnaxlamLcE7xfmpyvbsCmQ7j0w58CFyVh4+TnWzN34cYrTIC69fDbrtMnc1+drOtme+zTEYQXMm5k2jl3VxsaB42GAJkBtUGoD8F/wAAEDBJREFUGBnNwQOXJFubBtAnGRGpsm3bbNu2bbv7tq9tG5856zn35805b0RmZXX3zDdTnbVW7o3/jeXPDSHLOZv2FiTqxweRzR6csmkUVCN7+XfRsyaAbPX+OBU9o8hWm8JMKbmH7OTc5wzfdmSnOkUtr/oUjZvISs7PNN7ANhrrkJWWhBXJRADxBmobkZVGaXwNOPXUxpCNThfSWAZYW6m9jmy03aZmTwBWIbVJZKPXFLV2C3Daqe1GFgoV0vgaQLCS2hFkoRqbmvoSwDkfSV81stBCGmoKwBJqkQkA5+r27z8xgexxioZ9DsBaaiVx+NeVUotMxpElnBIaBX4A49RuIbSLnovIEgtsGkUWgG5qe7CWSZUBZIcpimkAgU6S9mF0KHrsRcgOeyh2AximVhl3CpkUm0B2uETxTwC/UvsaOKPoqTiNrGBtpSgH4oXUNgN9ip5+ZIecb2nYS4AlYZL5OUBuF4XdFkJ2aIrRKD0OPKXWagHIXXwokV9w+yyyRbWPRl4OQh9S+wnCydniR/ZYpmi0x7HUR7KgDNloQNHosLCR2mvIQvFzv1BMIzdBMrYaHifo4AUcf1kIz7GCDmZYQQsvErxX5uCFrKA/ZOHF/OWnSjrpasNakqrIgTj5WVV71es5mC2wsOXomsSH1ZjF+mHs84qqj+Fyqje+WVG75zSeUXOzsaKgsmgnnuMsvXymYk1792flcTyn7OErNlN+tbpJqmUQZ6M0FiPdiskGilpYloUk6+0wtcIgjJO1NjXV6iDd6q8iFK/CsiykufNpV5guu36Dg1mcPxUw3fWlYZKv+GE49TRUC2Y4b3xAT/hCV2HVZACuH8I0iqAF9+ygUOHVmJE7uYOegl2HKo7td5CUO6Y4w141hDSnN9pKMc3CFkWyD2JBmOIbpPy4ylaKHqVItkFYFyguAgg+sZWioVQdUiZqFZOUIqmWwhOoVZzlqxBScj/hM/aXkkwEILbbFPuRVPYRn1UEkZNHsQFwxm2mLETSvhIKRSoKVQfX0HrFZwwg6cFtPmsNtUm4llGoZfAMrafHTtTmUbRCVCsakQVAP9OchaemRNFV/FYthboKYV2k4mwqshoup42e8CeLOSO/Bq7rdFXDZb1Oz9bHPwaPUkxCDFActdAc4wz7MFy5n9NlN44Et9G1CKLZpiv/o08q6blwB6LOpqu+3NnOFPUaPKsofBNw1dl0rSoDjndSLIRhFVHcRVkF03Seg7DGFUXspgMspIg8gBEsolCtg8CK75SiUVoDIyePrqpzQA9T8gfh6aBoyIV4J4+ujUEAzYqGPQIjnlA06nBRMU1JCKK6mCK8DNoTigoHRrOPouMRtKHPKdTHMAYUDZU3CGATU9bB42yl+DAIcZdCrQ9B66PIfwfGShrKV7M6SipVOKZoqF0Qj96kUG9b0Ioo9kK0UES2QSynUBegvfMBhe9TaFeZlH8AnqFKikaIndcorq2EcYniqAVjA0Xeo1ZqXX/P/ZZiN0S5oqiKQwvlUYzCyC1QNBr/AVGWoCgMAbhJV+sdaJuYtBtJC6IUv0I8pWsARrCQogViPw11ZkmYZMNBBCIU5TCsDro2wVhZTLEMxohNcQMu602KxD3AqqWIbYPRTE9JDpJWhyluwDhdQdGwAMaKGMV5iI0UbZeUUr/3A6spihfA2BemOGTBWE7XSRg3KOwReHZRRMuAwSjFRw6MEbrstUgZpqsHxhIfxdcQPXRNQdym2BhRZNdpYAPFHxwYNxXFEYjdikZpAMYTisggPO9SRMuAzXR9DNEUpjgWR8pfKCITMPZQqD9B9FHYxyE+pFhDUl0FMEDRCtFIEZ6AaKQoDMFoocjfAs9eGiqRCyymKF4NsSWfohwpf/sjRUEujGmKHQsgpinyLBhWL1O6HQC3FY09MIIlFFtDMEL1FHsh9lI0lMFTREPVh4BWitIDEP5eih4k7cujq8uC5hylyHNgWO0UxyCcAqaUA7DyKL6HsTNKcQFiZ5RiHYzTxyhKt8AVbKdYb8H6iKIyF8I5RlEHz9/vK0VDTUMLtPkouiAWFFO0QBzoZFJhHMABm4Y9AWNRmGIdRDldJ6A11SqKSA1cg1EaahJwuineCkHEqyjWwZVTxKTFAKoL6emAOEHXZRhDHUzZD62ZosEPY5NNsRjiGwp7KeBcyWfS93Ato6sccI5RJHJgWAN01Towcm8xSf0Jobd3MGk9DGc9heqD5m9lSnQftCsUJUFoi0roWgyjrICi8ziOX1BMGYcIdVPkBQB8QlG8DcbjMF2x1dACHUrRY59cWUSl6PmjA224mK6HAIZaOWOXBe1VioIQgPd66RmDsV/RUCXx5hKlmJK/EsYNm+IutCd0Td4B8H0pkzpyEBou5IxoXyXT+JoB1JTQ83Pceq+baY7AOEVhTyG0toFJBQcAVEfpOvYwQk0x6dBKwDkRpYgugraBrvDF6p7XIkz5fU3HW7ZSnOFjOrXmxMG6EnoUK7ojTLNjH4xVdHWeecvHGV3D7/Xl0xO2KYqLFIWKNp6qKqbrCYxAAV2KrrwIZ7OZLnHX5iwxvsghC8Y6/p/Vb4pv5XMKf4QYVYppKrf9qhRTlKr9ijPsxppQlVJMUYmFPs5Q9KyDqONsYcUXK14VAJqLlWIapT5YAlfOVqbJ70GghGku5X7ClMTaIDAV4wzfcmcvZxzdTVcPxJYY04RHryum2FGmvHL1DrQ+zvZtD5IW9TKlshnA9lJ6VGxx0Kn4nYai75dBaNZ1m4pCxY4AgwWKLnvvli2l1FRJCK5RJinmLbdCu5SiULz7b3rsSysgnPMxxSTF++9hRs0tH4X98yIYPW9RhIuWAv5OCpV4w4GwbnbSVXEV2uo/UlReCQIDiqTvBjzxaZuu0s+OAxhqi1FEnwYSdPVusJDU0+WjJ2/3A6QLLZ8+miitbxkOwRXoK8pLVIz1BIH/WkzX+pVIWTTaVZm/puNKDkRg4FB+Xu31A9BO727PL/zSQVJwc2NvfmXF3vMTENbhVRUN+YXfvJczTWGfOoA08U9fr8rLz6uYXhjAc4JDOSGkcfz3QtBy3rUpakNI59zL9VtICeb6HXjiuSGks+I590JIE8rNDWHRIbq+sPCMoD/XH8L/Q9NRekaRUeUf0LMNL2vTB/SoDcigf+yJ0JM/hJdjvRFlkm8lMid00WZSt4WXEhwNM+UVPzLmwbucMY6X8mhMccZ3yJgVRUyzAS8j1EIjXEhxHpnyzpuKWkMVjR01eAnBMRqxG5do2CPIkLJukkrlVRfR2PoIc+c8UdSiw8EKGgW5yIyhDkWtfl9OA402vIQvbGrRckxEaLQiM4KXSCq+MoEem8ZmzN1UmNqOx8BjRWMtMuNLH0n1QRMwQKP0HOZsRS81ux9AG43IIDLiZIRaaTVwp5vGR5gzaxWNsfeBeAU1VYuM8H9Ozb4CoCZKTfVjzqpj1OpzAJy0qakryIg3aHwXBHCExo4JzJWzi5paDm03jR07kQk5JdQiNQCsDhq1mLOTPkWyyAEQrKfRaCETflMk1WvQamI01mLOJmn8BK2ZYjkywSqiFlkJ7W0a17Zgrqx6ag0roH2lSKVKHiATDsSo/ewAyEnQ2Ig5+6uPWpcFYCSmqD1ERgzTeB3a4t+pxQ5izpbSWA/A300j7+/IiD4aowCaSmm0WpizYRrtcbz/KsViZMZuGo0WfqylETmMuaumYbeVt9g0SnKRGX00YnseH6NYZWHu/lrMNKq4HBlSznTqlQBeRjfTrbPw0oIrFhzwI5DPNLFNeCnlPkWPYkscOb9duv3VVRj+qX/2nzho4Tk5S3/r61+4xI8XeNRfdS1a2l6OASYpFf6zhZdijfrosSfjqO5VSrEhAJQ9LfApxeKik5jF2j79rU8pRTvv7gI8y3mXVCRHcXoXkzoXWnhJ1htraNhV5UBOAUU1DtfTE9mANCtabKbk33Aw23Kbhj0FxAfyaUQ+OYgMKFu+bqxt//YQgE00lNqwPcGU6FKkrC5UTOO77CBd8IyicdQPbedf7rZsvNJkIcM207UxwTTdIXiaejmb/RDpDocp/oL5dJYpSpGKwv4errJ2Pis8ghnWNA2VCGA+DXNGZWOXj65pCKuFSWEmrbeQsi9KQ/2CeXWVSar1OIJf2hTtIRjNMbpae5oeF9JVPIKUV+l6gnn1KT1qLAQgeIjCtwKa8xGF3ecAKNtK1zdIKrumKBoxrzbRc/tfMMboqoG2OkZxwYGxPUxREYTnOj2lNZhPU3T1HoB4m66D0J5SFB+GCFZRRHfCFShgUmsQ86iHrn642uhaAMD5nOLfDlzjFPZSuL5gin0E86iHroVw7aWIBQDkRBSNjfAcoascYmdCMWXHdsyfZptiGcSdKoqEH8B7iqIfnhN0bYbx/iqmK1mBedNsU9RBDEYpblkAztL1GJ4TdA3DmApTqyyk510H86XZpvgJYhld16EtpKscniN0NUPb8gcafSsr6QrXYb6cpesnGNa7FPYItCN0DcNzmSIyASC4l8bWXFyN0bVmC+ZH6Axdm2EcjFLcj0NbS1cdPBcoCnIB66FNrXgYeP8uPYsxP5b56NoMzTpF18cwhum6Dpe/l+IWgE0RGi0OgEAvXfUO5kNOOz2boZ0NUxQEoA3dousXuH6g6yZQU0CjPQDjS7rsBZgPbzNpOYCVCbr+DC1wi57oIhjBMxSd53CvW1Hr3A4xGKHrb5gH5zqZVA7UbKWrOwTgcBVTbg0BcC7TNQ1rjEZ4IVxWO13bMA/GFZOmnLO99OzafLhuOsY0Xcv3/fCdTRFZhJEwNTVg4cH59YX3b3/TS2GvQObtiyomnTqm6FGKpOIsSqNrAPhNkVQXHZTdpyKVoqveQcb9YxX/k0SYzyryA1M2yXEHWMc0ipPIvINR/gcfLlqnOFvhTgDBFt+13UEAHzKNiixC5r1OrZ3/I3vXO3BWcZbaBTCsgB9GIdOoyxYybuc1kokvOENF2/pLFT2JviCA4P5OJqnOV/2YZVwpepQ640fmPaXWdoNJ9luTTRYOn7FpvDI5CNfBsQaKgvEmPOP4H5jSUYbMG6okGV7aT1H68J/b4jCcprV7bm5u8mNGztK1e84vO3kPz2uqolLUShfHMQ/WUqtynlJ0OZibR8vbiu6/+fXHWzAfrCJq57GRYr2FbLQtRjI2iEsUF5CVRqkVAXspLiIbxQupHQE6KPqRjUZ8igwPwuqioeqQjS5T63LgX0PDHkEW+tchagNAoIFG6XFkoX3F1KaAnVEavX5koTqSquEd4G/FNDqQjdpIqvXvA2cpPkM2qqd2EcDHisYJZCF/MbU6AK8pauEmZKFt1OwRAI008kLIQhuodR4HgoeoqUZkoz9T+zYXCORTU/3IRl9Qq4wDS2xqvpXIRuPUKuPAeRpHHWSjz6g15OLObRqXkZVeVSR3HMRfI9TCS5CVriiSatQZp3EsiKz0qaJmr6Hh24DslBPhjDdDyFKtTIktRbZaEqNL+fqRtaw9YYroeQvZy9lcZZPXGpdYyGqhpqklZRaywX8DLtm9oXXuPG8AAAAASUVORK5CYII=}}
+# ロゴ画像はレシートサービスが起動時に読み込み、この行を画像に置き換える
+LOGO_PLACEHOLDER = "{image:logo}"
 
-|{transaction.storecode}:{store_name}
+# レシートのレイアウト (モジュールの読み込み時に1回だけ組み立てる)
+RECEIPT_HEADER = partial(
+    """
+{logo}
 
-|{transaction.sale_date.strftime('%Y-%m-%d %H:%M')}
+|{storecode}:{store_name}
+
+|{sale_date}
 |担当No.{staff_code}
-|取引ID:{transaction.sale_id}
+|取引ID:{sale_id}
 {{border:none}}
 {{border:line; width:22}}
 ^領 収 書
 {{border:space; width:3,*,3,8; text:nowrap}}
-"""
+""".format,
+    logo=LOGO_PLACEHOLDER,
+)
 
-    for product in sale_products:
-        jan_last_3_digits = product.JAN.JAN[-3:]
-        is_reduced_tax = "*" if product.tax == 8 else "~"
-        receipt += f"{jan_last_3_digits} |{product.name} | ×{product.points} | ¥{product.price:,}{is_reduced_tax}\n"
+RECEIPT_LINE = "{jan_last_3_digits} |{name} | ×{points} | ¥{price:,}{is_reduced_tax}\n".format
 
-    receipt += f"""-
+RECEIPT_FOOTER = """-
 {{width:*,20}}
-|^合計 | ^¥{transaction.total_amount:,}
+|^合計 | ^¥{total_amount:,}
 {{width:auto}}
-| (10％税額 | ¥{transaction.tax_10_percent:,})
-| ( 8％税額 | ¥{transaction.tax_8_percent:,})
-| (合計消費税 | ¥{transaction.tax_amount:,})
-|点数 | {transaction.purchase_points}点
+| (10％税額 | ¥{tax_10_percent:,})
+| ( 8％税額 | ¥{tax_8_percent:,})
+| (合計消費税 | ¥{tax_amount:,})
+|点数 | {purchase_points}点
 
 |^お支払い
-|現金 | ¥{transaction.deposit:,}
-|^釣銭 | ¥{transaction.change:,}
+|現金 | ¥{deposit:,}
+|^釣銭 | ¥{change:,}
 {{width: *}}
 |「*」は軽減税率対象商品です。
 -
 
-{{code:{transaction.sale_id}; option:code128,3,48,nohri}}
-"""
-    return receipt
+{{code:{sale_id}; option:code128,3,48,nohri}}
+""".format
+
+
+def load_receipt_transaction(sale_id):
+    """
+    取引・店舗・販売商品を1回のクエリで取得し、(取引, 販売商品のリスト) を返す
+    """
+    sale_products = list(
+        SaleProduct.objects.select_related("transaction__storecode")
+        .filter(transaction__sale_id=sale_id)
+        .order_by("id")
+    )
+    if sale_products:
+        return sale_products[0].transaction, sale_products
+    return get_object_or_404(Transaction.objects.select_related("storecode"), sale_id=sale_id), []
+
+
+async def aload_receipt_transaction(sale_id):
+    """
+    load_receipt_transactionの非同期版
+    """
+    sale_products = [
+        sale_product
+        async for sale_product in SaleProduct.objects.select_related("transaction__storecode")
+        .filter(transaction__sale_id=sale_id)
+        .order_by("id")
+    ]
+    if sale_products:
+        return sale_products[0].transaction, sale_products
+    try:
+        return await Transaction.objects.select_related("storecode").aget(sale_id=sale_id), []
+    except Transaction.DoesNotExist:
+        raise Http404("No Transaction matches the given query.")
+
+
+def generate_receipt_text(transaction, sale_products=None):
+    if sale_products is None:
+        sale_products = transaction.sale_products.all()
+
+    parts = [
+        RECEIPT_HEADER(
+            storecode=transaction.storecode_id,
+            store_name=transaction.storecode.name if transaction.storecode else "",
+            sale_date=transaction.sale_date.strftime("%Y-%m-%d %H:%M"),
+            staff_code=transaction.staffcode_id,
+            sale_id=transaction.sale_id,
+        )
+    ]
+    for product in sale_products:
+        parts.append(
+            RECEIPT_LINE(
+                jan_last_3_digits=product.JAN_id[-3:],
+                name=product.name,
+                points=product.points,
+                price=product.price,
+                is_reduced_tax="*" if product.tax == 8 else "~",
+            )
+        )
+    parts.append(
+        RECEIPT_FOOTER(
+            total_amount=transaction.total_amount,
+            tax_10_percent=transaction.tax_10_percent,
+            tax_8_percent=transaction.tax_8_percent,
+            tax_amount=transaction.tax_amount,
+            purchase_points=transaction.purchase_points,
+            deposit=transaction.deposit,
+            change=transaction.change,
+            sale_id=transaction.sale_id,
+        )
+    )
+    return "".join(parts)
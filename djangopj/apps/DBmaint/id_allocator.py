@@ -0,0 +1,88 @@
+import re
+import threading
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, connections, transaction
+from django.db.models import F
+from sqids import Sqids
+from .models import IdSequence
+
+# 取引IDのエンコーダーはプロセス内で1つを使い回す
+SQIDS = Sqids(min_length=10, alphabet="ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789")
+
+
+class IdAllocator:
+    """
+    店舗ごとの単調増加する連番と日付を組み合わせて、重複しない取引IDを採番する
+    PostgreSQLでは店舗ごとのシーケンスからまとめて連番を取得し、プロセス内で順に払い出す
+    シーケンスの払い出しはトランザクションに依存しないため、行ロックの競合や
+    ロールバックによる再利用が起きず、一意制約違反に頼らずに一意性を保証できる
+    """
+
+    def __init__(self, kind, block_size, tag=None):
+        self.kind = kind
+        self.block_size = block_size
+        # 同じ店番・連番でも種別ごとに異なるIDになるよう末尾に付与する値
+        self.tag = tag
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def sequence_name(self, storecode):
+        storecode = str(storecode)
+        if not re.fullmatch(r"\w+", storecode):
+            raise ValueError(f"シーケンス名に使用できない店番です: {storecode}")
+        return f"{self.kind}_id_seq_{storecode}"
+
+    def next_value(self, storecode):
+        with self._lock:
+            block = self._blocks.get(storecode)
+            if not block:
+                block = self._blocks[storecode] = self._allocate_block(storecode)
+            return block.pop()
+
+    def allocate(self, storecode, current_time):
+        """
+        [日付(YYMMDD), 店番, 連番(, 種別)] をエンコードした取引IDを返す
+        旧形式のID ([秒以下4桁, 店番, スタッフコード]) とは先頭の値の範囲が異なるため衝突しない
+        """
+        day = int(current_time.strftime("%y%m%d"))
+        values = [day, int(storecode), self.next_value(storecode)]
+        if self.tag is not None:
+            values.append(self.tag)
+        return SQIDS.encode(values)
+
+    def _allocate_block(self, storecode):
+        name = self.sequence_name(storecode)
+        if connection.vendor != "postgresql":
+            # シーケンスがないDBでは採番テーブルを使い、ロールバックに備えて1件ずつ採番する
+            with transaction.atomic():
+                IdSequence.objects.get_or_create(name=name)
+                IdSequence.objects.filter(name=name).update(last_value=F("last_value") + 1)
+                return [IdSequence.objects.get(name=name).last_value]
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s) IS NULL", [name])
+            if cursor.fetchone()[0]:
+                self._create_sequence(name)
+            cursor.execute("SELECT nextval(%s) FROM generate_series(1, %s)", [name, self.block_size])
+            # pop()で小さい値から払い出すため降順に並べる
+            return sorted((row[0] for row in cursor.fetchall()), reverse=True)
+
+    def _create_sequence(self, name):
+        """
+        販売のトランザクションとは別の (自動コミットの) 接続でシーケンスを作成する
+        トランザクション内で作成すると、ロールバックでシーケンスが消えるうえ、
+        新しい店舗の最初の販売が同時に行われた場合にシステムカタログの一意制約違反になるため
+        """
+        other = connections.create_connection(DEFAULT_DB_ALIAS)
+        try:
+            with other.cursor() as cursor:
+                cursor.execute(f'CREATE SEQUENCE IF NOT EXISTS "{name}" AS bigint')
+        except IntegrityError:
+            # 他の接続が同時に作成した場合は、IF NOT EXISTSでも一意制約違反になることがある
+            pass
+        finally:
+            other.close()
+
+
+sale_id_allocator = IdAllocator("sale", getattr(settings, "TRANSACTION_ID_BLOCK_SIZE", 100))
+return_id_allocator = IdAllocator("return", getattr(settings, "TRANSACTION_ID_BLOCK_SIZE", 100), tag=2)
@@ -0,0 +1,59 @@
+import asyncio
+import statistics
+import time
+import httpx
+from django.core.management.base import BaseCommand, CommandError
+from apps.DBmaint.models import Product
+
+
+class Command(BaseCommand):
+    help = "レジのスキャン (JANコードによる商品検索) を並行して行い、同期版 (WSGI) と非同期版 (ASGI) のAPIのスループットを比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sync-url", default="http://app:8000/api/items/", help="同期版の商品APIのURL")
+        parser.add_argument("--async-url", default="http://app-async:8001/api/async/items/", help="非同期版の商品APIのURL")
+        parser.add_argument("--api-key", required=True, help="リクエストに付けるAPIキー")
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 100], help="並行するリクエスト数")
+        parser.add_argument("--requests", type=int, default=2000, help="並行数ごとのリクエスト数")
+
+    def handle(self, *args, **options):
+        jan_codes = list(Product.objects.order_by("?").values_list("JAN", flat=True)[:1000])
+        if not jan_codes:
+            raise CommandError("計測に使う商品が登録されていません。")
+
+        for label, url in (("sync", options["sync_url"]), ("async", options["async_url"])):
+            for concurrency in options["concurrency"]:
+                elapsed, latencies, errors = asyncio.run(
+                    self.run(url, options["api_key"], jan_codes, concurrency, options["requests"])
+                )
+                latencies.sort()
+                self.stdout.write(
+                    f"{label:<5} concurrency={concurrency:>4} requests={options['requests']:>6} "
+                    f"throughput={options['requests'] / elapsed:,.0f} req/s "
+                    f"p50={statistics.median(latencies) * 1000:.1f}ms "
+                    f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms errors={errors}"
+                )
+
+    async def run(self, url, api_key, jan_codes, concurrency, total):
+        latencies = []
+        errors = 0
+        counter = iter(range(total))
+        headers = {"X-Api-Key": api_key}
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+        async def register(client):
+            nonlocal errors
+            for i in counter:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url, params={"jan": jan_codes[i % len(jan_codes)]}, headers=headers)
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            start = time.perf_counter()
+            await asyncio.gather(*(register(client) for _ in range(concurrency)))
+            return time.perf_counter() - start, latencies, errors
@@ -0,0 +1,65 @@
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from apps.DBmaint.coupon_engine import CompiledCoupon, CouponIndex
+
+
+class Command(BaseCommand):
+    help = "クーポン数と購入点数を変えながら、クーポンエンジンの判定コストを計測する (DBは使用しない)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--coupons", type=int, nargs="+", default=[100, 1000, 10000, 100000], help="クーポン数")
+        parser.add_argument("--basket-sizes", type=int, nargs="+", default=[5, 30, 100], help="購入商品の種類数")
+        parser.add_argument("--catalog-size", type=int, default=20000, help="商品数")
+        parser.add_argument("--iterations", type=int, default=2000, help="判定の繰り返し回数")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        catalog = [f"49{i:011d}" for i in range(options["catalog_size"])]
+        expiration_date = timezone.now() + timedelta(days=30)
+
+        for coupon_count in options["coupons"]:
+            started = time.perf_counter()
+            index = CouponIndex(self.make_coupon(rng, i, catalog, expiration_date) for i in range(coupon_count))
+            compile_ms = (time.perf_counter() - started) * 1000
+            codes = list(index.by_code)
+
+            for basket_size in options["basket_sizes"]:
+                baskets = [
+                    {jan: rng.randint(1, 5) for jan in rng.sample(catalog, basket_size)}
+                    for _ in range(min(options["iterations"], 200))
+                ]
+                now = timezone.now()
+
+                # 提示された複数のクーポンコードを判定する場合
+                started = time.perf_counter()
+                for i in range(options["iterations"]):
+                    index.evaluate(Decimal("10000"), baskets[i % len(baskets)], rng.sample(codes, 3), now)
+                by_code_us = (time.perf_counter() - started) / options["iterations"] * 1_000_000
+
+                # 購入内容に適用できる全てのクーポンを判定する場合
+                started = time.perf_counter()
+                for i in range(options["iterations"]):
+                    index.evaluate(Decimal("10000"), baskets[i % len(baskets)], None, now)
+                all_us = (time.perf_counter() - started) / options["iterations"] * 1_000_000
+
+                self.stdout.write(
+                    f"coupons={coupon_count:>7} basket={basket_size:>4} compile={compile_ms:8.1f}ms "
+                    f"codes={by_code_us:8.1f}us/basket applicable={all_us:8.1f}us/basket"
+                )
+
+    def make_coupon(self, rng, i, catalog, expiration_date):
+        coupon_type = rng.choice(["product", "combo", "multi", "amount", "percent"])
+        return CompiledCoupon(
+            code=f"28{i:09d}",
+            coupon_type=coupon_type,
+            expiration_date=expiration_date,
+            discount_value=rng.randint(10, 100),
+            discount_percentage=Decimal(rng.randint(1, 20)) if coupon_type == "percent" else None,
+            applicable_jan=rng.choice(catalog) if coupon_type in ("product", "multi") else None,
+            combo_jans=rng.sample(catalog, 2) if coupon_type == "combo" else (),
+            min_quantity=rng.randint(2, 3) if coupon_type == "multi" else 1,
+        )
@@ -0,0 +1,82 @@
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from sqids import Sqids
+from apps.DBmaint.id_allocator import SQIDS, IdAllocator
+from apps.DBmaint.models import IdSequence
+
+
+class Command(BaseCommand):
+    help = "取引IDの採番のマイクロベンチマークと、並行採番時の一意性のストレステストを行う"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--storecode", default="999", help="計測に使う店番 (計測用のシーケンスを作成・削除する)")
+        parser.add_argument("--encodes", type=int, default=20000, help="エンコードの計測回数")
+        parser.add_argument("--threads", type=int, default=8, help="並行して採番するスレッド数")
+        parser.add_argument("--ids", type=int, default=2000, help="スレッドあたりの採番数")
+        parser.add_argument("--block-size", type=int, default=100, help="まとめて確保する連番の件数")
+
+    def handle(self, *args, **options):
+        self.bench_encode(options["encodes"])
+        allocator = IdAllocator("bench", options["block_size"])
+        try:
+            self.stress(allocator, options["storecode"], options["threads"], options["ids"])
+        finally:
+            name = allocator.sequence_name(options["storecode"])
+            if connection.vendor == "postgresql":
+                with connection.cursor() as cursor:
+                    cursor.execute(f'DROP SEQUENCE IF EXISTS "{name}"')
+            else:
+                IdSequence.objects.filter(name=name).delete()
+
+    def bench_encode(self, count):
+        values = [261018, 1, 12345]
+
+        started = time.perf_counter()
+        for _ in range(count):
+            Sqids(min_length=10, alphabet="ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789").encode(values)
+        per_request = (time.perf_counter() - started) / count * 1_000_000
+
+        started = time.perf_counter()
+        for _ in range(count):
+            SQIDS.encode(values)
+        shared = (time.perf_counter() - started) / count * 1_000_000
+
+        self.stdout.write(f"encode: new Sqids per call={per_request:.1f}us shared encoder={shared:.1f}us")
+
+    def stress(self, allocator, storecode, threads, ids):
+        results = [[] for _ in range(threads)]
+        errors = []
+        barrier = threading.Barrier(threads)
+        now = timezone.now()
+
+        def worker(bucket):
+            try:
+                barrier.wait()
+                for _ in range(ids):
+                    bucket.append(allocator.allocate(storecode, now))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker, args=(bucket,)) for bucket in results]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        if errors:
+            raise CommandError(f"採番中にエラーが発生しました: {errors[0]}")
+        allocated = [sale_id for bucket in results for sale_id in bucket]
+        duplicates = len(allocated) - len(set(allocated))
+        self.stdout.write(
+            f"allocate: threads={threads} ids={len(allocated):,} elapsed={elapsed:.2f}s "
+            f"throughput={len(allocated) / elapsed:,.0f} ids/s duplicates={duplicates}"
+        )
+        if duplicates:
+            raise CommandError("重複した取引IDが採番されました。")
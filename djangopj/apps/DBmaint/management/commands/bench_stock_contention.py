@@ -0,0 +1,69 @@
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from apps.DBmaint.models import Stock, StockMovement
+from apps.DBmaint.stock import apply_stock_deltas, current_quantities
+
+# 計測で記録した入出庫の発生元 (計測後に削除する)
+BENCH_REFERENCE = "bench_stock_contention"
+
+
+class Command(BaseCommand):
+    help = "複数レジが同一商品を並行して販売した場合の在庫減算スループットを計測する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("storecode", help="計測に使う店番")
+        parser.add_argument("jan", help="計測に使うJANコード")
+        parser.add_argument("--registers", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="並行するレジ数")
+        parser.add_argument("--sales", type=int, default=200, help="レジ1台あたりの販売回数")
+
+    def handle(self, *args, **options):
+        storecode, jan = options["storecode"], options["jan"]
+        try:
+            stock = Stock.objects.get(storecode=storecode, JAN=jan)
+        except Stock.DoesNotExist:
+            raise CommandError(f"店舗コード {storecode} と JANコード {jan} の在庫が存在しません。")
+
+        try:
+            for registers in options["registers"]:
+                before = current_quantities([stock.pk])[stock.pk]
+                elapsed = self.run(storecode, jan, registers, options["sales"])
+                after = current_quantities([stock.pk])[stock.pk]
+
+                total = registers * options["sales"]
+                lost = (before - after) - total
+                self.stdout.write(
+                    f"registers={registers:>3} sales={total:>6} "
+                    f"elapsed={elapsed:.2f}s throughput={total / elapsed:,.0f} sales/s lost_updates={lost}"
+                )
+        finally:
+            # 計測で記録した入出庫を削除して在庫数を元に戻す (集約されていない前提)
+            StockMovement.objects.filter(stock=stock, reference=BENCH_REFERENCE).delete()
+
+    def run(self, storecode, jan, registers, sales):
+        barrier = threading.Barrier(registers)
+        errors = []
+
+        def register():
+            try:
+                barrier.wait()
+                for _ in range(sales):
+                    with transaction.atomic():
+                        apply_stock_deltas(storecode, {jan: -1}, reference=BENCH_REFERENCE)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=register) for _ in range(registers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        if errors:
+            raise CommandError(f"計測中にエラーが発生しました: {errors[0]}")
+        return elapsed
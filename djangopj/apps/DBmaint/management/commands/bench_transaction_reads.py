@@ -0,0 +1,58 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from apps.DBmaint.models import ReturnTransaction, Transaction
+from apps.api.serializers import (
+    ReturnTransactionReadSerializer,
+    ReturnTransactionSerializer,
+    TransactionReadSerializer,
+    TransactionSerializer,
+)
+
+
+class Command(BaseCommand):
+    help = "取引・返品の一覧の1ページ分の取得とシリアライズについて、ページサイズごとのクエリ数と処理時間を計測する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-sizes", type=int, nargs="+", default=[10, 50, 200, 1000], help="ページサイズ")
+        parser.add_argument("--iterations", type=int, default=20, help="ページサイズごとの繰り返し回数")
+
+    def handle(self, *args, **options):
+        if not Transaction.objects.exists():
+            raise CommandError("計測に使う取引が登録されていません。")
+
+        targets = [
+            # (名前, モデル, 日時の列, ModelSerializer, 読み取り用シリアライザー)
+            ("transactions", Transaction, "sale_date", TransactionSerializer, TransactionReadSerializer),
+            ("returns", ReturnTransaction, "return_date", ReturnTransactionSerializer, ReturnTransactionReadSerializer),
+        ]
+        for name, model, date_field, model_serializer, read_serializer in targets:
+            queryset = model.objects.order_by(f"-{date_field}", "-id")
+            for page_size in options["page_sizes"]:
+                # 変更前の一覧 (ModelSerializer、明細は取引ごとに読み込む) と読み取り用シリアライザーを比較する
+                model_result = self.measure(
+                    lambda: model_serializer(list(queryset[:page_size]), many=True).data, options["iterations"]
+                )
+                read_result = self.measure(
+                    lambda: read_serializer(
+                        list(read_serializer.setup_eager_loading(queryset)[:page_size]), many=True
+                    ).data,
+                    options["iterations"],
+                )
+                self.stdout.write(
+                    f"{name:<12} page_size={page_size:>5} "
+                    f"model: queries={model_result[0]:>5} {model_result[1]:8.1f}ms  "
+                    f"read: queries={read_result[0]:>3} {read_result[1]:8.1f}ms"
+                )
+
+    def measure(self, serialize, iterations):
+        """
+        (1回あたりのクエリ数, 1回あたりの処理時間(ミリ秒)) を返す
+        """
+        with CaptureQueriesContext(connection) as queries:
+            serialize()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            serialize()
+        return len(queries), (time.perf_counter() - started) / iterations * 1000
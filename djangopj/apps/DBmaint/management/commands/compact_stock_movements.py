@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from apps.DBmaint.stock import compact_stock_movements
+
+
+class Command(BaseCommand):
+    help = "未集約の入出庫を在庫数 (スナップショット) に畳み込む (定期実行する)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="1回のトランザクションで集約する入出庫数")
+
+    def handle(self, *args, **options):
+        compacted, updated = compact_stock_movements(batch_size=options["batch_size"], progress=self.progress)
+        self.stdout.write(self.style.SUCCESS(f"入出庫を集約しました。(入出庫 {compacted} 件 / 在庫 {updated} 件)"))
+
+    def progress(self, compacted, updated):
+        self.stdout.write(f"入出庫 {compacted:,} 件 / 在庫 {updated:,} 件")
@@ -0,0 +1,53 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from apps.DBmaint.exports import EXPORT_CHUNK_SIZE, EXPORTS, RENDERERS, export_rows, render_export
+
+
+class Command(BaseCommand):
+    help = "取引・販売商品をCSVもしくはJSONL形式で出力する (件数によらず一定のメモリで出力する)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=list(EXPORTS), help="出力対象")
+        parser.add_argument("--format", choices=list(RENDERERS), default="csv", help="出力形式")
+        parser.add_argument("--since", help="期間の開始日 (YYYY-MM-DD)")
+        parser.add_argument("--until", help="期間の終了日 (YYYY-MM-DD)")
+        parser.add_argument("--store", help="店番")
+        parser.add_argument("--output", default="-", help="出力先のファイル (省略時は標準出力)")
+        parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE, help="1回に読み込む行数")
+
+    def handle(self, *args, **options):
+        fields, rows = export_rows(
+            options["kind"],
+            since=self.parse(options["since"], "--since"),
+            until=self.parse(options["until"], "--until"),
+            storecode=options["store"],
+            chunk_size=options["chunk_size"],
+        )
+        if options["output"] == "-":
+            self.write(sys.stdout, options["format"], fields, rows)
+        else:
+            with open(options["output"], "w", encoding="utf-8", newline="") as output:
+                count = self.write(output, options["format"], fields, rows)
+            self.stderr.write(self.style.SUCCESS(f"{count}行を{options['output']}に出力しました。"))
+
+    def write(self, output, fmt, fields, rows):
+        count = 0
+
+        def counted():
+            nonlocal count
+            for row in rows:
+                count += 1
+                yield row
+
+        for chunk in render_export(fmt, fields, counted()):
+            output.write(chunk)
+        return count
+
+    def parse(self, value, option):
+        if not value:
+            return None
+        date = parse_date(value)
+        if date is None:
+            raise CommandError(f"{option} には YYYY-MM-DD 形式の日付を指定してください。")
+        return date
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from apps.DBmaint.sales_rollup import fold_rollup
+
+
+class Command(BaseCommand):
+    help = "取引・返品の登録時に追記した集計待ちの行を日別販売集計に加算する (定期実行する)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="1回のトランザクションで加算する行数")
+
+    def handle(self, *args, **options):
+        folded = fold_rollup(batch_size=options["batch_size"], progress=self.progress)
+        self.stdout.write(self.style.SUCCESS(f"日別販売集計に加算しました。({folded} 行)"))
+
+    def progress(self, folded):
+        self.stdout.write(f"{folded:,} 行")
@@ -0,0 +1,72 @@
+from datetime import datetime, time
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from apps.DBmaint.coupon_issuance import CouponCodeSpaceExhausted, coupon_code_utilisation, issue_coupons
+from apps.DBmaint.models import Coupon, Product
+
+
+class Command(BaseCommand):
+    help = "クーポンを一括発行し、クーポン種別ごとのコード空間の使用率を表示する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("coupon_type", nargs="?", choices=[t for t, _ in Coupon.COUPON_TYPES], help="クーポン種別")
+        parser.add_argument("count", nargs="?", type=int, default=0, help="発行枚数")
+        parser.add_argument("--expiration", help="有効期限 (YYYY-MM-DD もしくは ISO 8601形式)")
+        parser.add_argument("--discount-value", type=int, default=0, help="割引金額")
+        parser.add_argument("--discount-percentage", type=Decimal, help="割引割合(%%)")
+        parser.add_argument("--applicable-jan", help="割引対象商品のJAN")
+        parser.add_argument("--combo-jans", nargs="+", default=[], help="組み合わせJAN")
+        parser.add_argument("--min-quantity", type=int, default=1, help="最低購入数")
+        parser.add_argument("--batch-size", type=int, default=10000, help="1回のINSERTで発行する枚数")
+        parser.add_argument("--report", action="store_true", help="発行せずに使用率のみ表示する")
+
+    def handle(self, *args, **options):
+        if not options["report"]:
+            if not options["coupon_type"] or options["count"] <= 0:
+                raise CommandError("クーポン種別と1以上の発行枚数を指定してください。")
+            self.issue(options)
+
+        for coupon_type, usage in coupon_code_utilisation().items():
+            self.stdout.write(
+                f"{coupon_type:>8}: {usage['issued']:>9,} / {usage['capacity']:,} ({usage['utilisation']:.2%})"
+            )
+
+    def issue(self, options):
+        try:
+            # parse_datetimeは日付だけの値も受け付けるため、日付として先に解釈する (日付の場合はその日の終わりまで有効)
+            expiration = parse_date(options["expiration"] or "")
+            expiration = datetime.combine(expiration, time.max) if expiration else parse_datetime(options["expiration"] or "")
+        except ValueError:
+            expiration = None
+        if not expiration:
+            raise CommandError("--expiration に有効期限を指定してください。")
+        if timezone.is_naive(expiration):
+            expiration = timezone.make_aware(expiration)
+
+        applicable_product = None
+        if options["applicable_jan"]:
+            try:
+                applicable_product = Product.objects.get(JAN=options["applicable_jan"])
+            except Product.DoesNotExist:
+                raise CommandError(f"JANコード {options['applicable_jan']} を持つ商品が存在しません。")
+        combo_products = list(Product.objects.filter(JAN__in=options["combo_jans"]))
+        if len(combo_products) != len(set(options["combo_jans"])):
+            raise CommandError("組み合わせJANに存在しない商品が含まれています。")
+
+        try:
+            codes = issue_coupons(
+                options["coupon_type"],
+                options["count"],
+                batch_size=options["batch_size"],
+                combo_products=combo_products,
+                expiration_date=expiration,
+                discount_value=options["discount_value"],
+                discount_percentage=options["discount_percentage"],
+                applicable_product_jan=applicable_product,
+                min_quantity=options["min_quantity"],
+            )
+        except CouponCodeSpaceExhausted as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"{len(codes):,} 件のクーポンを発行しました。"))
@@ -0,0 +1,61 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from apps.DBmaint.partitions import (
+    add_months,
+    convert_to_partitioned,
+    default_partition_rows,
+    is_partitioned,
+    maintain_partitions,
+    month_start,
+    partitioned_models,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "取引履歴・販売商品詳細の変更履歴テーブルを月別パーティションで管理する "
+        "(先の月のパーティションの作成と古いパーティションの切り離し。月1回以上実行する)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--convert",
+            action="store_true",
+            help="パーティション分割されていないテーブルを月別パーティションのテーブルに作り直す (初回のみ)",
+        )
+        parser.add_argument("--keep-legacy", action="store_true", help="--convert で元のテーブルを *_legacy として残す")
+        parser.add_argument("--months-ahead", type=int, help="事前に作成しておく先の月数")
+        parser.add_argument("--retention-months", type=int, help="この月数より前の月のパーティションを切り離す (0は切り離さない)")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("パーティションの管理はPostgreSQLでのみ使用できます。")
+        months_ahead = options["months_ahead"]
+        if months_ahead is None:
+            months_ahead = getattr(settings, "HISTORY_PARTITION_MONTHS_AHEAD", 3)
+        retention = options["retention_months"]
+        if retention is None:
+            retention = getattr(settings, "HISTORY_PARTITION_RETENTION_MONTHS", 0)
+        detach_before = add_months(month_start(timezone.localtime()), -retention) if retention else None
+
+        for model in partitioned_models():
+            table = model._meta.db_table
+            if not is_partitioned(table):
+                if not options["convert"]:
+                    raise CommandError(f"{table} はパーティション分割されていません。初回は --convert を指定してください。")
+                count = convert_to_partitioned(model, months_ahead, keep_legacy=options["keep_legacy"])
+                self.stdout.write(f"{table}: 月別パーティションのテーブルに作り直しました。(パーティション {count} 件)")
+
+            created, detached = maintain_partitions(model, months_ahead, detach_before)
+            for name in created:
+                self.stdout.write(f"{table}: {name} を作成しました。")
+            for name in detached:
+                self.stdout.write(f"{table}: {name} を切り離しました。(アーカイブ後に削除してください)")
+            outside = default_partition_rows(table)
+            if outside:
+                self.stdout.write(
+                    self.style.WARNING(f"{table}: 月別パーティションの範囲外の行が {outside} 件あります。(デフォルトパーティション)")
+                )
+        self.stdout.write(self.style.SUCCESS("パーティションを更新しました。"))
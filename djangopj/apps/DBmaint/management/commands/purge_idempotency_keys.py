@@ -0,0 +1,22 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from apps.DBmaint.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = "保持期間を過ぎたIdempotency-Keyと処理結果を削除する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hours",
+            type=int,
+            default=getattr(settings, "IDEMPOTENCY_KEY_TTL_HOURS", 48),
+            help="保持期間(時間)",
+        )
+
+    def handle(self, *args, **options):
+        threshold = timezone.now() - timedelta(hours=options["hours"])
+        deleted, _ = IdempotencyKey.objects.filter(created_at__lt=threshold).delete()
+        self.stdout.write(self.style.SUCCESS(f"{deleted}件の冪等キーを削除しました。"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from apps.DBmaint.sales_rollup import rebuild_rollup
+
+
+class Command(BaseCommand):
+    help = "販売商品・返品商品から日別販売集計を作り直す (初回の作成や集計のずれの修正に使う)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", help="作り直す期間の開始日 (YYYY-MM-DD)")
+        parser.add_argument("--until", help="作り直す期間の終了日 (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        since = self.parse(options["since"], "--since")
+        until = self.parse(options["until"], "--until")
+        if since and until and since > until:
+            raise CommandError("--since には --until 以前の日付を指定してください。")
+
+        count = rebuild_rollup(since, until)
+        self.stdout.write(self.style.SUCCESS(f"日別販売集計を{count}行作成しました。"))
+
+    def parse(self, value, option):
+        if not value:
+            return None
+        date = parse_date(value)
+        if date is None:
+            raise CommandError(f"{option} には YYYY-MM-DD 形式の日付を指定してください。")
+        return date
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from apps.DBmaint.models import Product
+from apps.DBmaint.stock import regenerate_stocks
+
+
+class Command(BaseCommand):
+    help = "商品の在庫を全店舗分、在庫数0で作り直す (JANを省略した場合は全商品)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("jan_codes", nargs="*", help="JAN")
+        parser.add_argument("--chunk-size", type=int, help="1回のトランザクションで処理する在庫行数")
+
+    def handle(self, *args, **options):
+        jan_codes = options["jan_codes"] or Product.objects.order_by("JAN").values_list("JAN", flat=True)
+        created, reset = regenerate_stocks(jan_codes, chunk_size=options["chunk_size"], progress=self.progress)
+        self.stdout.write(self.style.SUCCESS(f"在庫を再生成しました。(作成 {created} 件 / リセット {reset} 件)"))
+
+    def progress(self, done, total, created, reset):
+        self.stdout.write(f"{done:,} / {total:,} 商品 (作成 {created:,} 件 / リセット {reset:,} 件)")
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from apps.DBmaint.stock import transfer_stock
+
+
+class Command(BaseCommand):
+    help = "店舗間で在庫を移動し、移動元の出庫と移動先の入庫を入出庫台帳に記録する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("jan", help="JANコード")
+        parser.add_argument("from_storecode", help="移動元の店番")
+        parser.add_argument("to_storecode", help="移動先の店番")
+        parser.add_argument("quantity", type=int, help="移動する数量")
+        parser.add_argument("--reference", default="", help="伝票番号など、移動の発生元")
+
+    def handle(self, *args, **options):
+        if options["quantity"] <= 0:
+            raise CommandError("移動する数量には1以上を指定してください。")
+        if options["from_storecode"] == options["to_storecode"]:
+            raise CommandError("移動元と移動先には異なる店番を指定してください。")
+
+        with transaction.atomic():
+            missing = transfer_stock(
+                options["jan"],
+                options["from_storecode"],
+                options["to_storecode"],
+                options["quantity"],
+                reference=options["reference"],
+            )
+        if missing:
+            raise CommandError(f"店舗コード {missing[0][0]} と JANコード {missing[0][1]} の在庫が存在しません。")
+        self.stdout.write(self.style.SUCCESS(f"在庫を{options['quantity']}個移動しました。"))
@@ -5,6 +5,7 @@ from .utils import is_valid_jan_code, is_valid_tax
 from simple_history.models import HistoricalRecords
 import random, string
 from django.db.models import UniqueConstraint
+from django.core.serializers.json import DjangoJSONEncoder
 
 
 class Store(models.Model):
@@ -55,6 +56,43 @@ class Stock(models.Model):
         ]
 
 
+class StockMovement(models.Model):
+    """
+    在庫の入出庫台帳 (追記のみ)
+    販売・返品などでは在庫行を更新せずに入出庫を追記し、現在の在庫数は
+    在庫行の在庫数 (スナップショット) に未集約の入出庫の合計を足して求める
+    集約コマンド (compact_stock_movements) で入出庫をスナップショットに畳み込む
+    """
+
+    KINDS = (
+        ("sale", "販売"),
+        ("return", "返品"),
+        ("adjustment", "在庫調整"),
+        ("transfer", "店舗間移動"),
+    )
+    stock = models.ForeignKey(Stock, on_delete=models.CASCADE, related_name="movements", verbose_name="在庫")
+    kind = models.CharField(max_length=10, choices=KINDS, verbose_name="種別")
+    quantity = models.IntegerField(verbose_name="増減数")
+    # 取引ID・返品IDなど、入出庫の発生元
+    reference = models.CharField(max_length=255, blank=True, db_index=True, verbose_name="発生元")
+    # 管理画面などで在庫調整を行ったユーザー
+    user = models.ForeignKey(CustomUser, null=True, blank=True, on_delete=models.SET_NULL, verbose_name="ユーザー")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="記録日時")
+    # 在庫行の在庫数に畳み込み済みかどうか
+    compacted = models.BooleanField(default=False, verbose_name="集約済み")
+
+    def __str__(self):
+        return f"{self.stock_id}:{self.kind}:{self.quantity}"
+
+    class Meta:
+        verbose_name = "入出庫台帳"
+        verbose_name_plural = "入出庫台帳"
+        indexes = [
+            # 現在の在庫数の算出と集約では未集約の入出庫だけを読む
+            models.Index(fields=["stock"], condition=models.Q(compacted=False), name="stockmovement_pending_idx"),
+        ]
+
+
 class Transaction(models.Model):
     SALE_TYPES = (
         ("1", "販売"),
@@ -71,7 +109,8 @@ class Transaction(models.Model):
     staffcode = models.ForeignKey(CustomUser, on_delete=models.DO_NOTHING, to_field="staffcode")
     purchase_points = models.IntegerField()
     # SaleProductのJANをキーにProductテーブルを検索し、taxが10%のものの合計金額を計算 10%商品の（price * tax * points）の合計
-    coupon_code = models.CharField(blank=True, null=True, max_length=13)
+    # 複数のクーポンを適用した場合はカンマ区切りで保存する
+    coupon_code = models.CharField(blank=True, null=True, max_length=255)
     tax_10_percent = models.IntegerField()
     # SaleProductのJANをキーにProductテーブルを検索し、taxが8%のものの合計金額を計算 8%商品の（price * tax * points）の合計
     tax_8_percent = models.IntegerField()
@@ -88,6 +127,12 @@ class Transaction(models.Model):
     class Meta:
         verbose_name = "取引履歴"
         verbose_name_plural = "取引履歴"
+        indexes = [
+            # 管理画面・APIの販売日時での絞り込みと、APIのカーソルページネーション (販売日時, ID)
+            models.Index(fields=["sale_date", "id"], name="transaction_sale_date_id_idx"),
+            # APIの店舗での絞り込み
+            models.Index(fields=["storecode", "sale_date", "id"], name="transaction_store_date_idx"),
+        ]
 
 
 class SaleProduct(models.Model):
@@ -170,10 +215,18 @@ class Coupon(models.Model):
         "Product", related_name="combo_coupons", blank=True, verbose_name="組み合わせJAN"
     )
     min_quantity = models.PositiveIntegerField(default=1, verbose_name="最低購入数")
+    # 一括発行時のバッチID (衝突した行を判別するために使用)
+    issue_batch = models.CharField(
+        max_length=26, null=True, blank=True, db_index=True, editable=False, verbose_name="発行バッチ"
+    )
 
     def save(self, *args, **kwargs):
         if not self.code:
+            # 既存のクーポンを上書きしないよう、未使用のコードを採番して必ずINSERTする
             self.code = generate_coupon_code(self.coupon_type)
+            while Coupon.objects.filter(code=self.code).exists():
+                self.code = generate_coupon_code(self.coupon_type)
+            kwargs["force_insert"] = True
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -214,6 +267,11 @@ class ReturnTransaction(models.Model):
     class Meta:
         verbose_name = "返品商品詳細"
         verbose_name_plural = "返品商品詳細"
+        indexes = [
+            # APIのカーソルページネーション (返品日時, ID) と店舗での絞り込み
+            models.Index(fields=["return_date", "id"], name="return_date_id_idx"),
+            models.Index(fields=["storecode", "return_date", "id"], name="return_store_date_idx"),
+        ]
 
 
 class ReturnProduct(models.Model):
@@ -232,6 +290,115 @@ class ReturnProduct(models.Model):
         verbose_name_plural = "返品履歴"
 
 
+class IdSequence(models.Model):
+    """
+    PostgreSQL以外のDBで取引IDの連番を採番するためのテーブル
+    PostgreSQLではシーケンスを使用するため使われない
+    """
+
+    name = models.CharField(max_length=255, unique=True, verbose_name="シーケンス名")
+    last_value = models.BigIntegerField(default=0, verbose_name="最終値")
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = "採番テーブル"
+        verbose_name_plural = "採番テーブル"
+
+
+class IdempotencyKey(models.Model):
+    """
+    Idempotency-Keyヘッダー付きのPOSTの処理結果
+    同じキーで再送されたリクエストには、処理をやり直さずに保存済みのレスポンスを返す
+    """
+
+    key = models.CharField(max_length=255, verbose_name="冪等キー")
+    scope = models.CharField(max_length=100, verbose_name="エンドポイント")
+    request_hash = models.CharField(max_length=64, verbose_name="リクエストのハッシュ値")
+    status_code = models.PositiveSmallIntegerField(null=True, verbose_name="ステータスコード")
+    response_body = models.JSONField(null=True, encoder=DjangoJSONEncoder, verbose_name="レスポンス")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="作成日時")
+
+    def __str__(self):
+        return f"{self.scope}:{self.key}"
+
+    class Meta:
+        verbose_name = "冪等キー"
+        verbose_name_plural = "冪等キー"
+        constraints = [UniqueConstraint(fields=["scope", "key"], name="unique_idempotency_scope_key")]
+
+
+class CatalogChange(models.Model):
+    """
+    商品マスター・クーポンマスターの変更履歴
+    idを変更バージョンとして扱い、レジは前回取得したバージョン以降の差分だけを取得する
+    """
+
+    KINDS = (
+        ("product", "商品"),
+        ("coupon", "クーポン"),
+    )
+    OPERATIONS = (
+        ("upsert", "登録・更新"),
+        ("delete", "削除"),
+    )
+    id = models.BigAutoField(primary_key=True, verbose_name="変更バージョン")
+    kind = models.CharField(max_length=10, choices=KINDS, verbose_name="種別")
+    key = models.CharField(max_length=255, verbose_name="JAN・クーポンコード")
+    operation = models.CharField(max_length=6, choices=OPERATIONS, verbose_name="操作")
+    changed_at = models.DateTimeField(auto_now_add=True, verbose_name="変更日時")
+
+    def __str__(self):
+        return f"{self.id}:{self.kind}:{self.key}"
+
+    class Meta:
+        verbose_name = "マスター変更履歴"
+        verbose_name_plural = "マスター変更履歴"
+
+
+class DailySalesRollup(models.Model):
+    """
+    店舗×商品×日ごとの販売・返品の集計
+    取引・返品の登録時には集計待ち (SalesRollupDelta) に追記し、fold_sales_rollupコマンドで定期的に加算する
+    rebuild_sales_rollupコマンドで再集計できる
+    """
+
+    storecode = models.ForeignKey(Store, on_delete=models.DO_NOTHING, to_field="storecode", verbose_name="店番")
+    JAN = models.ForeignKey(Product, on_delete=models.DO_NOTHING, to_field="JAN", verbose_name="JAN")
+    date = models.DateField(verbose_name="日付")
+    sold_points = models.IntegerField(default=0, verbose_name="販売点数")
+    sold_amount = models.BigIntegerField(default=0, verbose_name="販売額")
+    returned_points = models.IntegerField(default=0, verbose_name="返品点数")
+    returned_amount = models.BigIntegerField(default=0, verbose_name="返品額")
+
+    class Meta:
+        verbose_name = "日別販売集計"
+        verbose_name_plural = "日別販売集計"
+        constraints = [UniqueConstraint(fields=["storecode", "JAN", "date"], name="unique_daily_sales_rollup")]
+        indexes = [models.Index(fields=["date"])]
+
+
+class SalesRollupDelta(models.Model):
+    """
+    日別販売集計に未加算の販売・返品 (追記のみ)
+    取引・返品の登録時は集計の行を更新せずにここへ追記し、同じ商品を並行して販売するレジ同士が集計の行で待ち合わせないようにする
+    fold_sales_rollupコマンドで日別販売集計に加算し、加算した行は削除する
+    """
+
+    storecode = models.ForeignKey(Store, on_delete=models.DO_NOTHING, to_field="storecode", verbose_name="店番")
+    JAN = models.ForeignKey(Product, on_delete=models.DO_NOTHING, to_field="JAN", verbose_name="JAN")
+    date = models.DateField(verbose_name="日付")
+    sold_points = models.IntegerField(default=0, verbose_name="販売点数")
+    sold_amount = models.BigIntegerField(default=0, verbose_name="販売額")
+    returned_points = models.IntegerField(default=0, verbose_name="返品点数")
+    returned_amount = models.BigIntegerField(default=0, verbose_name="返品額")
+
+    class Meta:
+        verbose_name = "日別販売集計 (集計待ち)"
+        verbose_name_plural = "日別販売集計 (集計待ち)"
+
+
 class SaleSummary(Transaction):
     class Meta:
         proxy = True
@@ -0,0 +1,183 @@
+import datetime
+import re
+from django.db import connection, models, transaction
+from django.utils import timezone
+from .models import SaleProduct, Transaction
+
+# 月別パーティションの名前の末尾 (例: _p202405)
+PARTITION_SUFFIX = re.compile(r"_p(\d{4})(\d{2})$")
+
+
+def partitioned_models():
+    """
+    history_dateの月ごとにパーティション分割する変更履歴のモデル
+    """
+    return [Transaction.history.model, SaleProduct.history.model]
+
+
+def month_start(value):
+    return datetime.date(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def month_bound(month):
+    # パーティションの境界は現在のタイムゾーン (Asia/Tokyo) の月初にする
+    return timezone.make_aware(datetime.datetime(month.year, month.month, 1))
+
+
+def partition_name(table, month):
+    return f"{table}_p{month:%Y%m}"
+
+
+def is_partitioned(table):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [connection.ops.quote_name(table)])
+        row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def list_partitions(table):
+    """
+    {月初の日付: パーティション名} を返す (デフォルトパーティションは含まない)
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = to_regclass(%s)
+            """,
+            [connection.ops.quote_name(table)],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    partitions = {}
+    for name in names:
+        match = PARTITION_SUFFIX.search(name)
+        if match and name == partition_name(table, datetime.date(int(match[1]), int(match[2]), 1)):
+            partitions[datetime.date(int(match[1]), int(match[2]), 1)] = name
+    return partitions
+
+
+def create_partition(cursor, table, month):
+    qn = connection.ops.quote_name
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS {qn(partition_name(table, month))} PARTITION OF {qn(table)} "
+        "FOR VALUES FROM (%s) TO (%s)",
+        [month_bound(month), month_bound(add_months(month, 1))],
+    )
+
+
+def default_partition_rows(table):
+    """
+    デフォルトパーティション (月別パーティションの範囲外の行) の行数を返す
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT count(*) FROM {connection.ops.quote_name(table + '_default')}")
+        return cursor.fetchone()[0]
+
+
+def convert_to_partitioned(model, months_ahead=3, keep_legacy=False):
+    """
+    変更履歴のテーブルをhistory_dateによる月別のレンジパーティションのテーブルに作り直し、作成したパーティション数を返す
+    既存の行は月別パーティションにコピーし、元のテーブルは削除する (keep_legacyの場合は *_legacy として残す)
+    テーブル全体を排他ロックするため、メンテナンス時間帯に1回だけ実行する
+
+    PostgreSQL 15はパーティションテーブルのIDENTITY列に対応していないため、history_idは
+    テーブルが所有するシーケンスのデフォルト値で採番する
+    主キーにはパーティションキーを含める必要があるため (history_id, history_date) とする
+    """
+    qn = connection.ops.quote_name
+    meta = model._meta
+    table = meta.db_table
+    legacy = f"{table}_legacy"
+    sequence = f"{table}_history_id_seq"
+    pk_column = meta.pk.column
+    date_column = meta.get_field("history_date").column
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {qn(table)} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype IN ('p', 'f')",
+            [qn(table)],
+        )
+        constraints = [row[0] for row in cursor.fetchall()]
+
+        # 元のテーブルの名前・制約名・IDENTITYのシーケンス名を空けてから、同じ名前で作り直す
+        cursor.execute(f"ALTER TABLE {qn(table)} RENAME TO {qn(legacy)}")
+        for name in constraints:
+            cursor.execute(f"ALTER TABLE {qn(legacy)} RENAME CONSTRAINT {qn(name)} TO {qn(name + '_legacy')}")
+        cursor.execute(f"ALTER TABLE {qn(legacy)} ALTER COLUMN {qn(pk_column)} DROP IDENTITY IF EXISTS")
+
+        cursor.execute(
+            f"CREATE TABLE {qn(table)} (LIKE {qn(legacy)} INCLUDING DEFAULTS) PARTITION BY RANGE ({qn(date_column)})"
+        )
+        cursor.execute(f"CREATE SEQUENCE {qn(sequence)} AS bigint OWNED BY {qn(table)}.{qn(pk_column)}")
+        cursor.execute(
+            f"SELECT setval(%s, COALESCE(max({qn(pk_column)}), 0) + 1, false) FROM {qn(legacy)}", [qn(sequence)]
+        )
+        cursor.execute(
+            f"ALTER TABLE {qn(table)} ALTER COLUMN {qn(pk_column)} SET DEFAULT nextval(%s::regclass)", [qn(sequence)]
+        )
+        cursor.execute(f"ALTER TABLE {qn(table)} ADD PRIMARY KEY ({qn(pk_column)}, {qn(date_column)})")
+
+        # インデックス・外部キーはパーティションテーブルに作成し、各パーティションに引き継がせる
+        indexed = {date_column}
+        for field in meta.local_fields:
+            if field.db_index and not field.primary_key:
+                indexed.add(field.column)
+            if isinstance(field, models.ForeignKey) and field.db_constraint:
+                target = field.target_field
+                cursor.execute(
+                    f"ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(f'{table}_{field.column}_fk')} "
+                    f"FOREIGN KEY ({qn(field.column)}) REFERENCES {qn(target.model._meta.db_table)} ({qn(target.column)}) "
+                    "DEFERRABLE INITIALLY DEFERRED"
+                )
+        for column in sorted(indexed):
+            cursor.execute(f"CREATE INDEX {qn(f'{table}_{column}_part_idx')} ON {qn(table)} ({qn(column)})")
+
+        # 既存の行の最古の月から、months_ahead か月先までのパーティションを作成する
+        cursor.execute(f"SELECT min({qn(date_column)}) FROM {qn(legacy)}")
+        oldest = cursor.fetchone()[0]
+        current = month_start(timezone.localtime())
+        month = month_start(timezone.localtime(oldest)) if oldest else current
+        created = 0
+        while month <= add_months(current, months_ahead):
+            create_partition(cursor, table, month)
+            month = add_months(month, 1)
+            created += 1
+        cursor.execute(f"CREATE TABLE {qn(table + '_default')} PARTITION OF {qn(table)} DEFAULT")
+
+        cursor.execute(f"INSERT INTO {qn(table)} SELECT * FROM {qn(legacy)}")
+        if not keep_legacy:
+            cursor.execute(f"DROP TABLE {qn(legacy)}")
+    return created
+
+
+def maintain_partitions(model, months_ahead=3, detach_before=None):
+    """
+    今月からmonths_ahead か月先までのパーティションを作成し、
+    detach_before (月初の日付) より前の月のパーティションを切り離す
+    切り離したパーティションは通常のテーブルとして残るため、アーカイブ後に削除する
+    (作成したパーティション名のリスト, 切り離したパーティション名のリスト) を返す
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    existing = list_partitions(table)
+    current = month_start(timezone.localtime())
+    created, detached = [], []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for offset in range(months_ahead + 1):
+            month = add_months(current, offset)
+            if month not in existing:
+                create_partition(cursor, table, month)
+                created.append(partition_name(table, month))
+        if detach_before:
+            for month, name in sorted(existing.items()):
+                if month < detach_before:
+                    cursor.execute(f"ALTER TABLE {qn(table)} DETACH PARTITION {qn(name)}")
+                    detached.append(name)
+    return created, detached
@@ -0,0 +1,201 @@
+import asyncio
+import threading
+import time
+import weakref
+from collections import OrderedDict
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+class ReceiptServiceError(Exception):
+    pass
+
+
+class ReceiptServiceUnavailable(ReceiptServiceError):
+    """
+    サーキットブレーカーが開いているため、レシートサービスを呼び出さなかった
+    """
+
+
+class ReceiptCache:
+    """
+    sale_idをキーに生成済みのレシートHTMLを保持するキャッシュ
+    取引は登録後に変更されないため有効期限は設けず、合計サイズが上限を超えると最も古く参照されたものから破棄する
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sale_id):
+        with self._lock:
+            html = self._entries.get(sale_id)
+            if html is not None:
+                self._entries.move_to_end(sale_id)
+            return html
+
+    def set(self, sale_id, html):
+        size = len(html.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(sale_id, None)
+            if previous is not None:
+                self.size -= len(previous.encode())
+            self._entries[sale_id] = html
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.encode())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class CircuitBreaker:
+    """
+    連続してfailure_threshold回失敗するとreset_timeout秒間呼び出しを止める
+    停止後は1回だけ試行を許可し、成功すれば再開、失敗すれば再び停止する
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # 次の試行が終わるまでは他の呼び出しを止めたままにする
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class ReceiptClient:
+    """
+    receiptlineサービスでレシートHTMLを生成するクライアント
+    - Keep-Aliveのコネクションプールを使い回し、接続・読み取りにタイムアウトを設定する
+    - サービスの障害時はサーキットブレーカーで呼び出しを止め、ワーカーを待たせない
+    - 生成したHTMLはsale_idごとにキャッシュし、再印刷ではサービスを呼び出さない
+    """
+
+    def __init__(self, base_url, connect_timeout, read_timeout, pool_size, failure_threshold, reset_timeout, cache_max_bytes):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.cache = ReceiptCache(cache_max_bytes)
+        self.session = requests.Session()
+        # リトライはしない (失敗はサーキットブレーカーで扱う)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def render(self, sale_id, build_text):
+        """
+        取引のレシートHTMLを返す
+        build_textはキャッシュにない場合だけ呼び出され、receiptline形式のテキストを返す
+        """
+        html = self.cache.get(sale_id)
+        if html is not None:
+            return html
+
+        if not self.breaker.allow():
+            raise ReceiptServiceUnavailable("レシートサービスが一時的に利用できません。")
+
+        try:
+            response = self.session.post(f"{self.base_url}/generate", data={"text": build_text()}, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as exc:
+            self.breaker.record_failure()
+            raise ReceiptServiceError(f"レシートの生成に失敗しました: {exc}") from exc
+
+        self.breaker.record_success()
+        html = response.text
+        self.cache.set(sale_id, html)
+        return html
+
+
+class AsyncReceiptClient:
+    """
+    ReceiptClientの非同期版 (httpx)
+    キャッシュとサーキットブレーカーは同じプロセスの同期版と共有する
+    """
+
+    def __init__(self, sync_client, pool_size):
+        self.base_url = sync_client.base_url
+        self.timeout = httpx.Timeout(sync_client.timeout[1], connect=sync_client.timeout[0])
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.breaker = sync_client.breaker
+        self.cache = sync_client.cache
+        # httpxのクライアントはイベントループごとに作成する (WSGIで実行した場合はリクエストごとにループが変わる)
+        self._clients = weakref.WeakKeyDictionary()
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return client
+
+    async def render(self, sale_id, build_text):
+        """
+        取引のレシートHTMLを返す
+        build_textはキャッシュにない場合だけ呼び出されるコルーチン関数で、receiptline形式のテキストを返す
+        """
+        html = self.cache.get(sale_id)
+        if html is not None:
+            return html
+
+        if not self.breaker.allow():
+            raise ReceiptServiceUnavailable("レシートサービスが一時的に利用できません。")
+
+        text = await build_text()
+        try:
+            response = await self.client().post(f"{self.base_url}/generate", data={"text": text})
+            response.raise_for_status()
+        except httpx.HTTPError as exc:
+            self.breaker.record_failure()
+            raise ReceiptServiceError(f"レシートの生成に失敗しました: {exc}") from exc
+
+        self.breaker.record_success()
+        html = response.text
+        self.cache.set(sale_id, html)
+        return html
+
+
+receipt_client = ReceiptClient(
+    base_url=getattr(settings, "RECEIPT_SERVICE_URL", "http://receipt:6573"),
+    connect_timeout=getattr(settings, "RECEIPT_SERVICE_CONNECT_TIMEOUT", 1.0),
+    read_timeout=getattr(settings, "RECEIPT_SERVICE_READ_TIMEOUT", 5.0),
+    pool_size=getattr(settings, "RECEIPT_SERVICE_POOL_SIZE", 4),
+    failure_threshold=getattr(settings, "RECEIPT_SERVICE_FAILURE_THRESHOLD", 3),
+    reset_timeout=getattr(settings, "RECEIPT_SERVICE_RESET_TIMEOUT", 30),
+    cache_max_bytes=getattr(settings, "RECEIPT_CACHE_MAX_BYTES", 32 * 1024 * 1024),
+)
+
+async_receipt_client = AsyncReceiptClient(
+    receipt_client,
+    pool_size=getattr(settings, "RECEIPT_SERVICE_ASYNC_POOL_SIZE", 100),
+)
@@ -0,0 +1,167 @@
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import DailySalesRollup, ReturnProduct, SaleProduct, SalesRollupDelta
+
+ROLLUP_COLUMNS = ("sold_points", "sold_amount", "returned_points", "returned_amount")
+
+
+def add_to_rollup(rows, batch_size=1000):
+    """
+    集計に加算する
+    rows は (店番, JAN, 日付, 販売点数, 販売額, 返品点数, 返品額) のイテラブル
+    同じキーの行は合算し、既存の行にはDB側で加算する (INSERT ... ON CONFLICT DO UPDATE)
+    キーの順に書き込むことで、並行して加算する処理同士のデッドロックを防ぐ
+    集計の行をロックするため、取引・返品の登録中には呼び出さず queue_rollup を使う
+    """
+    totals = _sum_rows(rows)
+    if not totals:
+        return
+
+    qn = connection.ops.quote_name
+    meta = DailySalesRollup._meta
+    key_columns = [meta.get_field(name).column for name in ("storecode", "JAN", "date")]
+    value_columns = [meta.get_field(name).column for name in ROLLUP_COLUMNS]
+    columns = ", ".join(qn(column) for column in key_columns + value_columns)
+    updates = ", ".join(
+        f"{qn(column)} = {qn(meta.db_table)}.{qn(column)} + EXCLUDED.{qn(column)}" for column in value_columns
+    )
+    keys = sorted(totals)
+    with connection.cursor() as cursor:
+        for start in range(0, len(keys), batch_size):
+            chunk = keys[start:start + batch_size]
+            params = []
+            for key in chunk:
+                params.extend([*key, *totals[key]])
+            cursor.execute(
+                f"INSERT INTO {qn(meta.db_table)} ({columns}) VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(chunk))} "
+                f"ON CONFLICT ({', '.join(qn(column) for column in key_columns)}) DO UPDATE SET {updates}",
+                params,
+            )
+
+
+def _sum_rows(rows):
+    """
+    同じキー (店番, JAN, 日付) の行を合算した {キー: [販売点数, 販売額, 返品点数, 返品額]} を返す
+    """
+    totals = {}
+    for storecode, jan_code, date, *values in rows:
+        current = totals.setdefault((storecode, jan_code, date), [0, 0, 0, 0])
+        for i, value in enumerate(values):
+            current[i] += value
+    return totals
+
+
+def queue_rollup(rows):
+    """
+    集計に加算する行を集計待ちに追記する (取引・返品の登録時に使う)
+    rows は add_to_rollup と同じ形式で、同じキーの行は合算して1行にする
+    集計の行を更新しないため、同じ商品を並行して販売しても待ち合わせない
+    """
+    SalesRollupDelta.objects.bulk_create(
+        [
+            SalesRollupDelta(storecode_id=storecode, JAN_id=jan_code, date=date, **dict(zip(ROLLUP_COLUMNS, values)))
+            for (storecode, jan_code, date), values in _sum_rows(rows).items()
+        ]
+    )
+
+
+def fold_rollup(batch_size=10000, progress=None):
+    """
+    集計待ちの行を日別販売集計に加算して削除し、加算した行数を返す
+    batch_size行ごとに1回のトランザクションで処理する
+    他の加算処理が処理中の行は飛ばすため、複数のワーカーから並行して実行できる
+    """
+    folded = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                SalesRollupDelta.objects.order_by("pk")
+                .select_for_update(skip_locked=True)
+                .values_list("pk", "storecode", "JAN", "date", *ROLLUP_COLUMNS)[:batch_size]
+            )
+            if not rows:
+                break
+            add_to_rollup(row[1:] for row in rows)
+            SalesRollupDelta.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        folded += len(rows)
+        if progress:
+            progress(folded)
+    return folded
+
+
+def sale_rollup_rows(sale_products):
+    """
+    販売商品から集計に加算する行を作る (日付は販売日時の現地日付)
+    """
+    for sale_product in sale_products:
+        transaction_instance = sale_product.transaction
+        yield (
+            transaction_instance.storecode_id,
+            sale_product.JAN_id,
+            timezone.localdate(transaction_instance.sale_date),
+            sale_product.points,
+            sale_product.price * sale_product.points,
+            0,
+            0,
+        )
+
+
+def return_rollup_rows(return_products):
+    """
+    返品商品から集計に加算する行を作る (日付は返品日時の現地日付)
+    """
+    for return_product in return_products:
+        return_instance = return_product.return_transaction
+        yield (
+            return_instance.storecode.storecode,
+            return_product.JAN_id,
+            timezone.localdate(return_instance.return_date),
+            0,
+            0,
+            return_product.points,
+            return_product.price * return_product.points,
+        )
+
+
+def rebuild_rollup(since=None, until=None):
+    """
+    販売商品・返品商品から集計を作り直し、作成した行数を返す
+    since・until (日付) を指定した場合はその期間 (両端を含む) だけを作り直す
+    期間内の集計待ちの行は作り直した集計に含まれるため削除する (取引の登録・fold_rollupと並行して実行しないこと)
+    """
+    sales = SaleProduct.objects.filter(transaction__storecode__isnull=False).annotate(
+        date=TruncDate("transaction__sale_date")
+    )
+    returns = ReturnProduct.objects.filter(return_transaction__storecode__isnull=False).annotate(
+        date=TruncDate("return_transaction__return_date")
+    )
+    rollups = DailySalesRollup.objects.all()
+    deltas = SalesRollupDelta.objects.all()
+    if since:
+        sales, returns, rollups = sales.filter(date__gte=since), returns.filter(date__gte=since), rollups.filter(date__gte=since)
+        deltas = deltas.filter(date__gte=since)
+    if until:
+        sales, returns, rollups = sales.filter(date__lte=until), returns.filter(date__lte=until), rollups.filter(date__lte=until)
+        deltas = deltas.filter(date__lte=until)
+
+    sold = (
+        sales.values_list("transaction__storecode", "JAN", "date")
+        .annotate(total_points=Sum("points"), total_amount=Sum(F("price") * F("points")))
+        .order_by()
+    )
+    returned = (
+        returns.values_list("return_transaction__storecode__storecode", "JAN", "date")
+        .annotate(total_points=Sum("points"), total_amount=Sum(F("price") * F("points")))
+        .order_by()
+    )
+
+    with transaction.atomic():
+        deltas.delete()
+        rollups.delete()
+        add_to_rollup((storecode, jan_code, date, points, amount, 0, 0) for storecode, jan_code, date, points, amount in sold.iterator())
+        add_to_rollup(
+            (storecode, jan_code, date, 0, 0, points, amount) for storecode, jan_code, date, points, amount in returned.iterator()
+        )
+        return rollups.count()
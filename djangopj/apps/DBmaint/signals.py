@@ -1,28 +1,69 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
-from .models import Product, Stock, Store
-from django.db import transaction
+from .models import Product, Store, Coupon
+from .catalog_cache import catalog_cache
+from .catalog_changes import record_catalog_changes
+from .coupon_engine import coupon_index
+from .stock import provision_stocks, stock_provisioning_deferred
 
 
 # 商品が追加されたら、全店舗分の在庫リストを作成
 @receiver(post_save, sender=Product)
 def create_stock_for_new_product(sender, instance, created, **kwargs):
-    if created:
-        with transaction.atomic():
-            stores = Store.objects.all()
-            for store in stores:
-                # StorecodeとJANの組み合わせが存在しない場合にのみ作成
-                if not Stock.objects.filter(storecode=store, JAN=instance).exists():
-                    Stock.objects.create(storecode=store, JAN=instance, quantity=0)
+    if created and not stock_provisioning_deferred():
+        provision_stocks(jan_codes=[instance.JAN])
 
 
 # 店舗が追加されたら、全商品分の在庫リストを作成
 @receiver(post_save, sender=Store)
 def create_stock_for_new_store(sender, instance, created, **kwargs):
-    if created:
-        with transaction.atomic():
-            products = Product.objects.all()
-            for product in products:
-                # StorecodeとJANの組み合わせが存在しない場合にのみ作成
-                if not Stock.objects.filter(storecode=instance, JAN=product).exists():
-                    Stock.objects.create(storecode=instance, JAN=product, quantity=0)
+    if created and not stock_provisioning_deferred():
+        provision_stocks(storecodes=[instance.storecode])
+
+
+# 商品が変更・削除されたら、商品キャッシュから該当JANを破棄
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_catalog_cache(sender, instance, **kwargs):
+    catalog_cache.invalidate(instance.JAN)
+
+
+# 商品・クーポンの登録・更新・削除を変更履歴に記録 (差分同期API用)
+@receiver(post_save, sender=Product)
+def record_product_upsert(sender, instance, **kwargs):
+    record_catalog_changes("product", [instance.JAN])
+
+
+@receiver(post_delete, sender=Product)
+def record_product_delete(sender, instance, **kwargs):
+    record_catalog_changes("product", [instance.JAN], operation="delete")
+
+
+@receiver(post_save, sender=Coupon)
+def record_coupon_upsert(sender, instance, **kwargs):
+    record_catalog_changes("coupon", [instance.code])
+
+
+@receiver(post_delete, sender=Coupon)
+def record_coupon_delete(sender, instance, **kwargs):
+    record_catalog_changes("coupon", [instance.code], operation="delete")
+
+
+# クーポンの組み合わせJANが変更された場合もクーポンの更新として記録
+@receiver(m2m_changed, sender=Coupon.combo_product_jans.through)
+def record_coupon_combo_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == "pre_clear":
+        # 商品側からのclearではpost_clearにpk_setが渡されないため、削除前に対象のクーポンを控えておく
+        instance._cleared_combo_coupons = list(instance.combo_coupons.values_list("code", flat=True))
+    elif reverse and action == "post_clear":
+        record_catalog_changes("coupon", instance.__dict__.pop("_cleared_combo_coupons", []))
+    elif action in ("post_add", "post_remove", "post_clear"):
+        record_catalog_changes("coupon", (pk_set or []) if reverse else [instance.code])
+
+
+# クーポンが変更・削除されたら、コンパイル済みのクーポン索引を破棄
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+@receiver(m2m_changed, sender=Coupon.combo_product_jans.through)
+def invalidate_coupon_index(sender, **kwargs):
+    coupon_index.invalidate()
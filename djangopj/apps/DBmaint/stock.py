@@ -0,0 +1,405 @@
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, Count, F, IntegerField, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from simple_history.utils import bulk_create_with_history
+from .models import Product, Stock, StockMovement, Store
+
+_provisioning = threading.local()
+
+
+def lock_stocks(queryset):
+    """
+    在庫行をpkの順で行ロックして取得する
+    ロック順序を固定することで、在庫行を直接変更する処理 (在庫数の指定・集約) 同士のデッドロックを防ぐ
+    更新するのは在庫数だけのため FOR NO KEY UPDATE でロックし、入出庫の追記 (外部キーの FOR KEY SHARE) を待たせない
+    """
+    return list(queryset.select_for_update(no_key=True).order_by("pk"))
+
+
+def pending_movements(stock_ref):
+    """
+    stock_refで指定した在庫行の、スナップショットに未集約の入出庫の合計を返すサブクエリ
+    """
+    pending = (
+        StockMovement.objects.filter(stock=stock_ref, compacted=False)
+        .order_by()
+        .values("stock")
+        .annotate(total=Sum("quantity"))
+        .values("total")
+    )
+    return Coalesce(Subquery(pending, output_field=IntegerField()), 0)
+
+
+def with_current_quantity(queryset):
+    """
+    在庫の querysetに、スナップショットの在庫数と未集約の入出庫から求めた現在の在庫数 (current_quantity) を付与する
+    1回のクエリで求めるため、集約と同時に実行されても二重に数えることはない
+    """
+    return queryset.annotate(current_quantity=F("quantity") + pending_movements(OuterRef("pk")))
+
+
+def product_stock_total():
+    """
+    商品のquerysetに付与する、全店舗の現在の在庫数の合計
+    """
+    pending = (
+        StockMovement.objects.filter(stock__JAN=OuterRef("JAN"), compacted=False)
+        .order_by()
+        .values("stock__JAN")
+        .annotate(total=Sum("quantity"))
+        .values("total")
+    )
+    return Sum("stock__quantity") + Coalesce(Subquery(pending, output_field=IntegerField()), 0)
+
+
+def _stock_list_version_fields(stocks):
+    """
+    stock_list_versionの集計式
+    """
+    pending = (
+        StockMovement.objects.filter(stock__in=stocks.order_by().values("pk"), compacted=False)
+        .order_by()
+        .values("compacted")
+    )
+    return {
+        "count": Count("pk"),
+        "max_pk": Max("pk"),
+        "total": Sum("quantity"),
+        # 在庫行によらない値のため、集計関数で包んで1回の集計に含める
+        "pending_count": Max(Subquery(pending.annotate(n=Count("pk")).values("n"), output_field=IntegerField())),
+        "pending_total": Max(Subquery(pending.annotate(n=Sum("quantity")).values("n"), output_field=IntegerField())),
+    }
+
+
+def stock_list_version(stocks):
+    """
+    在庫のquerysetの一覧 (現在の在庫数を含む) が変わると必ず変わる値を返す (一覧のETagに使う)
+    在庫行の件数・最大のpk・スナップショットの合計と、対象の在庫行の未集約の入出庫の件数・合計を1回の集計で求める
+    入出庫のidは採番順でコミット順ではないため使わない (後からコミットされた小さいidの入出庫でも件数が変わる)
+    入出庫の集約はスナップショットへの加算と集約済みへの変更を同じトランザクションで行うため、集約でも値が変わる
+    """
+    version = stocks.order_by().aggregate(**_stock_list_version_fields(stocks))
+    return "{count}:{max_pk}:{total}:{pending_count}:{pending_total}".format(**version)
+
+
+async def astock_list_version(stocks):
+    """
+    stock_list_versionの非同期版
+    """
+    version = await stocks.order_by().aaggregate(**_stock_list_version_fields(stocks))
+    return "{count}:{max_pk}:{total}:{pending_count}:{pending_total}".format(**version)
+
+
+def current_quantities(stock_ids):
+    """
+    {在庫のpk: 現在の在庫数} を返す
+    """
+    return dict(with_current_quantity(Stock.objects.filter(pk__in=stock_ids)).values_list("pk", "current_quantity"))
+
+
+def record_movements(movements, user=None):
+    """
+    入出庫を在庫行を更新せずに台帳へ1回のINSERTでまとめて追記する
+    movements は (店番, JAN, 増減数, 種別, 発生元) のリスト
+    在庫行が存在しない (店番, JAN) があれば何も記録せず、その組み合わせのリストを返す
+    在庫行をロックしないため、同じ商品を扱う並行チェックアウト同士が待ち合わせることはない
+    入出庫は在庫のpkの順で追記し、外部キーのロックを在庫行のロック (lock_stocks) と同じ順序で取る
+    """
+    movements = [(str(storecode), jan_code, *rest) for storecode, jan_code, *rest in movements]
+    pairs = {(storecode, jan_code) for storecode, jan_code, *_ in movements}
+    if not pairs:
+        return []
+    stock_ids = {
+        (storecode, jan_code): pk
+        for storecode, jan_code, pk in Stock.objects.filter(
+            storecode__in={storecode for storecode, _ in pairs}, JAN__in={jan_code for _, jan_code in pairs}
+        ).values_list("storecode_id", "JAN_id", "pk")
+    }
+    missing = sorted(pairs - set(stock_ids))
+    if missing:
+        return missing
+
+    StockMovement.objects.bulk_create(
+        [
+            StockMovement(
+                stock_id=stock_ids[(storecode, jan_code)],
+                quantity=quantity,
+                kind=kind,
+                reference=reference,
+                user=user,
+            )
+            for storecode, jan_code, quantity, kind, reference in sorted(
+                movements, key=lambda movement: stock_ids[(movement[0], movement[1])]
+            )
+            if quantity
+        ],
+        batch_size=5000,
+    )
+    return []
+
+
+def apply_stock_deltas(storecode, deltas, kind="sale", reference=""):
+    """
+    店舗内の複数JANの在庫数の増減を入出庫台帳にまとめて記録する
+    deltas は {JAN: 増減数} の辞書
+    在庫行が存在しないJANがあれば何も記録せず、そのJANのリストを返す
+    """
+    missing = record_movements([(storecode, jan_code, delta, kind, reference) for jan_code, delta in deltas.items()])
+    return [jan_code for _, jan_code in missing]
+
+
+def transfer_stock(jan_code, from_storecode, to_storecode, quantity, reference="", user=None):
+    """
+    店舗間で在庫を移動する (移動元の出庫と移動先の入庫を同じ発生元で記録する)
+    在庫行が存在しない (店番, JAN) のリストを返す
+    """
+    return record_movements(
+        [
+            (from_storecode, jan_code, -quantity, "transfer", reference),
+            (to_storecode, jan_code, quantity, "transfer", reference),
+        ],
+        user=user,
+    )
+
+
+def set_stock_quantities(targets, kind="adjustment", reference="", user=None):
+    """
+    在庫数を指定した値にするための入出庫を記録し、記録した入出庫のリストを返す
+    targets は {在庫のpk: 在庫数} の辞書
+    在庫行をロックしてから現在の在庫数を読み直すことで、同じ在庫への在庫数の指定や集約と競合しないようにする
+    トランザクション内で呼び出すこと
+    """
+    stocks = lock_stocks(Stock.objects.filter(pk__in=list(targets)))
+    current = current_quantities([stock.pk for stock in stocks])
+    movements = [
+        StockMovement(
+            stock_id=stock.pk,
+            quantity=targets[stock.pk] - current[stock.pk],
+            kind=kind,
+            reference=reference,
+            user=user,
+        )
+        for stock in stocks
+        if targets[stock.pk] != current[stock.pk]
+    ]
+    return StockMovement.objects.bulk_create(movements, batch_size=5000)
+
+
+def compact_stock_movements(batch_size=10000, history_user=None, progress=None):
+    """
+    未集約の入出庫を在庫行の在庫数 (スナップショット) に畳み込み、(集約した入出庫数, 更新した在庫行数) を返す
+    batch_size件の入出庫ごとに1回のトランザクションで、在庫行の加算と入出庫の集約済みへの変更を行う
+    コミット済みの入出庫だけが対象になるため、実行中の販売で追記された入出庫は次回以降に集約される
+    """
+    compacted = updated = 0
+    while True:
+        with transaction.atomic():
+            # 他の集約処理が処理中の入出庫は飛ばす
+            rows = list(
+                StockMovement.objects.filter(compacted=False)
+                .order_by("pk")
+                .select_for_update(skip_locked=True)
+                .values_list("pk", "stock_id", "quantity")[:batch_size]
+            )
+            if not rows:
+                break
+            totals = {}
+            for _, stock_id, quantity in rows:
+                totals[stock_id] = totals.get(stock_id, 0) + quantity
+
+            stocks = lock_stocks(Stock.objects.filter(pk__in=list(totals)))
+            Stock.objects.filter(pk__in=[stock.pk for stock in stocks]).update(
+                quantity=F("quantity")
+                + Case(
+                    *[When(pk=stock.pk, then=Value(totals[stock.pk])) for stock in stocks],
+                    output_field=IntegerField(),
+                )
+            )
+            StockMovement.objects.filter(pk__in=[pk for pk, _, _ in rows]).update(compacted=True)
+
+            # 行ロック中なので、取得した在庫数に合計を足した値が更新後の値と一致する
+            for stock in stocks:
+                stock.quantity += totals[stock.pk]
+            Stock.history.bulk_history_create(
+                stocks, update=True, default_user=history_user, default_change_reason="入出庫の集約"
+            )
+        compacted += len(rows)
+        updated += len(stocks)
+        if progress:
+            progress(compacted, updated)
+    return compacted, updated
+
+
+def provision_stocks(storecodes=None, jan_codes=None, history_user=None):
+    """
+    存在しない (店番, JAN) の在庫行を在庫数0でまとめて作成し、作成した行数を返す
+    storecodes・jan_codes を省略した場合は全店舗・全商品が対象
+    PostgreSQLでは在庫行と変更履歴を1回のINSERT ... SELECT (ON CONFLICT DO NOTHING) で作成する
+    """
+    if storecodes is not None:
+        storecodes = list(storecodes)
+        if not storecodes:
+            return 0
+    if jan_codes is not None:
+        jan_codes = list(jan_codes)
+        if not jan_codes:
+            return 0
+
+    if connection.vendor == "postgresql":
+        return _upsert_stocks_postgresql(storecodes, jan_codes, history_user)
+
+    with transaction.atomic():
+        missing = _missing_stocks(storecodes, jan_codes)
+        bulk_create_with_history(missing, Stock, batch_size=5000, default_user=history_user)
+    return len(missing)
+
+
+def regenerate_stocks(jan_codes, history_user=None, chunk_size=None, progress=None):
+    """
+    指定した商品の在庫を全店舗分、在庫数0で作り直し、(作成した行数, リセットした行数) を返す
+    商品をchunk_size行 (商品数×店舗数) ごとに区切り、区切りごとに1回のトランザクションで
+    存在しない在庫行の一括作成と、既存の在庫を0にする入出庫の記録を行う
+    progressを指定した場合は区切りごとに (処理済みの商品数, 商品数, 作成した行数, リセットした行数) で呼び出す
+    """
+    jan_codes = list(dict.fromkeys(jan_codes))
+    chunk_size = chunk_size or getattr(settings, "STOCK_UPSERT_CHUNK_SIZE", 5000)
+    products_per_chunk = max(1, chunk_size // max(1, Store.objects.count()))
+    created = reset = 0
+    for start in range(0, len(jan_codes), products_per_chunk):
+        chunk = jan_codes[start:start + products_per_chunk]
+        with transaction.atomic():
+            if connection.vendor == "postgresql":
+                chunk_created = _upsert_stocks_postgresql(None, chunk, history_user)
+            else:
+                missing = _missing_stocks(None, chunk)
+                bulk_create_with_history(missing, Stock, batch_size=5000, default_user=history_user)
+                chunk_created = len(missing)
+            # 既存の在庫は入出庫 (在庫調整) を記録して在庫数を0にする
+            chunk_reset = len(
+                set_stock_quantities(
+                    dict.fromkeys(Stock.objects.filter(JAN__in=chunk).values_list("pk", flat=True), 0),
+                    reference="在庫の再生成",
+                    user=history_user,
+                )
+            )
+        created += chunk_created
+        reset += chunk_reset
+        if progress:
+            progress(start + len(chunk), len(jan_codes), created, reset)
+    return created, reset
+
+
+def _missing_stocks(storecodes, jan_codes):
+    stores = Store.objects.all()
+    products = Product.objects.all()
+    stocks = Stock.objects.all()
+    if storecodes is not None:
+        stores, stocks = stores.filter(storecode__in=storecodes), stocks.filter(storecode__in=storecodes)
+    if jan_codes is not None:
+        products, stocks = products.filter(JAN__in=jan_codes), stocks.filter(JAN__in=jan_codes)
+    existing = set(stocks.values_list("storecode_id", "JAN_id"))
+    return [
+        Stock(storecode_id=storecode, JAN_id=jan_code, quantity=0)
+        for storecode in stores.values_list("storecode", flat=True)
+        for jan_code in products.values_list("JAN", flat=True).iterator()
+        if (storecode, jan_code) not in existing
+    ]
+
+
+def _upsert_stocks_postgresql(storecodes, jan_codes, history_user):
+    """
+    存在しない在庫行と変更履歴を1回のINSERT ... SELECT (ON CONFLICT DO NOTHING) で作成し、作成した行数を返す
+    """
+    qn = connection.ops.quote_name
+    stock_table = qn(Stock._meta.db_table)
+    history_table = qn(Stock.history.model._meta.db_table)
+    store_column = qn(Stock._meta.get_field("storecode").column)
+    jan_column = qn(Stock._meta.get_field("JAN").column)
+
+    conditions, params = [], []
+    if storecodes is not None:
+        conditions.append(f"s.{qn('storecode')} = ANY(%s)")
+        params.append(storecodes)
+    if jan_codes is not None:
+        conditions.append(f"p.{qn('JAN')} = ANY(%s)")
+        params.append(jan_codes)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sql = f"""
+        WITH upserted AS (
+            INSERT INTO {stock_table} ({store_column}, {jan_column}, {qn("quantity")})
+            SELECT s.{qn("storecode")}, p.{qn("JAN")}, 0
+            FROM {qn(Store._meta.db_table)} s CROSS JOIN {qn(Product._meta.db_table)} p
+            {where}
+            ON CONFLICT ({store_column}, {jan_column}) DO NOTHING
+            RETURNING {qn("id")}, {store_column}, {jan_column}, {qn("quantity")}
+        ), history AS (
+            INSERT INTO {history_table} (
+                {qn("id")}, {store_column}, {jan_column}, {qn("quantity")},
+                {qn("history_date")}, {qn("history_type")}, {qn("history_user_id")}
+            )
+            SELECT {qn("id")}, {store_column}, {jan_column}, {qn("quantity")}, %s, '+', %s
+            FROM upserted
+        )
+        SELECT count(*) FROM upserted
+    """
+    params.extend([timezone.now(), history_user.pk if history_user else None])
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()[0]
+
+
+@contextmanager
+def deferred_stock_provisioning():
+    """
+    ブロック内では商品・店舗の追加時のシグナルで在庫行を作成しない
+    商品の一括インポートなどで、最後にprovision_stocksをまとめて1回呼び出すために使う
+    """
+    previous = getattr(_provisioning, "deferred", False)
+    _provisioning.deferred = True
+    try:
+        yield
+    finally:
+        _provisioning.deferred = previous
+
+
+def stock_provisioning_deferred():
+    return getattr(_provisioning, "deferred", False)
+
+
+def adjust_stocks(adjustments, mode="delta", history_user=None, change_reason=None, chunk_size=5000):
+    """
+    在庫数をまとめて変更する入出庫 (在庫調整) を記録し、記録した入出庫のリストを返す
+    adjustments は {在庫のpk: 値} の辞書
+    mode が "delta" の場合は在庫数に値を加算し、"set" の場合は在庫数を値に置き換える
+    在庫行は更新せず、変更内容は入出庫台帳に残る (発生元には変更理由、userには変更者を記録する)
+    在庫行の変更履歴 (simple_history) は作成しないため、在庫数の変更の監査には入出庫台帳を使う
+    """
+    if mode not in ("delta", "set"):
+        raise ValueError(f"mode には delta もしくは set を指定してください: {mode}")
+
+    reference = (change_reason or "")[:255]
+    items = list(adjustments.items())
+    recorded = []
+    with transaction.atomic():
+        for start in range(0, len(items), chunk_size):
+            chunk = dict(items[start:start + chunk_size])
+            if mode == "set":
+                recorded.extend(set_stock_quantities(chunk, reference=reference, user=history_user))
+                continue
+            stock_ids = Stock.objects.filter(pk__in=list(chunk)).order_by("pk").values_list("pk", flat=True)
+            recorded.extend(
+                StockMovement.objects.bulk_create(
+                    [
+                        StockMovement(
+                            stock_id=pk, quantity=chunk[pk], kind="adjustment", reference=reference, user=history_user
+                        )
+                        for pk in stock_ids
+                        if chunk[pk]
+                    ]
+                )
+            )
+    return recorded
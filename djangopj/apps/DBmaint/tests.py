@@ -1,3 +1,238 @@
-from django.test import TestCase
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from apps.user.models import CustomUser
+from .catalog_cache import catalog_cache
+from .db_router import read_from_replica, replica_alias, replica_monitor
+from .get_recept_data import load_receipt_transaction
+from .id_allocator import SQIDS, IdAllocator
+from .models import CatalogChange, Coupon, Product, Stock, Store, Transaction
 
-# Create your tests here.
+REPLICA = getattr(settings, "REPLICA_DATABASE_ALIAS", "replica")
+
+
+@skipUnless(REPLICA in settings.DATABASES, "レプリカのDBが設定されていません。")
+class ReplicaRouterTests(TransactionTestCase):
+    """
+    レプリカへの読み取りの振り分け
+    TestCaseはテスト全体をプライマリのトランザクションで囲み、読み取りが常にプライマリになるためTransactionTestCaseを使う
+    (テストではレプリカはdefaultのミラーになる)
+    """
+
+    # レプリカが設定されていない場合もテストの収集時に参照されるため、設定済みのDBに絞る
+    databases = {DEFAULT_DB_ALIAS, REPLICA} & set(settings.DATABASES)
+    jan = "4900000000001"
+
+    def setUp(self):
+        replica_monitor.reset()
+        self.addCleanup(replica_monitor.reset)
+        self.user = CustomUser.objects.create_superuser(staffcode=1234, password="password")
+        self.store = Store.objects.create(storecode="1", name="店舗1")
+        Product.objects.create(JAN=self.jan, name="商品1", price=100, tax=Decimal("10.00"))
+        Stock.objects.filter(storecode=self.store, JAN_id=self.jan).update(quantity=10)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def capture(self, func):
+        """
+        (プライマリのクエリ数, レプリカのクエリ数, funcの戻り値) を返す
+        """
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as primary:
+            with CaptureQueriesContext(connections[REPLICA]) as replica:
+                result = func()
+        return len(primary), len(replica), result
+
+    def test_opted_in_reads_use_replica(self):
+        # 遅延の確認 (プライマリのWALの位置の取得) を先に済ませておく
+        self.assertEqual(replica_alias(), REPLICA)
+        primary, replica, response = self.capture(lambda: self.client.get("/api/stocks/"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+        with read_from_replica():
+            primary, replica, count = self.capture(Product.objects.count)
+        self.assertEqual((primary, replica, count), (0, 1, 1))
+
+    def test_reads_without_opt_in_use_primary(self):
+        primary, replica, _ = self.capture(Product.objects.count)
+        self.assertEqual((primary, replica), (1, 0))
+
+    def test_writes_use_primary(self):
+        with read_from_replica():
+            primary, replica, _ = self.capture(
+                lambda: Product.objects.filter(JAN=self.jan).update(name="商品2")
+            )
+        self.assertEqual((primary, replica), (1, 0))
+
+        body = {
+            "storecode": "1",
+            "staffcode": 1234,
+            "deposit": 1000,
+            "sale_products": [{"JAN": self.jan, "points": 1}],
+        }
+        primary, replica, response = self.capture(lambda: self.client.post("/api/transactions/", body, format="json"))
+        self.assertEqual(response.status_code, 201)
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+    def test_reads_in_transaction_use_primary(self):
+        with transaction.atomic(), read_from_replica():
+            self.assertEqual(replica_alias(), DEFAULT_DB_ALIAS)
+            primary, replica, _ = self.capture(Product.objects.count)
+        self.assertEqual((primary, replica), (1, 0))
+
+    def test_receipt_reads_use_primary(self):
+        # 販売直後に読み直すレシートの取引はプライマリから取得する
+        sale = Transaction.objects.create(
+            sale_id="S001",
+            sale_date="2024-01-01T00:00:00+09:00",
+            storecode=self.store,
+            staffcode=self.user,
+            purchase_points=0,
+            tax_10_percent=0,
+            tax_8_percent=0,
+            tax_amount=0,
+            total_amount=0,
+            deposit=0,
+            change=0,
+        )
+        primary, replica, (loaded, _) = self.capture(lambda: load_receipt_transaction(sale.sale_id))
+        self.assertEqual(loaded.pk, sale.pk)
+        self.assertEqual(replica, 0)
+
+        primary, replica, response = self.capture(lambda: self.client.get("/api/transactions/"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica, 0)
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        with mock.patch.object(replica_monitor, "lag", return_value=replica_monitor.max_lag + 1):
+            primary, replica, response = self.capture(lambda: self.client.get("/api/stocks/"))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+    def test_replica_reads_skip_catalog_cache(self):
+        # レプリカから読み込んだ商品は、販売でも使う共有のキャッシュに入れない
+        catalog_cache.invalidate()
+        self.addCleanup(catalog_cache.invalidate)
+        self.assertEqual(replica_alias(), REPLICA)
+        with read_from_replica():
+            primary, replica, products = self.capture(lambda: catalog_cache.get_many([self.jan]))
+        self.assertEqual((primary, replica), (0, 1))
+        self.assertIn(self.jan, products)
+
+        primary, replica, products = self.capture(lambda: catalog_cache.get_many([self.jan]))
+        self.assertEqual((primary, replica), (1, 0))
+        self.assertIn(self.jan, products)
+        # プライマリから読み込んだ商品はキャッシュされ、レプリカへの読み取りでも使われる
+        with read_from_replica():
+            primary, replica, _ = self.capture(lambda: catalog_cache.get_many([self.jan]))
+        self.assertEqual((primary, replica), (0, 0))
+
+    def test_unreachable_replica_backs_off(self):
+        with mock.patch.object(replica_monitor, "lag", return_value=None) as lag:
+            self.assertEqual(replica_alias(), DEFAULT_DB_ALIAS)
+            # 接続できなかった後は、確認の間隔が過ぎるまで接続を試みない
+            self.assertEqual(replica_alias(), DEFAULT_DB_ALIAS)
+            self.assertEqual(lag.call_count, 1)
+
+        # 間隔が過ぎて遅延が閾値以内になれば、レプリカに戻す
+        replica_monitor.reset()
+        with mock.patch.object(replica_monitor, "lag", return_value=0):
+            self.assertEqual(replica_alias(), REPLICA)
+
+
+class CouponComboChangeTests(TestCase):
+    """
+    クーポンの組み合わせJANの変更の記録
+    """
+
+    def setUp(self):
+        self.product = Product.objects.create(JAN="4900000000011", name="商品1", price=100, tax=Decimal("10.00"))
+        self.coupons = [
+            Coupon.objects.create(
+                code=code, coupon_type="combo", expiration_date=timezone.now() + timedelta(days=1), discount_value=10
+            )
+            for code in ("COMBO1", "COMBO2")
+        ]
+        for coupon in self.coupons:
+            coupon.combo_product_jans.add(self.product)
+
+    def recorded(self, action):
+        latest = CatalogChange.objects.order_by("-id").values_list("id", flat=True).first() or 0
+        action()
+        return sorted(CatalogChange.objects.filter(id__gt=latest, kind="coupon").values_list("key", flat=True))
+
+    def test_clear_from_coupon(self):
+        self.assertEqual(self.recorded(self.coupons[0].combo_product_jans.clear), ["COMBO1"])
+
+    def test_clear_from_product(self):
+        # 商品側からのclearでは、組み合わせから外れた全てのクーポンを記録する
+        self.assertEqual(self.recorded(self.product.combo_coupons.clear), ["COMBO1", "COMBO2"])
+
+
+@skipUnless(connection.vendor == "postgresql", "シーケンスによる採番はPostgreSQLでのみ確認できます。")
+class IdAllocatorConcurrencyTests(TransactionTestCase):
+    """
+    複数のプロセスからの同時の採番
+    プロセスごとのIdAllocatorをスレッドで同時に動かし、スレッドごとに別の接続で採番する
+    """
+
+    storecode = "7"
+    workers = 4
+    per_worker = 20
+
+    def setUp(self):
+        # 最初の販売でのシーケンスの同時作成も確認するため、シーケンスがない状態から始める
+        with connection.cursor() as cursor:
+            for kind in ("sale", "return"):
+                cursor.execute(f'DROP SEQUENCE IF EXISTS "{kind}_id_seq_{self.storecode}"')
+
+    def allocate_concurrently(self, allocators):
+        barrier = threading.Barrier(len(allocators))
+        results, errors = [], []
+        now = timezone.now()
+
+        def work(allocator):
+            try:
+                barrier.wait()
+                ids = [allocator.allocate(self.storecode, now) for _ in range(self.per_worker)]
+                results.append((allocator.tag, ids))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=work, args=(allocator,)) for allocator in allocators]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def test_ids_are_unique_across_processes(self):
+        allocators = [IdAllocator("sale", 3) for _ in range(self.workers)]
+        allocators += [IdAllocator("return", 3, tag=2) for _ in range(self.workers)]
+        results = self.allocate_concurrently(allocators)
+
+        sale_ids = [sale_id for tag, ids in results if tag is None for sale_id in ids]
+        return_ids = [return_id for tag, ids in results if tag == 2 for return_id in ids]
+        self.assertEqual(len(sale_ids), self.workers * self.per_worker)
+        self.assertEqual(len(set(sale_ids)), len(sale_ids))
+        self.assertEqual(len(return_ids), self.workers * self.per_worker)
+        self.assertEqual(len(set(return_ids)), len(return_ids))
+
+        # 販売と返品は別のシーケンスのため同じ連番になるが、種別の値によってIDは衝突しない
+        sale_values = {tuple(SQIDS.decode(sale_id)) for sale_id in sale_ids}
+        return_values = {tuple(SQIDS.decode(return_id)[:3]) for return_id in return_ids}
+        self.assertTrue(sale_values & return_values)
+        self.assertFalse(set(sale_ids) & set(return_ids))
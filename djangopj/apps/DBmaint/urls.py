@@ -5,4 +5,9 @@ from django.http import HttpResponse
 urlpatterns = [
     path('filter_products/', views.filter_products, name='filter_products'),
     path('admin/transactions/<str:sale_id>/receipt/', views.generate_receipt_view, name='generate_receipt_view'),
+    path(
+        'async/admin/transactions/<str:sale_id>/receipt/',
+        views.generate_receipt_async_view,
+        name='generate_receipt_async_view',
+    ),
 ]
@@ -1,15 +1,18 @@
-import requests
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import render
 from django.http import HttpResponse
-from .models import Product, Transaction
+from .models import Product
 from .forms import ItemFilterForm
+from .stock import product_stock_total
 from django.contrib.auth.decorators import login_required
-from .get_recept_data import generate_receipt_text
+from django.contrib.auth.views import redirect_to_login
+from asgiref.sync import sync_to_async
+from .get_recept_data import aload_receipt_transaction, generate_receipt_text, load_receipt_transaction
+from .receipt_client import ReceiptServiceError, async_receipt_client, receipt_client
 
 
 def filter_products(request):
     products = Product.objects.all()
-    products = products.annotate(total_stock=Sum("stock__quantity"))
+    products = products.annotate(total_stock=product_stock_total())
     form = ItemFilterForm(request.GET or None)
 
     if form.is_valid() and request.GET:
@@ -30,21 +33,33 @@ def filter_products(request):
 
 @login_required
 def generate_receipt_view(request, sale_id):
+    def build_text():
+        # キャッシュにない場合だけ取引を取得してレシートテキストを生成する
+        transaction, sale_products = load_receipt_transaction(sale_id)
+        return generate_receipt_text(transaction, sale_products)
+
+    try:
+        html_content = receipt_client.render(sale_id, build_text)
+    except ReceiptServiceError:
+        return HttpResponse("Failed to generate receipt.", content_type="text/plain", status=503)
+    return HttpResponse(html_content, content_type="text/html; charset=utf-8")
+
+
+async def generate_receipt_async_view(request, sale_id):
+    """
+    generate_receipt_viewの非同期版
+    取引の取得は非同期ORMで、レシートサービスの呼び出しはhttpxで行い、待ち時間にワーカーを占有しない
+    販売直後に表示されるため、レプリカではなくプライマリから読み込む
+    """
+    if not await sync_to_async(lambda: request.user.is_authenticated)():
+        return redirect_to_login(request.get_full_path())
+
+    async def build_text():
+        transaction, sale_products = await aload_receipt_transaction(sale_id)
+        return generate_receipt_text(transaction, sale_products)
+
     try:
-        # Transactionオブジェクトの取得
-        transaction = get_object_or_404(Transaction, sale_id=sale_id)
-
-        # レシートテキストの生成をサービス層に委譲
-        receipt_text = generate_receipt_text(transaction)
-
-        # レシートデータをPOSTリクエストで送信
-        response = requests.post("http://receipt:6573/generate", data={"text": receipt_text})
-        if response.status_code == 200:
-            # HTMLコンテンツを取得してそのままレスポンスとして返す
-            html_content = response.text
-            return HttpResponse(html_content, content_type="text/html; charset=utf-8")
-        else:
-            return HttpResponse("Failed to generate receipt.", content_type="text/plain")
-
-    except Transaction.DoesNotExist:
-        return HttpResponse("Transaction not found.", content_type="text/plain")
\ No newline at end of file
+        html_content = await async_receipt_client.render(sale_id, build_text)
+    except ReceiptServiceError:
+        return HttpResponse("Failed to generate receipt.", content_type="text/plain", status=503)
+    return HttpResponse(html_content, content_type="text/html; charset=utf-8")
@@ -0,0 +1,170 @@
+"""
+商品・在庫の読み取りAPIの非同期版 (ASGIサーバーで実行する)
+レスポンスの形式・絞り込み・ETagは同期版のItemReadOnlyViewSet・StockViewSetと同じ
+DRFのViewSetは非同期に対応していないため、Djangoの非同期ビューとして実装する
+"""
+import hashlib
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponseNotAllowed, JsonResponse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from rest_framework_api_key.permissions import HasAPIKey
+from apps.DBmaint.catalog_cache import catalog_cache
+from apps.DBmaint.catalog_changes import alatest_catalog_change, catalog_etag_source
+from apps.DBmaint.db_router import read_from_replica
+from apps.DBmaint.models import Product, Stock
+from apps.DBmaint.stock import astock_list_version, with_current_quantity
+
+PAGE_SIZE = settings.REST_FRAMEWORK.get("PAGE_SIZE", 50)
+ITEM_LOOKUP_MAX_JANS = getattr(settings, "ITEM_LOOKUP_MAX_JANS", 5000)
+PRODUCT_FIELDS = ("JAN", "name", "price", "tax")
+
+
+def _is_authorized(request):
+    return HasAPIKey().has_permission(request, None) or request.user.is_authenticated
+
+
+async def is_authorized(request):
+    """
+    APIキーもしくはログイン中のユーザーのリクエストかどうか (同期版の HasAPIKey | IsAuthenticated)
+    """
+    return await sync_to_async(_is_authorized)(request)
+
+
+def json_response(data, status=200):
+    # Decimalは同期版 (DRF) と同じく文字列で返す
+    return JsonResponse(data, status=status, encoder=DjangoJSONEncoder, safe=False, json_dumps_params={"ensure_ascii": False})
+
+
+async def check_request(request):
+    """
+    GET以外のメソッド・認証されていないリクエストに対するエラーのレスポンスを返す (問題がなければNone)
+    Django 4.2のrequire_GETなどのデコレーターは非同期ビューに対応していないため、ここで確認する
+    """
+    if request.method not in ("GET", "HEAD"):
+        return HttpResponseNotAllowed(["GET", "HEAD"])
+    if not await is_authorized(request):
+        return json_response({"detail": "認証情報が含まれていません。"}, status=403)
+    return None
+
+
+def conditional(request, source, last_modified=None):
+    """
+    (304のレスポンスもしくはNone, ETag, Last-Modified) を返す (同期版のConditionalListMixinと同じ算出方法)
+    """
+    etag = quote_etag(hashlib.md5(f"{request.get_full_path()}|{source}".encode()).hexdigest())
+    last_modified = int(last_modified.timestamp()) if last_modified else None
+    return get_conditional_response(request, etag=etag, last_modified=last_modified), etag, last_modified
+
+
+def with_validators(response, etag, last_modified):
+    if response.status_code == 200:
+        response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+async def paginate(request, queryset, serialize):
+    """
+    LimitOffsetPaginationと同じ形式で1ページ分を返す
+    """
+    try:
+        limit = int(request.GET.get("limit", PAGE_SIZE))
+        offset = max(int(request.GET.get("offset", 0)), 0)
+    except ValueError:
+        limit, offset = PAGE_SIZE, 0
+    if limit <= 0:
+        limit = PAGE_SIZE
+    count = await queryset.acount()
+    results = [serialize(row) async for row in queryset[offset:offset + limit]]
+
+    url = request.build_absolute_uri()
+    next_url = previous_url = None
+    if offset + limit < count:
+        next_url = replace_query_param(replace_query_param(url, "limit", limit), "offset", offset + limit)
+    if offset > 0:
+        previous_url = replace_query_param(url, "limit", limit)
+        if offset - limit > 0:
+            previous_url = replace_query_param(previous_url, "offset", offset - limit)
+        else:
+            previous_url = remove_query_param(previous_url, "offset")
+    return {"count": count, "next": next_url, "previous": previous_url, "results": results}
+
+
+def serialize_product(product):
+    return {field: getattr(product, field) for field in PRODUCT_FIELDS}
+
+
+async def item_list(request):
+    """
+    ItemReadOnlyViewSet.list の非同期版
+    """
+    error = await check_request(request)
+    if error is not None:
+        return error
+
+    with read_from_replica():
+        latest = await alatest_catalog_change()
+        # 商品キャッシュを最新の変更バージョンに追従させてから返す (同期版と同じ)
+        await catalog_cache.async_sync(latest["version"])
+        not_modified, etag, last_modified = conditional(request, catalog_etag_source(latest), latest["changed_at"])
+        if not_modified is not None:
+            return not_modified
+
+        jan = request.GET.get("jan")
+        if jan and "," in jan:
+            jan_codes = list(dict.fromkeys(code.strip() for code in jan.split(",") if code.strip()))
+            if len(jan_codes) > ITEM_LOOKUP_MAX_JANS:
+                return json_response({"Error": f"一度に検索できるJANコードは{ITEM_LOOKUP_MAX_JANS}件までです。"}, status=400)
+            products = await catalog_cache.aget_many(jan_codes)
+            data = {
+                "found": [serialize_product(products[code]) for code in jan_codes if code in products],
+                "missing": [code for code in jan_codes if code not in products],
+            }
+        elif jan:
+            product = await catalog_cache.aget(jan)
+            if product is None:
+                return json_response({"Error": "指定したJANコードに合致する製品が見つかりません。"}, status=404)
+            # JANコード指定時は商品キャッシュから返す
+            data = {"count": 1, "next": None, "previous": None, "results": [serialize_product(product)]}
+        else:
+            data = await paginate(request, Product.objects.order_by("pk").only(*PRODUCT_FIELDS), serialize_product)
+            if not data["count"]:
+                return json_response({"Error": "指定したJANコードに合致する製品が見つかりません。"}, status=404)
+    return with_validators(json_response(data), etag, last_modified)
+
+
+async def stock_list(request):
+    """
+    StockViewSet.list の非同期版 (現在の在庫数はスナップショットと未集約の入出庫から求める)
+    """
+    error = await check_request(request)
+    if error is not None:
+        return error
+
+    stocks = Stock.objects.all()
+    jan_code = request.GET.get("jan")
+    store_code = request.GET.get("storecode")
+    if jan_code:
+        stocks = stocks.filter(JAN=jan_code)
+    if store_code:
+        stocks = stocks.filter(storecode=store_code)
+    rows = with_current_quantity(stocks).order_by("pk").values("pk", "storecode_id", "JAN_id", "current_quantity")
+
+    with read_from_replica():
+        not_modified, etag, last_modified = conditional(request, await astock_list_version(stocks))
+        if not_modified is not None:
+            return not_modified
+
+        data = await paginate(
+            request,
+            rows,
+            lambda row: {"storecode": row["storecode_id"], "JAN": row["JAN_id"], "quantity": row["current_quantity"]},
+        )
+    if not data["count"]:
+        return json_response({"Error": "指定した店舗コードまたはJANに合致する在庫が見つかりません。"}, status=404)
+    return with_validators(json_response(data), etag, last_modified)
@@ -0,0 +1,62 @@
+import functools
+import hashlib
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from rest_framework import status
+from rest_framework.response import Response
+from apps.DBmaint.models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+
+def request_fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.sha256(f"{request.method}:{request.path}:{body}".encode()).hexdigest()
+
+
+def idempotent(view_method):
+    """
+    ViewSetのcreateに付与し、Idempotency-Keyヘッダーによる再送時の二重登録を防ぐ
+    - 初回のリクエストはキーの行を作成し、同じトランザクション内で処理と結果の保存を行う
+    - 同じキーの並行リクエストはキーの一意制約で初回のコミットまで待機し、保存済みのレスポンスを返す
+    - 処理が失敗した場合(2xx以外)はキーの行ごとロールバックし、同じキーで再試行できるようにする
+    """
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > 255:
+            return Response(
+                {"Error": f"{IDEMPOTENCY_HEADER}は255文字以内で指定してください。"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        scope = getattr(self, "basename", None) or request.path
+        fingerprint = request_fingerprint(request)
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    record = IdempotencyKey.objects.create(key=key, scope=scope, request_hash=fingerprint)
+            except IntegrityError:
+                record = IdempotencyKey.objects.select_for_update().get(key=key, scope=scope)
+                if record.request_hash != fingerprint:
+                    return Response(
+                        {"Error": f"同じ{IDEMPOTENCY_HEADER}で異なる内容のリクエストが送信されました。"},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    )
+                return Response(record.response_body, status=record.status_code, headers={"Idempotent-Replayed": "true"})
+
+            response = view_method(self, request, *args, **kwargs)
+            if not status.is_success(response.status_code):
+                transaction.set_rollback(True)
+                return response
+
+            record.status_code = response.status_code
+            record.response_body = response.data
+            record.save(update_fields=["status_code", "response_body"])
+        return response
+
+    return wrapper
+
@@ -0,0 +1,131 @@
+from base64 import b64decode, b64encode
+from datetime import timedelta
+from urllib import parse
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    (日時, id) によるキーセット (カーソル) ページネーション
+    前のページの最後の行より後ろを複合インデックスで読むため、件数 (COUNT) もOFFSETも使わず、何ページ目でも同じコストで取得できる
+
+    既定では新しい順に返す。order=asc の場合は古い順に返し、最後のページでもnextを返すため、
+    nextをポーリングすると以降に登録された取引を取得できる (日時が過去のオフライン取引は対象外)
+
+    取引の日時はコミット前に決まるため、日時の順とコミットの順は一致しない
+    (先に日時を決めた取引が後からコミットされると、カーソルより前に現れて読み飛ばされる)。
+    そのため古い順では、日時がKEYSET_TAIL_SETTLE_SECONDS秒より前の (コミット済みとみなせる) 取引だけを返し、
+    カーソルは確定した範囲の中だけを進める。直近の取引は、その秒数だけ遅れてポーリングの結果に現れる
+    """
+    date_field = None
+    page_size = settings.REST_FRAMEWORK.get("PAGE_SIZE", 50)
+    max_page_size = 1000
+    cursor_query_param = "cursor"
+    page_size_query_param = "limit"
+    order_query_param = "order"
+    invalid_cursor_message = "カーソルが不正です。"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.ascending = request.query_params.get(self.order_query_param) == "asc"
+        self.cursor = self.decode_cursor(request)
+
+        # previousのカーソルは逆向きに読み、取得後に並べ直す
+        reverse = self.cursor is not None and self.cursor[2]
+        forward = self.ascending != reverse
+        if self.cursor is not None:
+            queryset = queryset.filter(self.after(self.cursor[0], self.cursor[1], forward))
+        if self.ascending:
+            settle_seconds = getattr(settings, "KEYSET_TAIL_SETTLE_SECONDS", 10)
+            queryset = queryset.filter(**{f"{self.date_field}__lte": timezone.now() - timedelta(seconds=settle_seconds)})
+        if forward:
+            queryset = queryset.order_by(self.date_field, "id")
+        else:
+            queryset = queryset.order_by(f"-{self.date_field}", "-id")
+
+        # 1件多く読み、次のページがあるかどうかを判定する
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "previous": self.get_previous_link(), "results": data})
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(page_size, self.max_page_size) if page_size > 0 else self.page_size
+
+    def after(self, date, pk, ascending):
+        """
+        (日時, id) が指定した位置より後ろの行の条件
+        日時の範囲条件を先頭に置き、複合インデックスの範囲検索にする
+        """
+        if ascending:
+            return Q(**{f"{self.date_field}__gte": date}) & (Q(**{f"{self.date_field}__gt": date}) | Q(id__gt=pk))
+        return Q(**{f"{self.date_field}__lte": date}) & (Q(**{f"{self.date_field}__lt": date}) | Q(id__lt=pk))
+
+    def get_next_link(self):
+        if self.page and (self.has_next or self.ascending):
+            return self.encode_cursor(self.page[-1], reverse=False)
+        if self.cursor is not None and self.cursor[2]:
+            # 逆向きに読んで先頭まで戻った場合は、最初のページがそのまま次のページになる
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        if self.ascending and self.cursor is not None:
+            # 古い順の最後のページは、新しい取引が登録されるまで同じカーソルを返す
+            return self.base_url
+        return None
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def encode_cursor(self, row, reverse):
+        tokens = {"d": getattr(row, self.date_field).isoformat(), "i": row.pk}
+        if reverse:
+            tokens["r"] = "1"
+        encoded = b64encode(parse.urlencode(tokens, doseq=True).encode("ascii")).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def decode_cursor(self, request):
+        """
+        (日時, id, 逆向きかどうか) を返す (カーソルが指定されていない場合はNone)
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            tokens = parse.parse_qs(b64decode(encoded.encode("ascii")).decode("ascii"), keep_blank_values=True)
+            date = parse_datetime(tokens["d"][0])
+            pk = int(tokens["i"][0])
+            reverse = tokens.get("r", ["0"])[0] == "1"
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if date is None:
+            raise NotFound(self.invalid_cursor_message)
+        return date, pk, reverse
+
+
+class TransactionPagination(KeysetPagination):
+    date_field = "sale_date"
+
+
+class ReturnTransactionPagination(KeysetPagination):
+    date_field = "return_date"
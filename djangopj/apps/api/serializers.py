@@ -1,10 +1,17 @@
 from rest_framework import serializers
-from apps.DBmaint.models import Product, Stock, Transaction, SaleProduct, ReturnProduct, ReturnTransaction, Coupon
+from apps.DBmaint.models import Product, Stock, Store, Transaction, SaleProduct, ReturnProduct, ReturnTransaction, Coupon
+from apps.user.models import CustomUser
+from django.conf import settings
 from django.utils import timezone
 from decimal import Decimal
 from django.db import transaction
-from sqids import Sqids
-from decimal import ROUND_HALF_DOWN, ROUND_HALF_UP
+from decimal import ROUND_HALF_DOWN
+from simple_history.utils import bulk_create_with_history
+from apps.DBmaint.stock import apply_stock_deltas, record_movements
+from apps.DBmaint.catalog_cache import catalog_cache
+from apps.DBmaint.coupon_engine import coupon_index
+from apps.DBmaint.id_allocator import sale_id_allocator, return_id_allocator
+from apps.DBmaint.sales_rollup import queue_rollup, return_rollup_rows, sale_rollup_rows
 
 
 # 商品のシリアライザー
@@ -16,25 +23,85 @@ class ProductSerializer(serializers.ModelSerializer):
 
 # 在庫のシリアライザー
 class StockSerializer(serializers.ModelSerializer):
+    # スナップショットに未集約の入出庫を足した現在の在庫数 (with_current_quantityで付与)
+    quantity = serializers.IntegerField(source="current_quantity", read_only=True)
+
     class Meta:
         model = Stock
         fields = ["storecode", "JAN", "quantity"]
 
 
+# クーポンのシリアライザー
+class CouponSerializer(serializers.ModelSerializer):
+    applicable_product_jan = serializers.SlugRelatedField(slug_field="JAN", read_only=True)
+    combo_product_jans = serializers.SlugRelatedField(slug_field="JAN", many=True, read_only=True)
+
+    class Meta:
+        model = Coupon
+        fields = [
+            "code",
+            "coupon_type",
+            "expiration_date",
+            "discount_value",
+            "discount_percentage",
+            "applicable_product_jan",
+            "combo_product_jans",
+            "min_quantity",
+        ]
+
+
 # 販売製品のシリアライザー
 class SaleProductSerializer(serializers.ModelSerializer):
+    # 商品テーブルを参照せず、保存済みのJANをそのまま返す
+    JAN = serializers.CharField(source="JAN_id", read_only=True)
+
     class Meta:
         model = SaleProduct
         fields = ["JAN", "name", "price", "tax", "points"]
         read_only_fields = ["name", "price", "tax"]
 
 
+# 販売商品の入力用シリアライザー
+# JANを文字列のまま受け取り、商品の解決は取引単位でまとめて行う
+class SaleProductInputSerializer(serializers.Serializer):
+    JAN = serializers.CharField(max_length=255)
+    points = serializers.IntegerField()
+
+
+# クーポン割引の共通処理
+class CouponDiscountMixin:
+    def get_coupon_index(self, coupon_codes):
+        """
+        指定したクーポンコードをDBから読み直した索引を返す
+        バリデーションで読み直したコードは、同じシリアライザーの金額計算でも再利用する
+        """
+        self._coupon_index = getattr(self, "_coupon_index", None) or coupon_index.get()
+        self._coupon_index = self._coupon_index.including(coupon_codes)
+        return self._coupon_index
+
+    def apply_discount(self, amount, coupon_codes, sale_products_data, index=None, now=None):
+        """
+        クーポンエンジンで複数のクーポンをまとめて判定し、(割引後の金額, 判定結果) を返す
+        indexを省略した場合はワーカー内のコンパイル済み索引を使い、nowを省略した場合は現在時刻で有効期限を判定する
+        """
+        quantities = {}
+        for sale_product in sale_products_data:
+            jan_code = str(sale_product["JAN"])
+            quantities[jan_code] = quantities.get(jan_code, 0) + sale_product["points"]
+        index = index or self.get_coupon_index(coupon_codes or ())
+        result = index.evaluate(amount, quantities, coupon_codes, now)
+        return amount - result.total, result
+
+
 # 取引のシリアライザー
-class TransactionSerializer(serializers.ModelSerializer):
-    sale_products = SaleProductSerializer(many=True, write_only=True)
+class TransactionSerializer(CouponDiscountMixin, serializers.ModelSerializer):
+    sale_products = SaleProductInputSerializer(many=True, write_only=True)
     sale_date = serializers.DateTimeField(read_only=True)
     saleproduct_set = SaleProductSerializer(many=True, read_only=True, source="sale_products")
     coupon_code = serializers.CharField(max_length=50, required=False, allow_blank=True)
+    coupon_codes = serializers.ListField(
+        child=serializers.CharField(max_length=13), required=False, write_only=True
+    )
     discount_amount = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
 
     class Meta:
@@ -55,6 +122,7 @@ class TransactionSerializer(serializers.ModelSerializer):
             "change",
             "saleproduct_set",
             "coupon_code",
+            "coupon_codes",
             "discount_amount",
         ]
         read_only_fields = [
@@ -75,6 +143,16 @@ class TransactionSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("預かり金は正の値である必要があります。")
         return value
 
+    def validate(self, data):
+        # 適用したクーポンコードはカンマ区切りで取引のcoupon_codeに保存するため、列の長さを超えないようにする
+        coupon_codes = dict.fromkeys(code for code in [data.get("coupon_code"), *data.get("coupon_codes", [])] if code)
+        max_length = Transaction._meta.get_field("coupon_code").max_length
+        if len(",".join(coupon_codes)) > max_length:
+            raise serializers.ValidationError(
+                {"coupon_codes": f"クーポンコードは合計{max_length}文字 (カンマ区切り) 以内で指定してください。"}
+            )
+        return data
+
     def validate_sale_products(self, value):
         if not value:
             raise serializers.ValidationError("少なくとも1つの商品を提供する必要があります。")
@@ -92,9 +170,11 @@ class TransactionSerializer(serializers.ModelSerializer):
             if points <= 0:
                 raise serializers.ValidationError("ポイントは正の値である必要があります。")
 
-            try:
-                product = Product.objects.get(JAN=jan_code)
-            except Product.DoesNotExist:
+        # バスケット内の商品は1回のクエリでまとめて取得する
+        products = self.get_products(product_map.keys())
+        for jan_code in product_map:
+            product = products.get(jan_code)
+            if product is None:
                 raise serializers.ValidationError(f"JANコード {jan_code} を持つ商品が存在しません。")
 
             if product.tax not in [Decimal("10.00"), Decimal("8.00")]:
@@ -102,103 +182,64 @@ class TransactionSerializer(serializers.ModelSerializer):
 
         return list(product_map.values())
 
+    def get_products(self, jan_codes):
+        """
+        JANコードをキーにした商品の辞書を返す
+        商品キャッシュを参照し、バリデーション時に取得した結果はcreateでも再利用する
+        """
+        jan_codes = set(jan_codes)
+        cached = getattr(self, "_products", {})
+        if not jan_codes.issubset(cached):
+            cached = {**cached, **catalog_cache.get_many(jan_codes - set(cached))}
+            self._products = cached
+        return cached
+
     def is_valid_coupon(self, coupon_code):
-        try:
-            coupon = Coupon.objects.get(code=coupon_code)
-            if coupon.expiration_date < timezone.now():
-                return False
-            return True
-        except Coupon.DoesNotExist:
-            return False
+        return self.get_coupon_index([coupon_code]).get(coupon_code) is not None
 
     def validate_coupon_code(self, value):
         if value and not self.is_valid_coupon(value):
             raise serializers.ValidationError("無効または期限切れのクーポンコードです。")
         return value
 
-    def apply_discount(self, amount, coupon, sale_products_data):
-        discount = 0
-
-        if coupon.coupon_type == "percent":
-            discount = (amount * coupon.discount_percentage / Decimal("100.0")).quantize(
-                Decimal("1"), rounding=ROUND_HALF_UP
-            )
-        elif coupon.coupon_type == "amount":
-            discount = coupon.discount_value
-        elif coupon.coupon_type == "product":
-            applicable_products = coupon.applicable_product_jan
-            for sale_product in sale_products_data:
-                if str(sale_product["JAN"]) == applicable_products.JAN:
-                    discount = coupon.discount_value
-                    break
-        elif coupon.coupon_type == "combo":
-            combo_products = coupon.combo_product_jans.all()
-            combo_jan_list = [product.JAN for product in combo_products]
-            sale_jan_list = [str(product["JAN"]) for product in sale_products_data]
-            if all(jan in sale_jan_list for jan in combo_jan_list):
-                discount = int(coupon.discount_value)
-        elif coupon.coupon_type == "multi":
-            applicable_product_jan = coupon.applicable_product_jan
-            total_quantity = sum(
-                [
-                    product["points"]
-                    for product in sale_products_data
-                    if str(product["JAN"]) == applicable_product_jan.JAN
-                ]
-            )
-            if total_quantity >= coupon.min_quantity:
-                discount_multiplier = total_quantity // coupon.min_quantity
-                discount = coupon.discount_value * discount_multiplier
-        return amount - discount, discount
-
-    def create_transaction_instance(self, validated_data, sale_id, current_time):
-        return Transaction.objects.create(
-            sale_date=current_time,
-            sale_id=sale_id,
-            purchase_points=0,
-            tax_10_percent=Decimal("0.00"),
-            tax_8_percent=Decimal("0.00"),
-            tax_amount=Decimal("0.00"),
-            total_amount=Decimal("0.00"),
-            change=Decimal("0.00"),
-            **validated_data,
-        )
-
-    def process_sale_product(self, sale_product_data, storecode, transaction_instance):
-        jan_code = sale_product_data["JAN"]
-        points = sale_product_data["points"]
-
-        try:
-            product = Product.objects.get(JAN=jan_code)
-        except Product.DoesNotExist:
-            raise serializers.ValidationError(f"JANコード {jan_code} を持つ商品が存在しません。")
-
-        price = product.price
-        tax_rate = product.tax  # `tax_rate`を取得
-
-        try:
-            stock = Stock.objects.get(storecode=storecode, JAN=product)
-        except Stock.DoesNotExist:
-            raise serializers.ValidationError(f"店舗コード {storecode} と JANコード {jan_code} の在庫が存在しません。")
-
-        stock.quantity -= points
-        stock.save()
-
-        # `SaleProduct`オブジェクトを作成
-        SaleProduct.objects.create(
-            transaction=transaction_instance,
-            JAN=product,
-            name=product.name,
-            price=price,
-            tax=tax_rate,  # `tax_rate`を保存
-            points=points,
-        )
+    def validate_coupon_codes(self, value):
+        # 指定された全てのコードを1回で読み直す
+        self.get_coupon_index(value)
+        for coupon_code in value:
+            if not self.is_valid_coupon(coupon_code):
+                raise serializers.ValidationError(f"無効または期限切れのクーポンコードです: {coupon_code}")
+        return value
 
-        # `tax_rate`をsale_product_dataに追加
-        sale_product_data["price"] = price
-        sale_product_data["tax"] = tax_rate
+    def resolve_sale_products(self, sale_products_data):
+        """
+        販売商品に販売時点の商品名・価格・税率を設定する
+        """
+        products = self.get_products(p["JAN"] for p in sale_products_data)
+        for sale_product_data in sale_products_data:
+            jan_code = sale_product_data["JAN"]
+            product = products.get(jan_code)
+            if product is None:
+                raise serializers.ValidationError(f"JANコード {jan_code} を持つ商品が存在しません。")
 
-        return price, tax_rate, points  # `tax_rate`を返す
+            sale_product_data["name"] = product.name
+            sale_product_data["price"] = product.price
+            sale_product_data["tax"] = product.tax
+
+    def build_sale_products(self, sale_products_data, transaction_instance):
+        """
+        商品を解決済みの販売商品からSaleProductのインスタンスを組み立てる (保存はしない)
+        """
+        return [
+            SaleProduct(
+                transaction=transaction_instance,
+                JAN_id=sale_product_data["JAN"],
+                name=sale_product_data["name"],
+                price=sale_product_data["price"],
+                tax=sale_product_data["tax"],
+                points=sale_product_data["points"],
+            )
+            for sale_product_data in sale_products_data
+        ]
 
     def calculate_tax_amounts(self, tax_10_total_price, tax_8_total_price):
         tax_10_total = (tax_10_total_price * Decimal("10.00") / Decimal("110.00")).quantize(
@@ -209,91 +250,276 @@ class TransactionSerializer(serializers.ModelSerializer):
         )
         return tax_10_total, tax_8_total
 
+    def calculate_totals(self, sale_products_data, coupon_codes, deposit, index=None, now=None):
+        """
+        価格・税率を解決済みの販売商品から取引の合計金額・税額・お釣りを計算する
+        DBにはアクセスしないため、一括登録では複数の取引をまとめて計算できる
+        """
+        purchase_points = 0
+        tax_10_total_price = Decimal("0.00")
+        tax_8_total_price = Decimal("0.00")
+        for sale_product in sale_products_data:
+            purchase_points += sale_product["points"]
+
+            if sale_product["tax"] == Decimal("10.00"):
+                tax_10_total_price += sale_product["price"] * sale_product["points"]
+            elif sale_product["tax"] == Decimal("8.00"):
+                tax_8_total_price += sale_product["price"] * sale_product["points"]
+
+        total_amount_with_tax = tax_10_total_price + tax_8_total_price
+        discount_amount = Decimal("0.00")
+
+        if coupon_codes:
+            total_amount_with_tax, coupon_result = self.apply_discount(
+                total_amount_with_tax, coupon_codes, sale_products_data, index, now
+            )
+            if coupon_result.invalid_codes:
+                raise serializers.ValidationError("無効または期限切れのクーポンコードです。")
+            discount_amount = coupon_result.total
+
+            # 小計・割合・同時購入の割引は税率ごとの合計金額に按分する
+            # 商品指定・複数点購入の割引は税率ごとの合計金額を変更しない
+            if coupon_result.proportional and total_amount_with_tax:
+                tax_10_total_price -= coupon_result.proportional * (tax_10_total_price / total_amount_with_tax)
+                tax_8_total_price -= coupon_result.proportional * (tax_8_total_price / total_amount_with_tax)
+            elif coupon_result.proportional:
+                tax_10_total_price = tax_8_total_price = Decimal("0.00")
+
+        tax_10_total, tax_8_total = self.calculate_tax_amounts(tax_10_total_price, tax_8_total_price)
+        tax_amount = tax_10_total + tax_8_total
+
+        change = deposit - total_amount_with_tax
+
+        if deposit < total_amount_with_tax:
+            raise serializers.ValidationError("預かり金は総額を超えている必要があります。")
+        if change < Decimal("0.00"):
+            raise serializers.ValidationError("お釣りは正の値である必要があります。")
+
+        return {
+            "purchase_points": purchase_points,
+            "tax_10_percent": tax_10_total,
+            "tax_8_percent": tax_8_total,
+            "tax_amount": tax_amount,
+            "total_amount": total_amount_with_tax,
+            "change": change,
+            "discount_amount": discount_amount,
+        }
+
     def create(self, validated_data):
         sale_products_data = validated_data.pop("sale_products")
         storecode = validated_data.get("storecode")
         deposit = validated_data.get("deposit")
-        coupon_code = validated_data.get("coupon_code")
+        coupon_code = validated_data.pop("coupon_code", None)
+        # 単一のcoupon_codeと複数指定のcoupon_codesをまとめて適用する
+        coupon_codes = list(dict.fromkeys(code for code in [coupon_code, *validated_data.pop("coupon_codes", [])] if code))
 
-        purchase_points = 0
-        tax_10_total_price = Decimal("0.00")
-        tax_8_total_price = Decimal("0.00")
+        # 金額は登録前に計算し、取引は確定した値で1回だけINSERTする (変更履歴も1行)
+        self.resolve_sale_products(sale_products_data)
+        totals = self.calculate_totals(sale_products_data, coupon_codes, deposit)
 
         with transaction.atomic():
             current_time = timezone.now()
-            storecode_str = str(storecode)
-            staffcode = str(validated_data.get("staffcode"))
-            cutted_ms = str(current_time).split(".")[1][:4]
-            sqids = Sqids(min_length=10, alphabet="ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789")
-            sale_id = sqids.encode([int(cutted_ms), int(storecode_str), int(staffcode)])
+            sale_id = sale_id_allocator.allocate(str(storecode), current_time)
+            # 在庫行は更新せず、取引IDを発生元とした出庫を入出庫台帳に追記する
+            deltas = {}
+            for p in sale_products_data:
+                deltas[p["JAN"]] = deltas.get(p["JAN"], 0) - p["points"]
+            missing = apply_stock_deltas(storecode, deltas, kind="sale", reference=sale_id)
+            if missing:
+                raise serializers.ValidationError(f"店舗コード {storecode} と JANコード {missing[0]} の在庫が存在しません。")
 
             transaction_instance = Transaction.objects.create(
                 **validated_data,
                 sale_id=sale_id,
                 sale_date=current_time,
-                purchase_points=0,
-                tax_10_percent=Decimal("0.00"),
-                tax_8_percent=Decimal("0.00"),
-                tax_amount=Decimal("0.00"),
-                total_amount=Decimal("0.00"),
-                change=Decimal("0.00"),
-                discount_amount=Decimal("0.00"),
+                coupon_code=",".join(coupon_codes) or coupon_code,
+                **totals,
             )
 
-            for sale_product_data in sale_products_data:
-                price, tax_rate, points = self.process_sale_product(sale_product_data, storecode, transaction_instance)
-                purchase_points += points
+            # `SaleProduct`とその履歴は1回のINSERTでまとめて作成
+            sale_products = self.build_sale_products(sale_products_data, transaction_instance)
+            bulk_create_with_history(sale_products, SaleProduct)
+            queue_rollup(sale_rollup_rows(sale_products))
 
-                if tax_rate == Decimal("10.00"):
-                    tax_10_total_price += price * points
-                elif tax_rate == Decimal("8.00"):
-                    tax_8_total_price += price * points
+        return transaction_instance
 
-            total_amount_with_tax = tax_10_total_price + tax_8_total_price
-            discount_amount = Decimal("0.00")
 
-            if coupon_code:
-                try:
-                    coupon = Coupon.objects.get(code=coupon_code)
-                    total_amount_with_tax, discount_amount = self.apply_discount(
-                        total_amount_with_tax, coupon, sale_products_data
-                    )
-                except Coupon.DoesNotExist:
-                    raise serializers.ValidationError("無効または期限切れのクーポンコードです。")
-
-                if coupon.coupon_type in ["percent", "amount", "combo"]:
-                    tax_10_total_price -= discount_amount * (tax_10_total_price / total_amount_with_tax)
-                    tax_8_total_price -= discount_amount * (tax_8_total_price / total_amount_with_tax)
-                elif coupon.coupon_type in ["product", "multi"]:
-                    tax_10_total_price = sum(
-                        p["price"] * p["points"] for p in sale_products_data if Decimal(p["tax"]) == Decimal("10.00")
-                    ) or 0
-                    tax_8_total_price = sum(
-                        p["price"] * p["points"] for p in sale_products_data if Decimal(p["tax"]) == Decimal("8.00")
-                    ) or 0
+# オフライン中にレジで登録された取引の一括登録用シリアライザー (1件分)
+class TransactionBatchItemSerializer(TransactionSerializer):
+    # レジで販売した日時をそのまま保存する (省略時は登録日時)
+    sale_date = serializers.DateTimeField(required=False)
+    # 店舗・スタッフはバッチ全体でまとめて取得したものから解決する
+    storecode = serializers.CharField(max_length=255)
+    staffcode = serializers.IntegerField()
+    # レジ側で取引を識別する値 (結果との突き合わせに使う)
+    client_ref = serializers.CharField(max_length=255, required=False)
+
+    class Meta(TransactionSerializer.Meta):
+        fields = TransactionSerializer.Meta.fields + ["client_ref"]
+        read_only_fields = [field for field in TransactionSerializer.Meta.read_only_fields if field != "sale_date"]
+
+    def validate_storecode(self, value):
+        store = self.context["stores"].get(value)
+        if store is None:
+            raise serializers.ValidationError(f"店舗コード {value} の店舗が存在しません。")
+        return store
+
+    def validate_staffcode(self, value):
+        staff = self.context["staff"].get(value)
+        if staff is None:
+            raise serializers.ValidationError(f"スタッフコード {value} のスタッフが存在しません。")
+        return staff
+
+    # クーポンの有効期限は販売日時で判定するため、金額計算時にまとめて確認する
+    def validate_coupon_code(self, value):
+        return value
 
-            tax_10_total, tax_8_total = self.calculate_tax_amounts(tax_10_total_price, tax_8_total_price)
-            tax_amount = tax_10_total + tax_8_total
+    def validate_coupon_codes(self, value):
+        return value
 
-            change = deposit - total_amount_with_tax
 
-            if deposit < total_amount_with_tax:
-                raise serializers.ValidationError("預かり金は総額を超えている必要があります。")
-            if change < Decimal("0.00"):
-                raise serializers.ValidationError("お釣りは正の値である必要があります。")
+# 取引の一括登録のシリアライザー
+class TransactionBatchSerializer(serializers.Serializer):
+    """
+    オフライン中に溜まった取引をまとめて登録する
+    - 店舗・スタッフ・商品・在庫・クーポンはバッチ全体で1回ずつまとめて取得する
+    - 取引ごとに検証・金額計算を行い、失敗した取引だけをエラーとして返す
+    - 在庫は店舗ごとに1回のUPDATEで減算し、取引と販売商品はそれぞれ1回のINSERTで作成する
+    """
 
-            transaction_instance.purchase_points = purchase_points
-            transaction_instance.coupon_code = coupon_code
-            transaction_instance.tax_10_percent = tax_10_total
-            transaction_instance.tax_8_percent = tax_8_total
-            transaction_instance.tax_amount = tax_amount
-            transaction_instance.total_amount = total_amount_with_tax
-            transaction_instance.change = change
-            transaction_instance.discount_amount = discount_amount
+    # 取引ごとの形式の誤りも取引ごとのエラーとして返すため、ここでは要素の型を検証しない
+    transactions = serializers.ListField(
+        child=serializers.JSONField(allow_null=True),
+        allow_empty=False,
+        max_length=getattr(settings, "TRANSACTION_BATCH_MAX_SIZE", 1000),
+    )
 
-            transaction_instance.save()
+    def create(self, validated_data):
+        entries = validated_data["transactions"]
+        context = {**self.context, **self.preload(entries)}
+        results = [None] * len(entries)
+
+        # 取引ごとに検証し、金額を計算する
+        accepted = []
+        coupon_codes = {}
+        for i, entry in enumerate(entries):
+            item = TransactionBatchItemSerializer(data=entry, context=context)
+            if not item.is_valid():
+                results[i] = self.error_result(i, entry, item.errors)
+                continue
+            data = dict(item.validated_data)
+            coupon_code = data.get("coupon_code")
+            coupon_codes[i] = list(dict.fromkeys(code for code in [coupon_code, *data.pop("coupon_codes", [])] if code))
+            accepted.append((i, item, data))
+
+        index = coupon_index.get().including(code for codes in coupon_codes.values() for code in codes)
+        existing_stocks = set(
+            Stock.objects.filter(
+                storecode__in=[data["storecode"] for _, _, data in accepted],
+                JAN__in={p["JAN"] for _, _, data in accepted for p in data["sale_products"]},
+            ).values_list("storecode_id", "JAN_id")
+        )
 
-        return transaction_instance
+        priced = []
+        for i, item, data in accepted:
+            storecode = data["storecode"].storecode
+            data.setdefault("sale_date", timezone.now())
+            try:
+                item.resolve_sale_products(data["sale_products"])
+                for sale_product_data in data["sale_products"]:
+                    if (storecode, sale_product_data["JAN"]) not in existing_stocks:
+                        raise serializers.ValidationError(
+                            f"店舗コード {storecode} と JANコード {sale_product_data['JAN']} の在庫が存在しません。"
+                        )
+                totals = item.calculate_totals(
+                    data["sale_products"], coupon_codes[i], data["deposit"], index, data["sale_date"]
+                )
+            except serializers.ValidationError as exc:
+                results[i] = self.error_result(i, entries[i], exc.detail)
+                continue
+            priced.append((i, item, data, totals))
+
+        if not priced:
+            return results
+
+        with transaction.atomic():
+            transactions = []
+            movements = []
+            for i, _, data, totals in priced:
+                storecode = data["storecode"].storecode
+                sale_id = sale_id_allocator.allocate(storecode, data["sale_date"])
+                transactions.append(
+                    Transaction(
+                        sale_type=data.get("sale_type", "1"),
+                        sale_id=sale_id,
+                        sale_date=data["sale_date"],
+                        storecode=data["storecode"],
+                        staffcode=data["staffcode"],
+                        deposit=data["deposit"],
+                        coupon_code=",".join(coupon_codes[i]) or data.get("coupon_code"),
+                        **totals,
+                    )
+                )
+                movements.extend(
+                    (storecode, sale_product_data["JAN"], -sale_product_data["points"], "sale", sale_id)
+                    for sale_product_data in data["sale_products"]
+                )
+            # バッチ全体の出庫は1回のINSERTで入出庫台帳に追記する
+            missing = record_movements(movements)
+            if missing:
+                raise serializers.ValidationError(f"店舗コード {missing[0][0]} と JANコード {missing[0][1]} の在庫が存在しません。")
+
+            transactions = bulk_create_with_history(transactions, Transaction)
+
+            sale_products = []
+            for (_, item, data, _), transaction_instance in zip(priced, transactions):
+                sale_products.extend(item.build_sale_products(data["sale_products"], transaction_instance))
+            bulk_create_with_history(sale_products, SaleProduct)
+            queue_rollup(sale_rollup_rows(sale_products))
+
+        for (i, _, data, _), transaction_instance in zip(priced, transactions):
+            results[i] = {
+                "index": i,
+                "client_ref": data.get("client_ref"),
+                "status": "created",
+                "sale_id": transaction_instance.sale_id,
+                "sale_date": transaction_instance.sale_date,
+                "total_amount": int(transaction_instance.total_amount),
+                "discount_amount": int(transaction_instance.discount_amount),
+                "change": int(transaction_instance.change),
+            }
+        return results
+
+    def preload(self, entries):
+        """
+        バッチ内の店舗・スタッフ・商品をそれぞれ1回のクエリで取得する
+        """
+        storecodes, staffcodes, jan_codes = set(), set(), set()
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            storecodes.add(str(entry.get("storecode")))
+            try:
+                staffcodes.add(int(entry.get("staffcode")))
+            except (TypeError, ValueError):
+                pass
+            for sale_product in entry.get("sale_products") or []:
+                if isinstance(sale_product, dict) and sale_product.get("JAN"):
+                    jan_codes.add(str(sale_product["JAN"]))
+        return {
+            "stores": Store.objects.in_bulk(storecodes, field_name="storecode"),
+            "staff": CustomUser.objects.in_bulk(staffcodes, field_name="staffcode"),
+            # 取得した商品は商品キャッシュにも載るため、取引ごとの検証ではクエリが発生しない
+            "products": catalog_cache.get_many(jan_codes),
+        }
+
+    def error_result(self, index, entry, errors):
+        return {
+            "index": index,
+            "client_ref": entry.get("client_ref") if isinstance(entry, dict) else None,
+            "status": "error",
+            "errors": errors,
+        }
 
 
 # 返品製品のシリアライザー
@@ -358,35 +584,6 @@ class ReturnTransactionSerializer(serializers.ModelSerializer):
         
         return data
 
-    def apply_discount(self, amount, coupon, sale_products_data):
-        discount = 0
-        
-        if coupon.coupon_type == "percent":
-            discount = (amount * coupon.discount_percentage / Decimal("100.0")).quantize(
-                Decimal("1"), rounding=ROUND_HALF_UP
-            )
-        elif coupon.coupon_type == "amount":
-            discount = coupon.discount_value
-        elif coupon.coupon_type == "product":
-            applicable_products = coupon.applicable_product_jan
-            for sale_product in sale_products_data:
-                if str(sale_product["JAN"]) == applicable_products.JAN:
-                    discount = coupon.discount_value
-                    break
-        elif coupon.coupon_type == "combo":
-            combo_products = coupon.combo_product_jans.all()
-            combo_jan_list = [product.JAN for product in combo_products]
-            sale_jan_list = [str(product["JAN"]) for product in sale_products_data]
-            if all(jan in sale_jan_list for jan in combo_jan_list):
-                discount = int(coupon.discount_value)
-        elif coupon.coupon_type == "multi":
-            applicable_product_jan = coupon.applicable_product_jan
-            total_quantity = sum([product["points"] for product in sale_products_data if str(product["JAN"]) == applicable_product_jan.JAN])
-            if total_quantity >= coupon.min_quantity:
-                discount_multiplier = total_quantity // coupon.min_quantity
-                discount = coupon.discount_value * discount_multiplier
-        return amount - discount, discount
-
     def calculate_tax_amounts(self, tax_10_total_price, tax_8_total_price):
         tax_10_total = (tax_10_total_price * Decimal("10.00") / Decimal("110.00")).quantize(
             Decimal("0.01"), rounding=ROUND_HALF_DOWN
@@ -407,11 +604,7 @@ class ReturnTransactionSerializer(serializers.ModelSerializer):
 
         with transaction.atomic():
             current_time = timezone.now()
-            storecode_str = str(storecode)
-            staffcode = str(validated_data.get("staffcode"))
-            cutted_ms = str(current_time).split('.')[1][:4]
-            sqids = Sqids(min_length=10, alphabet="ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789")
-            return_id = sqids.encode([int(cutted_ms), int(storecode_str), int(staffcode)])
+            return_id = return_id_allocator.allocate(str(storecode), current_time)
             return_instance = ReturnTransaction.objects.create(
                 return_date=current_time,
                 return_id=return_id,
@@ -424,13 +617,15 @@ class ReturnTransactionSerializer(serializers.ModelSerializer):
                 **validated_data
             )
 
+            products = catalog_cache.get_many({str(p["JAN"]) for p in return_products_data})
+            return_products = []
+            stock_deltas = {}
             for return_product_data in return_products_data:
-                jan_code = return_product_data["JAN"]
+                jan_code = str(return_product_data["JAN"])
                 points = return_product_data["points"]
 
-                try:
-                    product = Product.objects.get(JAN=jan_code)
-                except Product.DoesNotExist:
+                product = products.get(jan_code)
+                if product is None:
                     raise serializers.ValidationError(f"Product with JAN code {jan_code} does not exist.")
 
                 price = product.price
@@ -441,20 +636,23 @@ class ReturnTransactionSerializer(serializers.ModelSerializer):
                 elif tax_rate == Decimal("8.00"):
                     tax_8_total_price += price * points
 
-                try:
-                    stock = Stock.objects.get(storecode=storecode, JAN=product)
-                except Stock.DoesNotExist:
-                    raise serializers.ValidationError(f"Stock for product with JAN code {jan_code} in store {storecode} does not exist.")
-
-                stock.quantity += points
-                stock.save()
-
-                ReturnProduct.objects.create(
-                    return_transaction=return_instance, JAN=product, name=product.name, price=price, tax=tax_rate, points=points
+                stock_deltas[jan_code] = stock_deltas.get(jan_code, 0) + points
+                return_products.append(
+                    ReturnProduct(
+                        return_transaction=return_instance, JAN=product, name=product.name, price=price, tax=tax_rate, points=points
+                    )
                 )
 
                 return_points += points
 
+            # 返品IDを発生元とした入庫を入出庫台帳にまとめて追記する
+            missing = apply_stock_deltas(storecode, stock_deltas, kind="return", reference=return_id)
+            if missing:
+                raise serializers.ValidationError(f"Stock for product with JAN code {missing[0]} in store {storecode} does not exist.")
+
+            ReturnProduct.objects.bulk_create(return_products)
+            queue_rollup(return_rollup_rows(return_products))
+
             tax_10_total, tax_8_total = self.calculate_tax_amounts(tax_10_total_price, tax_8_total_price)
             tax_amount = tax_10_total + tax_8_total
             return_amount_with_tax = tax_10_total_price + tax_8_total_price
@@ -477,7 +675,66 @@ class ReturnTransactionSerializer(serializers.ModelSerializer):
 
         return return_instance
 
+
+# 一覧・詳細の取得で日時・金額を同期版のシリアライザーと同じ形式にするためのフィールド
+_datetime_field = serializers.DateTimeField()
+_discount_field = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+
+def line_representation(line):
+    return {"JAN": line.JAN_id, "name": line.name, "price": line.price, "tax": line.tax, "points": line.points}
+
+
+# 取引の読み取り用シリアライザー (一覧・詳細)
+# ModelSerializerのフィールドの解決を行わず、TransactionSerializerと同じ形式のdictを組み立てる
+# 店番・スタッフコード・JANは外部キーの列の値をそのまま返すため、関連テーブルを参照しない
+class TransactionReadSerializer(serializers.BaseSerializer):
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        販売商品を取引ごとではなくページ単位でまとめて読み込む
+        """
+        return queryset.prefetch_related("sale_products")
+
+    def to_representation(self, instance):
+        return {
+            "sale_type": instance.sale_type,
+            "sale_id": instance.sale_id,
+            "storecode": instance.storecode_id,
+            "staffcode": instance.staffcode_id,
+            "deposit": instance.deposit,
+            "sale_date": _datetime_field.to_representation(instance.sale_date),
+            "purchase_points": instance.purchase_points,
+            "tax_10_percent": instance.tax_10_percent,
+            "tax_8_percent": instance.tax_8_percent,
+            "tax_amount": instance.tax_amount,
+            "total_amount": instance.total_amount,
+            "change": instance.change,
+            "saleproduct_set": [line_representation(line) for line in instance.sale_products.all()],
+            "coupon_code": instance.coupon_code,
+            "discount_amount": _discount_field.to_representation(instance.discount_amount),
+        }
+
+
+# 返品取引の読み取り用シリアライザー (一覧・詳細)
+class ReturnTransactionReadSerializer(serializers.BaseSerializer):
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset.prefetch_related("return_products")
+
     def to_representation(self, instance):
-        representation = super().to_representation(instance)
-        representation["returnproduct_set"] = ReturnProductSerializer(instance.return_products.all(), many=True).data
-        return representation
+        return {
+            "return_type": instance.return_type,
+            "return_id": instance.return_id,
+            "originSaleid": instance.originSaleid_id,
+            "storecode": instance.storecode_id,
+            "staffcode": instance.staffcode_id,
+            "reason": instance.reason,
+            "return_points": instance.return_points,
+            "tax_10_percent": instance.tax_10_percent,
+            "tax_8_percent": instance.tax_8_percent,
+            "tax_amount": instance.tax_amount,
+            "return_amount": instance.return_amount,
+            "return_date": _datetime_field.to_representation(instance.return_date),
+            "returnproduct_set": [line_representation(line) for line in instance.return_products.all()],
+        }
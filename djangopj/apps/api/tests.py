@@ -1,3 +1,385 @@
-from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
+from django.db import connection
+from django.db.models import F
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from apps.DBmaint.catalog_cache import catalog_cache
+from apps.DBmaint.models import Coupon, IdempotencyKey, Product, SaleProduct, Stock, Store, Transaction
+from apps.DBmaint.stock import current_quantities
+from apps.user.models import CustomUser
 
-# Create your tests here.
+
+class TransactionPaginationTests(APITestCase):
+    """
+    取引一覧のカーソルページネーション
+    """
+
+    url = "/api/transactions/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_superuser(staffcode=1234, password="password")
+        cls.store = Store.objects.create(storecode="1", name="店舗1")
+        cls.base = timezone.now() - timedelta(hours=1)
+        # 同じ販売日時の取引を含め、(販売日時, ID) の順に並ぶことを確認する
+        for i, minutes in enumerate([0, 1, 1, 1, 2, 3, 5]):
+            cls.create_transaction(f"S{i:03d}", cls.base + timedelta(minutes=minutes))
+
+    @classmethod
+    def create_transaction(cls, sale_id, sale_date):
+        return Transaction.objects.create(
+            sale_id=sale_id,
+            sale_date=sale_date,
+            storecode=cls.store,
+            staffcode=cls.user,
+            purchase_points=0,
+            tax_10_percent=0,
+            tax_8_percent=0,
+            tax_amount=0,
+            total_amount=100,
+            deposit=100,
+            change=0,
+        )
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def get_page(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        return [row["sale_id"] for row in body["results"]], body["next"], body["previous"]
+
+    def expected(self, ascending=False):
+        ordering = ("sale_date", "id") if ascending else ("-sale_date", "-id")
+        return list(Transaction.objects.order_by(*ordering).values_list("sale_id", flat=True))
+
+    def test_first_page(self):
+        sale_ids, next_link, previous_link = self.get_page(self.url, limit=3)
+        self.assertEqual(sale_ids, self.expected()[:3])
+        self.assertIsNotNone(next_link)
+        self.assertIsNone(previous_link)
+
+    def test_next_links_cover_all_rows_once(self):
+        sale_ids, next_link, _ = self.get_page(self.url, limit=2)
+        while next_link:
+            page, next_link, previous_link = self.get_page(next_link)
+            self.assertIsNotNone(previous_link)
+            sale_ids += page
+        self.assertEqual(sale_ids, self.expected())
+
+    def test_previous_link_returns_previous_page(self):
+        first, next_link, _ = self.get_page(self.url, limit=3)
+        second, _, previous_link = self.get_page(next_link)
+        self.assertEqual(second, self.expected()[3:6])
+        page, next_link, previous_link = self.get_page(previous_link)
+        self.assertEqual(page, first)
+        # 先頭まで戻った場合、nextは2ページ目になり、previousはない
+        self.assertIsNone(previous_link)
+        self.assertEqual(self.get_page(next_link)[0], second)
+
+    def test_last_page_has_no_next(self):
+        _, next_link, _ = self.get_page(self.url, limit=7)
+        self.assertIsNone(next_link)
+        sale_ids, next_link, _ = self.get_page(self.url, limit=100)
+        self.assertEqual(sale_ids, self.expected())
+        self.assertIsNone(next_link)
+
+    def test_invalid_limit_uses_default(self):
+        sale_ids, _, _ = self.get_page(self.url, limit=0)
+        self.assertEqual(sale_ids, self.expected())
+        sale_ids, _, _ = self.get_page(self.url, limit="x")
+        self.assertEqual(sale_ids, self.expected())
+
+    def test_invalid_cursor(self):
+        for cursor in ["x", "%%%", "ZD14Jmk9MQ==", "aT0x"]:
+            response = self.client.get(self.url, {"cursor": cursor})
+            self.assertEqual(response.status_code, 404, cursor)
+
+    def test_ascending_order(self):
+        sale_ids, next_link, _ = self.get_page(self.url, limit=4, order="asc")
+        while True:
+            page, next_link, _ = self.get_page(next_link)
+            if not page:
+                break
+            sale_ids += page
+        self.assertEqual(sale_ids, self.expected(ascending=True))
+        # 古い順の最後のページでも、同じカーソルのnextを返す
+        self.assertEqual(self.get_page(next_link)[1], next_link)
+
+    @override_settings(KEYSET_TAIL_SETTLE_SECONDS=60)
+    def test_ascending_tail_waits_for_settle_window(self):
+        sale_ids, next_link, _ = self.get_page(self.url, limit=100, order="asc")
+        self.assertEqual(sale_ids, self.expected(ascending=True))
+
+        # 日時が直近の取引はまだ返さず、カーソルも進めない
+        now = timezone.now()
+        self.create_transaction("RECENT", now)
+        self.assertEqual(self.get_page(next_link)[0], [])
+
+        # 直近の取引より前の日時で後からコミットされた取引も、確定範囲に入ってから日時の順に返す
+        self.create_transaction("LATE", now - timedelta(seconds=1))
+        self.assertEqual(self.get_page(next_link)[0], [])
+        Transaction.objects.filter(sale_id__in=["RECENT", "LATE"]).update(sale_date=F("sale_date") - timedelta(seconds=61))
+        page, next_link, _ = self.get_page(next_link)
+        self.assertEqual(page, ["LATE", "RECENT"])
+        self.assertEqual(self.get_page(next_link)[0], [])
+
+    def test_descending_includes_recent_transactions(self):
+        self.create_transaction("RECENT", timezone.now())
+        sale_ids, _, _ = self.get_page(self.url, limit=1)
+        self.assertEqual(sale_ids, ["RECENT"])
+
+
+class SaleAPITestCase(APITestCase):
+    """
+    販売の登録のテストの共通の準備
+    商品A (10%) と商品B (8%) の在庫を店舗1に10点ずつ用意する
+    """
+
+    jan_a = "4900000000011"
+    jan_b = "4900000000028"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_superuser(staffcode=1234, password="password")
+        cls.store = Store.objects.create(storecode="1", name="店舗1")
+        Product.objects.create(JAN=cls.jan_a, name="商品A", price=1100, tax=Decimal("10.00"))
+        Product.objects.create(JAN=cls.jan_b, name="商品B", price=540, tax=Decimal("8.00"))
+        Stock.objects.filter(storecode=cls.store).update(quantity=10)
+
+    def setUp(self):
+        # 商品キャッシュはプロセス内で共有され、テストのロールバックでは破棄されないため空にしておく
+        catalog_cache.invalidate()
+        self.client.force_authenticate(self.user)
+
+    def sale_body(self, lines, **extra):
+        return {
+            "storecode": "1",
+            "staffcode": 1234,
+            "deposit": 10000,
+            "sale_products": [{"JAN": jan_code, "points": points} for jan_code, points in lines],
+            **extra,
+        }
+
+    def post_sale(self, lines, **extra):
+        return self.client.post("/api/transactions/", self.sale_body(lines, **extra), format="json")
+
+    def quantity(self, jan_code):
+        stock = Stock.objects.get(storecode=self.store, JAN_id=jan_code)
+        return current_quantities([stock.pk])[stock.pk]
+
+
+class CheckoutTests(SaleAPITestCase):
+    """
+    販売の登録 (商品・在庫の一括取得と販売商品の一括作成)
+    """
+
+    def test_totals_and_stock(self):
+        # 同じJANの行は1行にまとめる
+        response = self.post_sale([(self.jan_a, 1), (self.jan_b, 2), (self.jan_a, 1)])
+        self.assertEqual(response.status_code, 201, response.json())
+        body = response.json()
+        self.assertEqual(Decimal(body["total_amount"]), Decimal("3280"))
+        self.assertEqual(Decimal(body["tax_10_percent"]), Decimal("200"))
+        self.assertEqual(Decimal(body["tax_8_percent"]), Decimal("80"))
+        self.assertEqual(Decimal(body["tax_amount"]), Decimal("280"))
+        self.assertEqual(Decimal(body["change"]), Decimal("6720"))
+        self.assertEqual(body["purchase_points"], 4)
+
+        sale = Transaction.objects.get(sale_id=body["sale_id"])
+        lines = {line.JAN_id: line for line in SaleProduct.objects.filter(transaction=sale)}
+        self.assertEqual({jan_code: line.points for jan_code, line in lines.items()}, {self.jan_a: 2, self.jan_b: 2})
+        self.assertEqual(lines[self.jan_a].price, Decimal("1100"))
+        self.assertEqual((self.quantity(self.jan_a), self.quantity(self.jan_b)), (8, 8))
+
+    def test_history(self):
+        response = self.post_sale([(self.jan_a, 1), (self.jan_b, 1)])
+        self.assertEqual(response.status_code, 201)
+        sale = Transaction.objects.get(sale_id=response.json()["sale_id"])
+        # 取引は確定した値で1回だけINSERTし、変更履歴も1行になる
+        self.assertEqual(sale.history.count(), 1)
+        self.assertEqual(sale.history.get().total_amount, sale.total_amount)
+        self.assertEqual(SaleProduct.history.filter(transaction_id=sale.pk).count(), 2)
+
+    def test_unknown_product_changes_nothing(self):
+        response = self.post_sale([(self.jan_a, 1), ("4900000000035", 1)])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(self.quantity(self.jan_a), 10)
+
+    def test_queries_do_not_grow_with_basket(self):
+        def count_queries(lines):
+            catalog_cache.invalidate()
+            queries = []
+            with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+                response = self.post_sale(lines)
+            self.assertEqual(response.status_code, 201)
+            return len(queries)
+
+        # 店舗で最初の販売では採番の準備のクエリが発生するため、先に1件登録しておく
+        count_queries([(self.jan_b, 1)])
+        self.assertEqual(count_queries([(self.jan_a, 1)]), count_queries([(self.jan_a, 1), (self.jan_b, 3)]))
+
+
+class CouponCheckoutTests(SaleAPITestCase):
+    """
+    販売の登録でのクーポンの判定
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        expires = timezone.now() + timedelta(days=1)
+        product_a = Product.objects.get(JAN=cls.jan_a)
+        Coupon.objects.create(code="AMOUNT100", coupon_type="amount", expiration_date=expires, discount_value=100)
+        Coupon.objects.create(
+            code="PERCENT10",
+            coupon_type="percent",
+            expiration_date=expires,
+            discount_value=0,
+            discount_percentage=Decimal("10.0"),
+        )
+        Coupon.objects.create(code="AMOUNT9999", coupon_type="amount", expiration_date=expires, discount_value=9999)
+        Coupon.objects.create(
+            code="MULTI2",
+            coupon_type="multi",
+            expiration_date=expires,
+            discount_value=50,
+            applicable_product_jan=product_a,
+            min_quantity=2,
+        )
+        Coupon.objects.create(
+            code="EXPIRED",
+            coupon_type="amount",
+            expiration_date=timezone.now() - timedelta(days=1),
+            discount_value=100,
+        )
+
+    def test_percent_applies_after_other_discounts(self):
+        # 指定の順序によらず、割合の割引は他の割引を差し引いた後の小計に適用する
+        for codes in (["PERCENT10", "AMOUNT100"], ["AMOUNT100", "PERCENT10"]):
+            response = self.post_sale([(self.jan_a, 1)], coupon_codes=codes)
+            self.assertEqual(response.status_code, 201, response.json())
+            body = response.json()
+            self.assertEqual(Decimal(body["discount_amount"]), Decimal("200"))
+            self.assertEqual(Decimal(body["total_amount"]), Decimal("900"))
+
+    def test_discount_is_capped_at_subtotal(self):
+        response = self.post_sale([(self.jan_a, 1)], coupon_codes=["AMOUNT9999", "PERCENT10"], deposit=1)
+        self.assertEqual(response.status_code, 201, response.json())
+        body = response.json()
+        self.assertEqual(Decimal(body["discount_amount"]), Decimal("1100"))
+        self.assertEqual(Decimal(body["total_amount"]), Decimal("0"))
+        self.assertEqual(Decimal(body["change"]), Decimal("1"))
+
+    def test_multi_coupon_and_single_code(self):
+        response = self.post_sale([(self.jan_a, 5)], coupon_code="MULTI2")
+        self.assertEqual(response.status_code, 201, response.json())
+        self.assertEqual(Decimal(response.json()["discount_amount"]), Decimal("100"))
+        self.assertEqual(Transaction.objects.get().coupon_code, "MULTI2")
+
+    def test_invalid_codes_are_rejected(self):
+        for codes in (["EXPIRED"], ["UNKNOWN"], ["AMOUNT100", "EXPIRED"]):
+            response = self.post_sale([(self.jan_a, 1)], coupon_codes=codes)
+            self.assertEqual(response.status_code, 400, codes)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_joined_codes_fit_column(self):
+        expires = timezone.now() + timedelta(days=1)
+        codes = [f"C{i:012d}" for i in range(20)]
+        Coupon.objects.bulk_create(
+            Coupon(code=code, coupon_type="amount", expiration_date=expires, discount_value=1) for code in codes
+        )
+        response = self.post_sale([(self.jan_a, 1)], coupon_codes=codes)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("coupon_codes", response.json())
+
+
+class IdempotencyTests(SaleAPITestCase):
+    """
+    Idempotency-Keyヘッダーによる再送時の二重登録の防止
+    """
+
+    def post_sale(self, lines, key, **extra):
+        return self.client.post(
+            "/api/transactions/", self.sale_body(lines, **extra), format="json", HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_replay_returns_stored_response(self):
+        first = self.post_sale([(self.jan_a, 1)], "key-1")
+        self.assertEqual(first.status_code, 201)
+        replay = self.post_sale([(self.jan_a, 1)], "key-1")
+        self.assertEqual(replay.status_code, 201)
+        self.assertEqual(replay["Idempotent-Replayed"], "true")
+        self.assertEqual(replay.json()["sale_id"], first.json()["sale_id"])
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(self.quantity(self.jan_a), 9)
+
+    def test_different_body_with_same_key_conflicts(self):
+        self.assertEqual(self.post_sale([(self.jan_a, 1)], "key-1").status_code, 201)
+        response = self.post_sale([(self.jan_a, 2)], "key-1")
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(self.quantity(self.jan_a), 9)
+
+    def test_failed_request_can_be_retried(self):
+        self.assertEqual(self.post_sale([(self.jan_a, 1)], "key-1", deposit=1).status_code, 400)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.post_sale([(self.jan_a, 1)], "key-1").status_code, 201)
+
+    def test_requests_without_key_are_not_deduplicated(self):
+        super().post_sale([(self.jan_a, 1)])
+        super().post_sale([(self.jan_a, 1)])
+        self.assertEqual(Transaction.objects.count(), 2)
+
+
+class TransactionBatchTests(SaleAPITestCase):
+    """
+    オフライン中の取引の一括登録
+    """
+
+    url = "/api/transactions/batch/"
+
+    def test_per_entry_results(self):
+        sale_date = timezone.now() - timedelta(days=1)
+        entries = [
+            self.sale_body([(self.jan_a, 1)], client_ref="r0", sale_date=sale_date.isoformat()),
+            self.sale_body([(self.jan_a, 1)], client_ref="r1", storecode="9"),
+            self.sale_body([("4900000000035", 1)], client_ref="r2"),
+            self.sale_body([(self.jan_b, 2)], client_ref="r3", deposit=1),
+            self.sale_body([(self.jan_a, 1), (self.jan_b, 1)], client_ref="r4"),
+        ]
+        response = self.client.post(self.url, {"transactions": entries}, format="json")
+        self.assertEqual(response.status_code, 200, response.json())
+        body = response.json()
+        self.assertEqual((body["created"], body["failed"]), (2, 3))
+        results = body["results"]
+        self.assertEqual([result["client_ref"] for result in results], ["r0", "r1", "r2", "r3", "r4"])
+        self.assertEqual(
+            [result["status"] for result in results], ["created", "error", "error", "error", "created"]
+        )
+        self.assertIn("storecode", results[1]["errors"])
+        self.assertIn("sale_products", results[2]["errors"])
+
+        # 販売日時はレジで販売した日時のまま保存する
+        self.assertEqual(Transaction.objects.get(sale_id=results[0]["sale_id"]).sale_date, sale_date)
+        self.assertEqual(Decimal(results[4]["total_amount"]), Decimal("1640"))
+        self.assertEqual((self.quantity(self.jan_a), self.quantity(self.jan_b)), (8, 9))
+
+    def test_malformed_entry_fails_only_itself(self):
+        entries = [self.sale_body([(self.jan_a, 1)], client_ref="r0"), "not an object", None]
+        response = self.client.post(self.url, {"transactions": entries}, format="json")
+        self.assertEqual(response.status_code, 200, response.json())
+        body = response.json()
+        self.assertEqual((body["created"], body["failed"]), (1, 2))
+        for result in body["results"][1:]:
+            self.assertEqual(result["status"], "error")
+            self.assertIsNone(result["client_ref"])
+            self.assertIn("non_field_errors", result["errors"])
+
+    def test_empty_batch_is_rejected(self):
+        response = self.client.post(self.url, {"transactions": []}, format="json")
+        self.assertEqual(response.status_code, 400)
@@ -1,5 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from . import async_views
 from .views import ItemReadOnlyViewSet, StockViewSet, TransactionViewSet, TestViewSet, ReturnTransactionViewSet
 
 router = DefaultRouter()
@@ -10,5 +11,8 @@ router.register(r'transactions', TransactionViewSet, basename='transaction')
 router.register(r'returntransactions', ReturnTransactionViewSet, basename='returntransaction')
 
 urlpatterns = [
+    # 非同期版の読み取りAPI (ASGIサーバーで実行する)
+    path('async/items/', async_views.item_list, name='async-item-list'),
+    path('async/stocks/', async_views.stock_list, name='async-stock-list'),
     path('', include(router.urls)),
 ]
@@ -3,20 +3,81 @@ from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet
 from apps.DBmaint.models import Product, Stock, Transaction, ReturnTransaction
-from .serializers import TransactionSerializer, ProductSerializer, StockSerializer, ReturnTransactionSerializer
+from .serializers import TransactionSerializer, ProductSerializer, StockSerializer, ReturnTransactionSerializer, CouponSerializer, TransactionBatchSerializer
+from .serializers import TransactionReadSerializer, ReturnTransactionReadSerializer
 from django.utils import timezone
 from rest_framework_api_key.permissions import HasAPIKey
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAdminUser, SAFE_METHODS
+from rest_framework.decorators import action
+from apps.DBmaint.catalog_cache import catalog_cache
+from apps.DBmaint.catalog_changes import catalog_etag_source, get_catalog_changes, latest_catalog_change
+from apps.DBmaint.db_router import read_from_replica
+from apps.DBmaint.stock import stock_list_version, with_current_quantity
+from django.conf import settings
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from django.utils.dateparse import parse_date, parse_datetime
+import datetime
+import hashlib
+from .idempotency import idempotent
+from .pagination import ReturnTransactionPagination, TransactionPagination
+
+# 複数JAN検索で一度に指定できるJANコードの上限
+ITEM_LOOKUP_MAX_JANS = getattr(settings, "ITEM_LOOKUP_MAX_JANS", 5000)
+# 差分同期で一度に読み込む変更履歴の上限
+CATALOG_CHANGES_PAGE_SIZE = getattr(settings, "CATALOG_CHANGES_PAGE_SIZE", 10000)
+
+
+class ConditionalListMixin:
+    """
+    一覧取得にETag / Last-Modifiedを付与し、
+    If-None-Match / If-Modified-Since が一致する場合はシリアライズせずに304を返す
+    """
+
+    def conditional_list(self, request, source, last_modified=None):
+        """
+        sourceはETagの元になる値で、レスポンスに影響するデータが変わった場合に必ず変わること
+        """
+        self.list_etag = quote_etag(hashlib.md5(f"{request.get_full_path()}|{source}".encode()).hexdigest())
+        self.list_last_modified = int(last_modified.timestamp()) if last_modified else None
+        return get_conditional_response(request, etag=self.list_etag, last_modified=self.list_last_modified)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, "list_etag", None) and response.status_code == status.HTTP_200_OK:
+            response["ETag"] = self.list_etag
+            if self.list_last_modified:
+                response["Last-Modified"] = http_date(self.list_last_modified)
+        return response
+
+
+class ReplicaReadMixin:
+    """
+    読み取りのリクエスト (GET・HEADとreplica_actionsのアクション) をレプリカで処理する
+    レプリカの遅延が閾値を超えている場合はプライマリで処理する
+    """
+
+    # POSTでも読み取りのみを行うアクション
+    replica_actions = ()
+
+    def dispatch(self, request, *args, **kwargs):
+        action = getattr(self, "action_map", {}).get(request.method.lower())
+        if request.method in SAFE_METHODS or action in self.replica_actions:
+            with read_from_replica():
+                return super().dispatch(request, *args, **kwargs)
+        return super().dispatch(request, *args, **kwargs)
 
 
 # 商品情報に対する読み取り専用のViewSet
-class ItemReadOnlyViewSet(viewsets.ReadOnlyModelViewSet):
+class ItemReadOnlyViewSet(ReplicaReadMixin, ConditionalListMixin, viewsets.ReadOnlyModelViewSet):
     """
     JANコードに基づいて商品情報を取得するためのViewSet
     """
     permission_classes = [HasAPIKey | IsAuthenticated]  # APIキーを使用して認証
     serializer_class = ProductSerializer  # 使用するシリアライザーの指定
+    replica_actions = ("lookup",)
 
     def get_queryset(self):
         queryset = Product.objects.all()  # 全ての商品情報を取得
@@ -26,8 +87,27 @@ class ItemReadOnlyViewSet(viewsets.ReadOnlyModelViewSet):
         return queryset
 
     def list(self, request, *args, **kwargs):
-        queryset = self.filter_queryset(self.get_queryset())
-        if not queryset.exists():
+        # 商品が変更されると変更バージョンが必ず増えるため、最新の変更バージョン (と商品の件数・最大のid) からETagを算出する
+        # 商品キャッシュをこのバージョンに追従させ、古い商品を新しいETagで返さないようにする
+        latest = latest_catalog_change()
+        catalog_cache.sync(latest["version"])
+        not_modified = self.conditional_list(request, catalog_etag_source(latest), latest["changed_at"])
+        if not_modified is not None:
+            return not_modified
+
+        jan = request.query_params.get("jan")
+        if jan and "," in jan:
+            # カンマ区切りで複数のJANコードが指定された場合はまとめて検索する
+            return self.lookup_response(jan.split(","))
+        if jan:
+            # JANコード指定時は商品キャッシュから取得する
+            product = catalog_cache.get(jan)
+            queryset = [product] if product else []
+            found = bool(queryset)
+        else:
+            queryset = self.filter_queryset(self.get_queryset())
+            found = queryset.exists()
+        if not found:
             # 指定されたJANコードの商品が見つからない場合は404エラーを返す
             return Response({"Error": "指定したJANコードに合致する製品が見つかりません。"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -39,9 +119,65 @@ class ItemReadOnlyViewSet(viewsets.ReadOnlyModelViewSet):
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
+    @action(detail=False, methods=["post"])
+    def lookup(self, request):
+        """
+        リクエストボディの複数JANコードに合致する商品をまとめて返す
+        {"jans": ["4900000000000", ...]} もしくはカンマ区切りの文字列を受け付ける
+        """
+        jans = request.data.get("jans")
+        if isinstance(jans, str):
+            jans = jans.split(",")
+        if not isinstance(jans, list):
+            return Response({"Error": "jansにJANコードのリストを指定してください。"}, status=status.HTTP_400_BAD_REQUEST)
+        return self.lookup_response(jans)
+
+    def lookup_response(self, jans):
+        # 重複と空白を除いたJANコードを指定順のまま1回のINクエリで検索する
+        jan_codes = list(dict.fromkeys(str(jan).strip() for jan in jans if str(jan).strip()))
+        if len(jan_codes) > ITEM_LOOKUP_MAX_JANS:
+            return Response(
+                {"Error": f"一度に検索できるJANコードは{ITEM_LOOKUP_MAX_JANS}件までです。"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        products = catalog_cache.get_many(jan_codes)
+        return Response(
+            {
+                "found": self.get_serializer([products[jan] for jan in jan_codes if jan in products], many=True).data,
+                "missing": [jan for jan in jan_codes if jan not in products],
+            }
+        )
+
+    @action(detail=False, methods=["get"])
+    def changes(self, request):
+        """
+        指定した変更バージョン(since)以降に登録・更新・削除された商品とクーポンを返す
+        has_moreがTrueの場合は、返却されたversionをsinceに指定して続きを取得する
+        """
+        try:
+            since = int(request.query_params.get("since", 0))
+        except ValueError:
+            return Response({"Error": "sinceには変更バージョンを整数で指定してください。"}, status=status.HTTP_400_BAD_REQUEST)
+
+        changes = get_catalog_changes(since, CATALOG_CHANGES_PAGE_SIZE)
+        data = {"version": changes["version"], "has_more": changes["has_more"]}
+        for kind, serializer_class in (("product", ProductSerializer), ("coupon", CouponSerializer)):
+            upserts = []
+            for instance, version in changes[kind]["upserts"]:
+                row = serializer_class(instance).data
+                row["change_version"] = version
+                upserts.append(row)
+            data[f"{kind}s"] = {"upserts": upserts, "deletes": changes[kind]["deletes"]}
+        return Response(data)
+
+    @action(detail=False, methods=["get"], permission_classes=[IsAdminUser])
+    def cache_stats(self, request):
+        # 商品キャッシュのヒット・ミス件数を返す (ワーカープロセスごとの値)
+        return Response(catalog_cache.stats())
+
 
 # 在庫情報に対する読み取り専用のViewSet
-class StockViewSet(viewsets.ReadOnlyModelViewSet):
+class StockViewSet(ReplicaReadMixin, ConditionalListMixin, viewsets.ReadOnlyModelViewSet):
     """
     JANコードもしくは店舗コードに基づいて在庫情報を取得するためのViewSet
     """
@@ -50,8 +186,14 @@ class StockViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         # select_related を使用して関連する storecode と JAN データをあらかじめ取得
-        queryset = Stock.objects.select_related('storecode', 'JAN').all()
-        
+        # 現在の在庫数はスナップショットと未集約の入出庫から求める
+        return with_current_quantity(self.get_stocks().select_related('storecode', 'JAN'))
+
+    def get_stocks(self):
+        """
+        リクエストの条件で絞り込んだ在庫 (現在の在庫数を付与しない)
+        """
+        queryset = Stock.objects.all()
         jan_code = self.request.query_params.get("jan")
         store_code = self.request.query_params.get("storecode")
 
@@ -65,6 +207,11 @@ class StockViewSet(viewsets.ReadOnlyModelViewSet):
         return queryset
 
     def list(self, request, *args, **kwargs):
+        # 対象の在庫行と入出庫の1回の集計からETagを算出する (在庫行ごとの現在の在庫数は求めない)
+        not_modified = self.conditional_list(request, stock_list_version(self.get_stocks()))
+        if not_modified is not None:
+            return not_modified
+
         queryset = self.filter_queryset(self.get_queryset())
         if not queryset.exists():
             # 指定されたJANコードおよびstorecodeの在庫が見つからない場合は404エラーを返す
@@ -80,15 +227,93 @@ class StockViewSet(viewsets.ReadOnlyModelViewSet):
 
 
 # 取引情報に対するCRUD操作を行うビュー
-class TransactionViewSet(viewsets.ModelViewSet):
+class ReadSerializerMixin:
+    """
+    一覧・詳細の取得では読み取り用のシリアライザー (read_serializer_class) を使い、明細をまとめて読み込む
+    登録・更新 (ブラウザブルAPIの入力フォームを含む) では serializer_class を使う
+    """
+    read_serializer_class = None
+
+    def is_read_request(self):
+        return self.request.method == "GET" and self.action in ("list", "retrieve")
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.is_read_request():
+            queryset = self.read_serializer_class.setup_eager_loading(queryset)
+        return queryset
+
+    def get_serializer_class(self):
+        if self.is_read_request():
+            return self.read_serializer_class
+        return super().get_serializer_class()
+
+
+class PeriodFilterMixin:
+    """
+    一覧取得を店舗・期間・種別で絞り込む
+    期間は date_from / date_to に日付 (YYYY-MM-DD) もしくは日時 (ISO 8601) で指定する (日付のdate_toはその日を含む)
+    """
+    date_field = None
+    type_field = None
+    store_lookup = "storecode"
+
+    def parse_period_param(self, name):
+        """
+        (日時, 日付で指定されたかどうか) を返す (指定されていない場合はNone)
+        """
+        value = self.request.query_params.get(name)
+        if not value:
+            return None
+        try:
+            # parse_datetimeは日付のみの文字列も受け付けるため、先に日付として解釈する
+            day = parse_date(value)
+            if day is not None:
+                parsed, is_date = datetime.datetime.combine(day, datetime.time()), True
+            else:
+                parsed, is_date = parse_datetime(value), False
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise ValidationError({name: "日付 (YYYY-MM-DD) もしくは日時 (ISO 8601) で指定してください。"})
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed, is_date
+
+    def filter_period(self, queryset):
+        params = self.request.query_params
+        if params.get("storecode"):
+            queryset = queryset.filter(**{self.store_lookup: params["storecode"]})
+        if params.get(self.type_field):
+            queryset = queryset.filter(**{self.type_field: params[self.type_field]})
+        date_from = self.parse_period_param("date_from")
+        if date_from is not None:
+            queryset = queryset.filter(**{f"{self.date_field}__gte": date_from[0]})
+        date_to = self.parse_period_param("date_to")
+        if date_to is not None:
+            value, is_date = date_to
+            if is_date:
+                # 日付指定の場合はその日の終わり (翌日0時より前) まで
+                queryset = queryset.filter(**{f"{self.date_field}__lt": value + datetime.timedelta(days=1)})
+            else:
+                queryset = queryset.filter(**{f"{self.date_field}__lte": value})
+        return queryset
+
+
+class TransactionViewSet(ReadSerializerMixin, PeriodFilterMixin, viewsets.ModelViewSet):
     """
     取引情報に対するCRUD操作を行うためのViewSet
     """
     permission_classes = [HasAPIKey | IsAuthenticated]
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
-    pagenation_class = LimitOffsetPagination
+    read_serializer_class = TransactionReadSerializer
+    # 販売日時・IDによるカーソルページネーション (件数・OFFSETを使わない)
+    pagination_class = TransactionPagination
+    date_field = "sale_date"
+    type_field = "sale_type"
 
+    @idempotent
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)  # データのバリデーション
@@ -96,6 +321,23 @@ class TransactionViewSet(viewsets.ModelViewSet):
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
+    @action(detail=False, methods=["post"], url_path="batch")
+    @idempotent
+    def batch(self, request):
+        """
+        オフライン中にレジに溜まった取引をまとめて登録する
+        リクエスト: {"transactions": [取引, ...]} (各取引に販売日時sale_date・レジ側の識別子client_refを指定できる)
+        レスポンス: 取引ごとの登録結果 (status が created もしくは error)
+        """
+        serializer = TransactionBatchSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save()
+        created = sum(1 for result in results if result["status"] == "created")
+        return Response(
+            {"created": created, "failed": len(results) - created, "results": results},
+            status=status.HTTP_200_OK,
+        )
+
     def update(self, request, *args, **kwargs):
         partial = kwargs.pop("partial", False)  # 部分更新かどうか
         instance = self.get_object()
@@ -106,19 +348,16 @@ class TransactionViewSet(viewsets.ModelViewSet):
 
     def list(self, request, *args, **kwargs):
         sale_id = request.query_params.get('sale_id', None)
-        queryset = self.get_queryset()
+        queryset = self.filter_period(self.get_queryset())
         if sale_id is not None:
             queryset = queryset.filter(sale_id=sale_id)
-        if not queryset.exists():
-            return Response({"Error": "指定した売上IDに合致する取引が見つかりません。"}, status=status.HTTP_404_NOT_FOUND)
-        
+
+        # 該当する取引の有無は最初のページの取得結果で判定する (exists() の追加のクエリを使わない)
         page = self.paginate_queryset(queryset)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        if not page and self.paginator.cursor is None:
+            return Response({"Error": "指定した売上IDに合致する取引が見つかりません。"}, status=status.HTTP_404_NOT_FOUND)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -138,15 +377,21 @@ class TestViewSet(ViewSet):
         return Response(data)
 
 
-class ReturnTransactionViewSet(viewsets.ModelViewSet):
+class ReturnTransactionViewSet(ReadSerializerMixin, PeriodFilterMixin, viewsets.ModelViewSet):
     """
     返品取引情報に対するCRUD操作を行うためのViewSet
     """
     permission_classes = [HasAPIKey | IsAuthenticated]
     queryset = ReturnTransaction.objects.all()
     serializer_class = ReturnTransactionSerializer
-    pagination_class = LimitOffsetPagination  # pagenation_class から pagination_class に修正
+    read_serializer_class = ReturnTransactionReadSerializer
+    # 返品日時・IDによるカーソルページネーション (件数・OFFSETを使わない)
+    pagination_class = ReturnTransactionPagination
+    date_field = "return_date"
+    type_field = "return_type"
+    store_lookup = "storecode__storecode"
 
+    @idempotent
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)  # データのバリデーション
@@ -164,19 +409,15 @@ class ReturnTransactionViewSet(viewsets.ModelViewSet):
 
     def list(self, request, *args, **kwargs):
         return_id = request.query_params.get('return_id', None)
-        queryset = self.get_queryset()
+        queryset = self.filter_period(self.get_queryset())
         if return_id is not None:
             queryset = queryset.filter(return_id=return_id)
-            if not queryset.exists():
-                return Response({"Error": "指定した返品IDに合致する取引が見つかりません。"}, status=status.HTTP_404_NOT_FOUND)
-        
+
         page = self.paginate_queryset(queryset)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        if return_id is not None and not page and self.paginator.cursor is None:
+            return Response({"Error": "指定した返品IDに合致する取引が見つかりません。"}, status=status.HTTP_404_NOT_FOUND)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -1,7 +1,10 @@
 from django.shortcuts import render, redirect
 from django.views.decorators.http import require_http_methods
 from django.db import transaction
+from django.db.models import Min
+from collections import Counter
 from apps.DBmaint.models import Product, Stock  # 'DBmaint.models'からのインポートを変更
+from apps.DBmaint.stock import current_quantities, lock_stocks, record_movements
 
 
 # アイテム一覧を取得して、JANコード、商品名、価格を多次元リストに保存する関数
@@ -61,11 +64,22 @@ def proceed_to_checkout(request):
     if "item_list" in request.session:
         item_list = request.session["item_list"]
 
-        for jan in item_list:
-            stock_instance = Stock.objects.filter(JAN__JAN=jan).first()
-            if stock_instance and stock_instance.quantity > 0:
-                stock_instance.quantity -= 1
-                stock_instance.save()
+        # JANごとの販売点数を集計し、各JANの先頭の在庫行に出庫を記録する
+        # 在庫数は0未満にしない (現在の在庫数を超える分は出庫しない)
+        # 現在の在庫数を読んでから出庫を記録するまで対象の在庫行だけをロックし、並行するチェックアウトで二重に出庫しないようにする
+        # (FOR NO KEY UPDATEのため、APIからの販売による入出庫の追記は待たせない)
+        counts = Counter(item_list)
+        first_ids = (
+            Stock.objects.filter(JAN__JAN__in=list(counts)).values("JAN").annotate(first_id=Min("id")).values("first_id")
+        )
+        stocks = lock_stocks(Stock.objects.filter(pk__in=first_ids))
+        current = current_quantities([stock.pk for stock in stocks])
+        record_movements(
+            [
+                (stock.storecode_id, stock.JAN_id, -min(counts[stock.JAN_id], max(current[stock.pk], 0)), "sale", "checkout")
+                for stock in stocks
+            ]
+        )
 
         del request.session["item_list"]
 
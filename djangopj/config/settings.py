@@ -95,6 +95,18 @@ DATABASES = {
     }
 }
 
+# 読み取り専用のAPI・集計・出力に使うレプリカ (POSTGRES_REPLICA_HOSTを指定した場合のみ)
+if os.environ.get("POSTGRES_REPLICA_HOST"):
+    DATABASES["replica"] = {
+        **DATABASES["default"],
+        "HOST": os.environ.get("POSTGRES_REPLICA_HOST"),
+        "PORT": os.environ.get("POSTGRES_REPLICA_PORT", DATABASES["default"]["PORT"]),
+        "OPTIONS": {"connect_timeout": int(os.environ.get("POSTGRES_REPLICA_CONNECT_TIMEOUT", 2))},
+        # テストではレプリカの代わりにdefaultを使う
+        "TEST": {"MIRROR": "default"},
+    }
+DATABASE_ROUTERS = ["apps.DBmaint.db_router.ReplicaRouter"]
+
 # パスワードバリデーション
 AUTH_PASSWORD_VALIDATORS = [
     {"NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator"},
@@ -139,6 +151,62 @@ REST_FRAMEWORK = {
     "PAGE_SIZE": 50,
 }
 
+# 商品キャッシュ (ワーカープロセスごと) の上限件数と有効期間(秒)
+CATALOG_CACHE_SIZE = int(os.environ.get("CATALOG_CACHE_SIZE", 50000))
+CATALOG_CACHE_TTL = int(os.environ.get("CATALOG_CACHE_TTL", 60))
+
+# 商品の複数JAN検索で一度に指定できるJANコードの上限
+ITEM_LOOKUP_MAX_JANS = int(os.environ.get("ITEM_LOOKUP_MAX_JANS", 5000))
+
+# 商品・クーポンの差分同期で一度に読み込む変更履歴の上限
+CATALOG_CHANGES_PAGE_SIZE = int(os.environ.get("CATALOG_CHANGES_PAGE_SIZE", 10000))
+
+# コンパイル済みクーポン索引 (ワーカープロセスごと) の有効期間(秒)
+COUPON_INDEX_TTL = int(os.environ.get("COUPON_INDEX_TTL", 60))
+
+# 取引ID・返品IDの連番をまとめて確保する件数
+TRANSACTION_ID_BLOCK_SIZE = int(os.environ.get("TRANSACTION_ID_BLOCK_SIZE", 100))
+
+# 取引の一括登録で1回に受け付ける最大件数
+TRANSACTION_BATCH_MAX_SIZE = int(os.environ.get("TRANSACTION_BATCH_MAX_SIZE", 1000))
+
+# 取引・返品の一覧を古い順に取得 (ポーリング) する場合に、コミット済みとみなすまでの日時の経過秒数
+KEYSET_TAIL_SETTLE_SECONDS = int(os.environ.get("KEYSET_TAIL_SETTLE_SECONDS", 10))
+
+# Idempotency-Keyと処理結果の保持期間(時間)
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get("IDEMPOTENCY_KEY_TTL_HOURS", 48))
+
+# レシート生成サービス (receiptline) の接続先とタイムアウト(秒)
+RECEIPT_SERVICE_URL = os.environ.get("RECEIPT_SERVICE_URL", "http://receipt:6573")
+RECEIPT_SERVICE_CONNECT_TIMEOUT = float(os.environ.get("RECEIPT_SERVICE_CONNECT_TIMEOUT", 1.0))
+RECEIPT_SERVICE_READ_TIMEOUT = float(os.environ.get("RECEIPT_SERVICE_READ_TIMEOUT", 5.0))
+# レシートサービスへの接続を使い回す数 (ワーカープロセスごと)
+RECEIPT_SERVICE_POOL_SIZE = int(os.environ.get("RECEIPT_SERVICE_POOL_SIZE", 4))
+# 連続して失敗した場合にレシートサービスの呼び出しを止める回数と、止める時間(秒)
+RECEIPT_SERVICE_FAILURE_THRESHOLD = int(os.environ.get("RECEIPT_SERVICE_FAILURE_THRESHOLD", 3))
+RECEIPT_SERVICE_RESET_TIMEOUT = int(os.environ.get("RECEIPT_SERVICE_RESET_TIMEOUT", 30))
+# 生成済みレシートHTMLのキャッシュ上限(バイト、ワーカープロセスごと)
+RECEIPT_CACHE_MAX_BYTES = int(os.environ.get("RECEIPT_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+# 非同期版のレシートビュー (ASGI) でレシートサービスに同時に接続する最大数 (ワーカープロセスごと)
+RECEIPT_SERVICE_ASYNC_POOL_SIZE = int(os.environ.get("RECEIPT_SERVICE_ASYNC_POOL_SIZE", 100))
+
+# 取引・販売商品の出力で1回に読み込む行数
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 2000))
+
+# 在庫の再生成で1回のトランザクションで処理する在庫行数 (商品数×店舗数)
+STOCK_UPSERT_CHUNK_SIZE = int(os.environ.get("STOCK_UPSERT_CHUNK_SIZE", 5000))
+
+# 変更履歴 (取引・販売商品) の月別パーティションを事前に作成する月数と、切り離すまでの保持月数 (0は切り離さない)
+HISTORY_PARTITION_MONTHS_AHEAD = int(os.environ.get("HISTORY_PARTITION_MONTHS_AHEAD", 3))
+HISTORY_PARTITION_RETENTION_MONTHS = int(os.environ.get("HISTORY_PARTITION_RETENTION_MONTHS", 0))
+
+# レプリカのDBエイリアスと、レプリカを使う遅延の上限(秒)・遅延を確認する間隔(秒)
+REPLICA_DATABASE_ALIAS = "replica"
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", 5))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get("REPLICA_LAG_CHECK_INTERVAL", 1))
+# レプリカに接続できない場合に、確認の間隔を延ばす上限(秒)
+REPLICA_RETRY_MAX_INTERVAL = float(os.environ.get("REPLICA_RETRY_MAX_INTERVAL", 30))
+
 # APIキーのカスタムヘッダー
 API_KEY_CUSTOM_HEADER = "HTTP_X_API_KEY"
 
@@ -150,4 +218,5 @@ CORS_ALLOW_ALL_ORIGINS = True
 # 許可するカスタムヘッダーを追加
 CORS_ALLOW_HEADERS = list(default_headers) + [
     'X-Api-Key',
+    'Idempotency-Key',
 ]